@@ -0,0 +1,98 @@
+#!/usr/bin/env python3.5
+
+"""
+On-disk cache of nrfident results
+Results are keyed by the sha256 of the firmware file content and stored with the
+build identity of the nRF.db that produced them.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                             "nrf5x", "ident.db")
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+# bumped when the serialised Result changes, entries of another format are purged like other builds
+RESULT_FORMAT = 4
+
+def content_key(content):
+    """
+    Returns the cache key of a firmware file content
+    """
+    return hashlib.sha256(content).hexdigest()
+
+class IdentCache(object):
+    """
+    Size-bounded LRU cache of identification results
+    Entries produced with another nRF.db build are purged when the cache is opened,
+    the least recently used entries are evicted once max_size bytes are stored.
+    Each thread gets its own connection, an instance can be shared between threads.
+    """
+    def __init__(self, build_id, path=None, max_size=DEFAULT_MAX_SIZE):
+        self.build_id = "{0}/{1}".format(build_id, RESULT_FORMAT)
+        self.path = path if path is not None else DEFAULT_CACHE
+        self.max_size = max_size
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.con.execute("create table if not exists Results (hash text primary key, build_id text, "
+                         "result text, size integer, last_used real)")
+        self.con.execute("create index if not exists Results_last_used on Results (last_used)")
+        with self.con:
+            self.con.execute("delete from Results where build_id != ?", (self.build_id, ))
+
+    @property
+    def con(self):
+        """
+        Returns the connection of the calling thread, opened on first use
+        """
+        con = getattr(self.local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.local.con = con
+            with self.lock:
+                self.connections.append(con)
+        return con
+
+    def close(self):
+        """
+        Closes the cache database connections of all threads
+        """
+        with self.lock:
+            for con in self.connections:
+                con.close()
+            self.connections = []
+        self.local = threading.local()
+
+    def get(self, key):
+        """
+        Returns the cached result of a key, None on a miss
+        """
+        res = self.con.execute("select result from Results where hash=? and build_id=?",
+                               (key, self.build_id)).fetchone()
+        if res is None:
+            return None
+        with self.con:
+            self.con.execute("update Results set last_used=? where hash=?", (time.time(), key))
+        return res[0]
+
+    def put(self, key, result):
+        """
+        Stores a result and evicts the least recently used entries beyond max_size
+        """
+        with self.con:
+            self.con.execute("insert or replace into Results values (?, ?, ?, ?, ?)",
+                             (key, self.build_id, result, len(result), time.time()))
+            total = self.con.execute("select coalesce(sum(size), 0) from Results").fetchone()[0]
+            if total <= self.max_size:
+                return
+            for old_key, size in self.con.execute("select hash, size from Results order by last_used").fetchall():
+                if total <= self.max_size:
+                    break
+                self.con.execute("delete from Results where hash=?", (old_key, ))
+                total -= size
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3.5
+
+"""
+NRF5 region carving tool
+Splits identified firmwares into their MBR, SoftDevice, application and bootloader
+regions, written as separate .bin and/or .hex files.
+.bin inputs are memory mapped and every region is written from a memoryview slice of
+the mapping, without copying the image; .hex inputs are decoded once.
+"""
+import argparse
+import mmap
+import os
+import re
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from nrfdb import NRFDatabase
+from nrfident import decode_image, identify_image, default_db, UICR_BOOTLOADERADDR
+from nrfindex import app_start, list_firmwares
+from nrfdfu import MBR_SIZE
+import nrftrace
+
+HEX_LINE = 16
+NOT_ERASED = re.compile(rb"[^\xff]")
+
+def hex_record(record_type, offset, payload):
+    """
+    Returns an Intel HEX record line
+    """
+    body = struct.pack(">BHB", len(payload), offset, record_type) + bytes(payload)
+    return ":" + (body + bytes([-sum(body) & 0xff])).hex().upper() + "\n"
+
+def write_hex(path, region, base):
+    """
+    Writes a region loaded at the base address as Intel HEX, erased (0xff) lines skipped
+    Lines are aligned on HEX_LINE bytes so none crosses a 64 KiB extended address boundary
+    """
+    erased = b"\xff" * HEX_LINE
+    upper = None
+    with open(path, "w") as hexfile:
+        pos = 0
+        while pos < len(region):
+            addr = base + pos
+            size = min(HEX_LINE - addr % HEX_LINE, len(region) - pos)
+            line = region[pos:pos + size]
+            pos += size
+            if line == erased[:size]:
+                continue
+            if addr >> 16 != upper:
+                upper = addr >> 16
+                hexfile.write(hex_record(0x04, 0, struct.pack(">H", upper)))
+            hexfile.write(hex_record(0x00, addr & 0xffff, line))
+        hexfile.write(hex_record(0x01, 0, b""))
+
+def bootloader_address(uicr):
+    """
+    Returns the bootloader start address of the UICR bytes of a .hex firmware, None if unset
+    """
+    data = bytes(uicr.get(UICR_BOOTLOADERADDR + i, 0xff) for i in range(4))
+    addr = struct.unpack("<I", data)[0]
+    if addr == 0xffffffff:
+        return None
+    return addr
+
+def carve_regions(start, size, bootloader=None):
+    """
+    Returns the (name, start, end) regions of an image whose application starts at start
+    The application ends at the bootloader, which is only known from the UICR of .hex firmwares
+    or given by the caller
+    """
+    end = size
+    if bootloader is not None and start <= bootloader < size:
+        end = bootloader
+    regions = [("mbr", 0, min(MBR_SIZE, start)), ("softdevice", MBR_SIZE, start), ("application", start, end)]
+    if end < size:
+        regions.append(("bootloader", end, size))
+    return [(name, first, last) for name, first, last in regions if first < min(last, size)]
+
+def open_image(path):
+    """
+    Returns the image of a firmware file and the bootloader address of its UICR
+    A .bin file is memory mapped, a .hex file is decoded
+    """
+    if path.lower().endswith(".hex"):
+        uicr = dict()
+        with open(path, "rb") as firmware:
+            image = decode_image(firmware.read(), True, uicr)
+        return memoryview(image), bootloader_address(uicr)
+    with open(path, "rb") as firmware:
+        if os.fstat(firmware.fileno()).st_size == 0:
+            return memoryview(b""), None
+        return memoryview(mmap.mmap(firmware.fileno(), 0, access=mmap.ACCESS_READ)), None
+
+def carve(path, outdir, formats, db=None, bootloader=None):
+    """
+    Identifies a firmware and writes its regions to outdir as <name>.<region>.bin/.hex
+    Returns the identification Result and the (region, start, end, files) written
+    Only images whose SoftDevice signature is known are carved: the regions are None when the
+    end of their SoftDevice is unknown (no memory map nor SoftDevice information structure)
+    """
+    if db is None:
+        db = default_db()
+    elif not isinstance(db, NRFDatabase):
+        with NRFDatabase(db) as own_db:
+            return carve(path, outdir, formats, own_db, bootloader)
+    image, uicr_bootloader = open_image(path)
+    try:
+        with nrftrace.span("identify", firmware=path):
+            result = identify_image(image, db)
+        if result.method != "signature":
+            return result, []
+        start = app_start(result, image)
+        if start is None:
+            return result, None
+        if bootloader is None:
+            bootloader = uicr_bootloader
+        stem = os.path.splitext(os.path.basename(path))[0]
+        carved = []
+        for name, first, end in carve_regions(start, len(image), bootloader):
+            # the slice is released on every path, the mapping cannot be closed while it is exported
+            with image[first:end] as region:
+                if NOT_ERASED.search(region) is None:
+                    continue
+                files = []
+                with nrftrace.span("write_region", firmware=path, region=name):
+                    for fmt in formats:
+                        out_path = os.path.join(outdir, "{0}.{1}.{2}".format(stem, name, fmt))
+                        if fmt == "bin":
+                            with open(out_path, "wb") as out:
+                                out.write(region)
+                        else:
+                            write_hex(out_path, region, first)
+                        files.append(out_path)
+            carved.append((name, first, end, files))
+        return result, carved
+    finally:
+        mapping = image.obj
+        image.release()
+        if isinstance(mapping, mmap.mmap):
+            mapping.close()
+
+def main():
+    """
+    main
+    """
+    parser = argparse.ArgumentParser("nrfcarve.py")
+    parser.add_argument("firmwares", help="firmware files or directories", metavar="FILE", nargs="+")
+    parser.add_argument("--outdir", help="output directory", metavar="DIR", default="carved")
+    parser.add_argument("--formats", help="output formats", choices=["bin", "hex"], nargs="+", default=["bin"])
+    parser.add_argument("--bootloader", help="bootloader start address, when not given by the UICR of a .hex",
+                        metavar="ADDR", type=lambda x: int(x, 0), default=None)
+    parser.add_argument("--db", help="path of nRF.db", default=None)
+    parser.add_argument("--jobs", help="number of worker processes", type=int, default=None)
+    parser.add_argument("--trace", help="write a Chrome trace-event JSON of the carving to FILE",
+                        metavar="FILE", default=None)
+    args = parser.parse_args()
+    nrftrace.enable(args.trace)
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+    firmwares = list_firmwares(args.firmwares)
+    worker = partial(carve, outdir=args.outdir, formats=args.formats, db=args.db, bootloader=args.bootloader)
+    with nrftrace.span("carve", count=len(firmwares)):
+        if len(firmwares) == 1:
+            results = [worker(firmwares[0])]
+        else:
+            with ProcessPoolExecutor(args.jobs) as executor:
+                results = list(executor.map(worker, firmwares, chunksize=16))
+    for path, (result, carved) in zip(firmwares, results):
+        if result.method != "signature":
+            print("{0}: SoftDevice signature not found, not carved".format(path))
+            continue
+        softdevice = result.candidates[0]
+        if carved is None:
+            print("{0}: end of {1} {2} unknown (no memory map nor SoftDevice information), not carved".format(
+                path, softdevice.softdevice_v, softdevice.nrf))
+            continue
+        print("{0}: {1} {2} (SDK {3})".format(path, softdevice.softdevice_v, softdevice.nrf, softdevice.sdk_version))
+        for name, start, end, files in carved:
+            print("    {0:12} {1:#010x}-{2:#010x} {3}".format(name, start, end, " ".join(files)))
+    nrftrace.finish()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3.5
+
+"""
+nRF.db data access layer shared by nrfparse, nrfident and nrfreverse
+The database is opened read-only, queries are exposed as typed methods
+"""
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from urllib.request import pathname2url
+import nrftrace
+
+DB_ENV = "NRF_DB"
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nRF.db")
+
+SoftDeviceRow = namedtuple("SoftDeviceRow", ["sdk_version", "nrf", "softdevice_v"])
+MemoryMap = namedtuple("MemoryMap", ["softdev_v", "card_version", "ram_origin", "ram_length",
+                                     "rom_origin", "rom_length", "nrf"])
+SVCallRow = namedtuple("SVCallRow", ["svc", "function", "ret_type", "arguments"])
+SearchHit = namedtuple("SearchHit", ["kind", "name", "prototype", "rank", "softdevices"])
+MarkerRow = namedtuple("MarkerRow", ["kind", "sign", "softdevice"])
+Layout = namedtuple("Layout", ["name", "kind", "abi", "size", "align", "members"])
+LayoutMember = namedtuple("LayoutMember", ["name", "type_name", "offset", "size", "count", "bit_offset", "bit_size"])
+
+def address(value):
+    """
+    Returns an address of MemoryAddr as an integer
+    Databases built before addresses were stored as integers hold strings such as "0x0001B000"
+    """
+    if isinstance(value, str):
+        return int(value, 0)
+    return value
+
+def memory_map(row):
+    """
+    Returns the MemoryMap of a MemoryAddr row, with integer addresses
+    """
+    softdev_v, card_version, ram_origin, ram_length, rom_origin, rom_length, nrf = row
+    return MemoryMap(softdev_v, card_version, address(ram_origin), address(ram_length), address(rom_origin),
+                     address(rom_length), nrf)
+
+def db_path(path=None):
+    """
+    Returns the path of nRF.db
+    The given path first, then the NRF_DB environment variable,
+    then the nRF.db next to the tools
+    """
+    if path is None:
+        path = os.environ.get(DB_ENV, DEFAULT_DB)
+    return os.path.abspath(path)
+
+class NRFDatabase(object):
+    """
+    Read-only access to nRF.db
+    The database is opened immutable, memory mapped and with a large page cache.
+    Every query is a fixed SQL string so sqlite3 reuses its prepared statement.
+    Each thread gets its own connection, an instance can be shared between threads.
+    """
+    MMAP_SIZE = 256 * 1024 * 1024
+    CACHE_KIB = 64 * 1024
+    CACHED_STATEMENTS = 64
+
+    def __init__(self, path=None):
+        self.path = db_path(path)
+        if not os.path.isfile(self.path):
+            raise IOError("nRF.db not found: {0}".format(self.path))
+        self.uri = "file:" + pathname2url(self.path) + "?mode=ro&immutable=1"
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        tables = self.query("select name from sqlite_master where type='table'", ())
+        # databases built before prototypes were normalised keep the SVCALL/StructArgs tables
+        self.normalised = ("Prototype", ) in tables
+        self.searchable = ("SearchIndex", ) in tables
+        self.markable = ("SDKMarker", ) in tables
+        # databases built before struct layouts only hold the member declarations of StructMember
+        self.laid_out = ("StructLayout", ) in tables
+        self.struct_defs = dict()
+        builds = []
+        if ("BuildInfo", ) in tables:
+            builds = self.query("select build_id from BuildInfo order by id desc limit 1", ())
+        if builds != []:
+            self.build_id = builds[0][0]
+        else:
+            # databases built before BuildInfo are identified by their file
+            stat = os.stat(self.path)
+            self.build_id = "file-{0}-{1}".format(stat.st_size, stat.st_mtime_ns)
+
+    @property
+    def con(self):
+        """
+        Returns the connection of the calling thread, opened on first use
+        """
+        con = getattr(self.local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.uri, uri=True, check_same_thread=False,
+                                  cached_statements=self.CACHED_STATEMENTS)
+            con.execute("PRAGMA mmap_size={0}".format(self.MMAP_SIZE))
+            con.execute("PRAGMA cache_size=-{0}".format(self.CACHE_KIB))
+            con.execute("PRAGMA query_only=1")
+            self.local.con = con
+            with self.lock:
+                self.connections.append(con)
+        return con
+
+    def query(self, req, params):
+        """
+        Runs a query and returns all its rows
+        """
+        with nrftrace.span("sql", query=req):
+            return self.con.execute(req, params).fetchall()
+
+    def close(self):
+        """
+        Closes the database connections of all threads
+        """
+        with self.lock:
+            for con in self.connections:
+                con.close()
+            self.connections = []
+        self.local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def softdevices(self, sign):
+        """
+        Returns the SoftDevices matching the given signature (LIKE pattern)
+        SoftDevices sharing a signature are ordered by SDK version, SoftDevice version and nRF
+        """
+        req = "select sdk_version, nrf, softdevice_v from SoftDevice where sign LIKE ? order by sdk_version, softdevice_v, nrf"
+        return [SoftDeviceRow(*res) for res in self.query(req, (sign, ))]
+
+    def softdevices_of(self, softdevice_v, sdk_version):
+        """
+        Returns the SoftDevices of a SoftDevice version (s132) shipped in an SDK version
+        """
+        req = "select distinct sdk_version, nrf, softdevice_v from SoftDevice where softdevice_v=? and sdk_version=?"
+        return [SoftDeviceRow(*res) for res in self.query(req, (softdevice_v, sdk_version))]
+
+    def softdevice_versions(self, sign, nrf, sdk_version):
+        """
+        Returns the SoftDevice versions of an approximate signature for an nRF and SDK version
+        """
+        req = "select softdevice_v from SoftDevice where sign LIKE ? and nrf=? and sdk_version=?"
+        return [res[0] for res in self.query(req, (sign, nrf, sdk_version))]
+
+    def markers(self):
+        """
+        Returns a dict of the SDK version and nRF part markers and the MarkerRows they designate
+        """
+        markers = dict()
+        req = "select marker, kind, softdev_signature, sdk_version, nrf, softdevice_v from SDKMarker order by id"
+        for marker, kind, sign, sdk_version, nrf, softdevice_v in self.query(req, ()):
+            markers.setdefault(marker, []).append(MarkerRow(kind, sign, SoftDeviceRow(sdk_version, nrf, softdevice_v)))
+        return markers
+
+    def memory_maps(self, sign, nrf=None):
+        """
+        Returns the distinct RAM and FLASH mappings of a signature, optionally for a given nRF
+        """
+        if nrf is None:
+            req = "select softdev_v, card_version, ram_origin, ram_length, rom_origin, rom_length, nrf from MemoryAddr where softdev_signature LIKE ? GROUP BY card_version, ram_origin, ram_length, rom_origin, rom_length"
+            rows = self.query(req, (sign, ))
+        else:
+            req = "select softdev_v, card_version, ram_origin, ram_length, rom_origin, rom_length, nrf from MemoryAddr where softdev_signature LIKE ? and nrf=? GROUP BY card_version, ram_origin, ram_length, rom_origin, rom_length"
+            rows = self.query(req, (sign, nrf))
+        maps = []
+        for res in rows:
+            # legacy string addresses of the same value ("0x18000", "0x00018000") are grouped here
+            mem_map = memory_map(res)
+            if mem_map not in maps:
+                maps.append(mem_map)
+        return maps
+
+    def all_memory_maps(self):
+        """
+        Returns the (signature, MemoryMap) pairs of every known layout
+        """
+        req = "select distinct softdev_signature, softdev_v, card_version, ram_origin, ram_length, rom_origin, rom_length, nrf from MemoryAddr"
+        layouts = set()
+        for res in self.query(req, ()):
+            layouts.add((res[0], memory_map(res[1:])))
+        return sorted(layouts)
+
+    def svc_names(self, syscall, sign):
+        """
+        Returns the distinct SVC names declared for a syscall number
+        """
+        if self.normalised:
+            req = "select distinct(p.svc) from Prototype p join SoftDevicePrototype l on l.proto_hash=p.hash where LOWER(p.syscall)=LOWER(?) and l.softdev_signature LIKE ?"
+        else:
+            req = "select distinct(svc) from SVCALL where LOWER(syscall)=LOWER(?) and softdev_signature LIKE ?"
+        return [res[0] for res in self.query(req, (syscall, sign))]
+
+    def svcalls(self, syscall, sign):
+        """
+        Returns the distinct SVCALL prototypes declared for a syscall number
+        """
+        if self.normalised:
+            req = "select distinct p.svc, p.function, p.ret_type, p.arguments from Prototype p join SoftDevicePrototype l on l.proto_hash=p.hash where LOWER(p.syscall)=LOWER(?) and l.softdev_signature LIKE ?"
+        else:
+            req = "select distinct(svc), function, ret_type, arguments from SVCALL where LOWER(syscall)=LOWER(?) and softdev_signature LIKE ?"
+        return [SVCallRow(*res) for res in self.query(req, (syscall, sign))]
+
+    def svc_table(self, sign):
+        """
+        Returns a dict of the syscall numbers of a signature and their function names
+        """
+        if self.normalised:
+            req = "select distinct p.syscall, p.function from Prototype p join SoftDevicePrototype l on l.proto_hash=p.hash where l.softdev_signature LIKE ?"
+        else:
+            req = "select distinct syscall, function from SVCALL where softdev_signature LIKE ?"
+        table = dict()
+        for syscall, function in self.query(req, (sign, )):
+            # a few radio SVCs are declared with another SVC name instead of a number
+            if syscall.lower().startswith("0x"):
+                table.setdefault(int(syscall, 16), function)
+        return table
+
+    def structs(self, sign):
+        """
+        Returns a dict of the structures of a signature and their members, in declaration order
+        """
+        if self.normalised:
+            return self.struct_defs_of(sign)
+        structs = dict()
+        req = "select distinct(name) from Structures where softdev_signature LIKE ?"
+        for res in self.query(req, (sign, )):
+            structs[res[0]] = []
+        req = "select struct_name, arg_name from StructArgs where softdev_signature LIKE ? order by id"
+        for struct_name, arg_name in self.query(req, (sign, )):
+            args = structs.setdefault(struct_name, [])
+            if arg_name not in args:
+                args.append(arg_name)
+        return structs
+
+    def struct_defs_of(self, sign):
+        """
+        Returns the structures of a signature from the content-addressed StructDef table
+        Structure definitions are cached by hash and shared by every signature using them
+        """
+        req = "select distinct(struct_hash) from SoftDeviceStruct where softdev_signature LIKE ?"
+        hashes = [res[0] for res in self.query(req, (sign, ))]
+        missing = set(struct_hash for struct_hash in hashes if struct_hash not in self.struct_defs)
+        if missing:
+            req = "select d.hash, d.name, m.arg_name from StructDef d left join StructMember m on m.struct_hash=d.hash where d.hash in (select distinct(struct_hash) from SoftDeviceStruct where softdev_signature LIKE ?) order by d.hash, m.position"
+            loaded = dict()
+            for struct_hash, name, arg_name in self.query(req, (sign, )):
+                if struct_hash in missing:
+                    name, args = loaded.setdefault(struct_hash, (name, []))
+                    if arg_name is not None:
+                        args.append(arg_name)
+            with self.lock:
+                self.struct_defs.update(loaded)
+        structs = dict()
+        for struct_hash in hashes:
+            name, args = self.struct_defs[struct_hash]
+            merged = structs.setdefault(name, [])
+            for arg in args:
+                if arg not in merged:
+                    merged.append(arg)
+        return structs
+
+    def layouts(self, sign):
+        """
+        Returns a dict of the structure and union Layouts of a signature, an empty dict if
+        the database has no layouts
+        """
+        if not self.laid_out:
+            return dict()
+        req = "select l.hash, l.name, l.kind, l.abi, l.size, l.align, m.name, m.type_name, m.offset, m.size, m.count, m.bit_offset, m.bit_size from StructLayout l left join LayoutMember m on m.layout_hash=l.hash where l.hash in (select distinct(layout_hash) from SoftDeviceLayout where softdev_signature LIKE ?) order by l.hash, m.position"
+        layouts = dict()
+        by_hash = dict()
+        for row in self.query(req, (sign, )):
+            layout_hash, name, kind, abi, size, align = row[:6]
+            if layout_hash not in by_hash:
+                by_hash[layout_hash] = Layout(name, kind, abi, size, align, [])
+                # an approximate signature may match several SoftDevices: the first layout of a name is kept
+                layouts.setdefault(name, by_hash[layout_hash])
+            if row[6] is not None:
+                by_hash[layout_hash].members.append(LayoutMember(*row[6:]))
+        return layouts
+
+    def search(self, match, sdk_version=None, softdevice_v=None, nrf=None, limit=50):
+        """
+        Returns the functions and structures matching an FTS5 query, best ranked first
+        Each hit lists the SoftDevices defining it, optionally filtered by SDK version,
+        SoftDevice version and nRF
+        """
+        if not self.searchable:
+            raise ValueError("{0} has no SearchIndex, rebuild it with nrfparse.py".format(self.path))
+        req = "select s.ref, s.kind, s.name, s.prototype, bm25(SearchIndex) as rank, d.sdk_version, d.nrf, d.softdevice_v from SearchIndex s join (select proto_hash as ref, softdev_signature from SoftDevicePrototype union all select struct_hash, softdev_signature from SoftDeviceStruct) l on l.ref=s.ref join SoftDevice d on d.sign=l.softdev_signature where SearchIndex MATCH ?1 and (?2 is null or d.sdk_version=?2) and (?3 is null or d.softdevice_v=?3) and (?4 is null or d.nrf=?4) order by rank, s.ref, d.sdk_version, d.softdevice_v, d.nrf"
+        try:
+            rows = self.query(req, (match, sdk_version, softdevice_v, nrf))
+        except sqlite3.OperationalError as err:
+            raise ValueError("invalid query {0!r}: {1}".format(match, err))
+        hits = []
+        by_ref = dict()
+        for ref, kind, name, prototype, rank, row_sdk, row_nrf, row_softdevice in rows:
+            if ref not in by_ref:
+                if len(hits) == limit:
+                    break
+                by_ref[ref] = SearchHit(kind, name, prototype, rank, [])
+                hits.append(by_ref[ref])
+            softdevice = SoftDeviceRow(row_sdk, row_nrf, row_softdevice)
+            if softdevice not in by_ref[ref].softdevices:
+                by_ref[ref].softdevices.append(softdevice)
+        return hits
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3.5
+
+"""
+nrfutil DFU package support for nrfident
+Members are read from the .zip in memory: the manifest and init packets are parsed,
+every firmware component is identified and the SoftDevice requirement declared by
+the init packets is cross-checked against nRF.db.
+"""
+import io
+import json
+import os
+import struct
+import zipfile
+from collections import namedtuple
+from nrfident import identify_image, default_db
+from nrfdb import NRFDatabase
+import nrftrace
+
+MBR_SIZE = 0x1000
+SD_ANY = 0xfffe
+FW_TYPES = {0: "application", 1: "softdevice", 2: "bootloader", 3: "softdevice_bootloader",
+            4: "external_application"}
+# SoftDevice firmware IDs (FWID) used in sd_req: SoftDevice, version and SDK versions shipping it
+SD_FWIDS = {
+    0x64: ("s110", "8.0.0", ("8.0.0", "8.1.0", "9.0.0", "10.0.0")),
+    0x67: ("s130", "1.0.0", ("8.1.0", "9.0.0", "10.0.0")),
+    0x80: ("s130", "2.0.0", ("11.0.0", )),
+    0x81: ("s132", "2.0.0", ("11.0.0", )),
+    0x87: ("s130", "2.0.1", ("12.0.0", "12.1.0", "12.2.0", "12.3.0", "13.0.0-1.alpha")),
+    0x88: ("s132", "2.0.1", ()),
+    0x8c: ("s132", "3.0.0", ("12.0.0", "12.1.0", "12.2.0")),
+    0x91: ("s132", "3.1.0", ("12.3.0", )),
+    0x95: ("s132", "4.0.0", ()),
+    0x98: ("s132", "4.0.2", ("13.0.0", "13.1.0")),
+    0x99: ("s132", "4.0.3", ()),
+    0x9e: ("s132", "4.0.4", ()),
+    0x9f: ("s132", "4.0.5", ()),
+    0x9d: ("s132", "5.0.0", ("14.0.0", "14.1.0")),
+    0xa5: ("s132", "5.1.0", ("14.2.0", )),
+    0xa7: ("s112", "6.0.0", ("15.0.0", )),
+    0xa8: ("s132", "6.0.0", ("15.0.0", )),
+    0xa9: ("s140", "6.0.0", ("15.0.0", )),
+    0xae: ("s140", "6.1.0", ("15.2.0", )),
+    0xaf: ("s132", "6.1.0", ("15.2.0", )),
+    0xb0: ("s112", "6.1.0", ("15.2.0", )),
+    0xb6: ("s140", "6.1.1", ("15.3.0", )),
+    0xb7: ("s132", "6.1.1", ("15.3.0", )),
+    0xb8: ("s112", "6.1.1", ("15.3.0", )),
+}
+
+InitPacket = namedtuple("InitPacket", ["fw_type", "fw_version", "hw_version", "sd_req", "sd_size", "bl_size",
+                                       "app_size", "hash", "is_debug"])
+Requirement = namedtuple("Requirement", ["fwid", "softdevice_v", "version", "softdevices"])
+Component = namedtuple("Component", ["name", "bin_file", "size", "init", "result", "requirements", "consistent"])
+
+def read_varint(data, pos):
+    """
+    Returns a protobuf varint and the position following it
+    """
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("truncated varint")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte & 0x80 == 0:
+            return value, pos
+
+def decode_message(data):
+    """
+    Returns the fields of a protobuf message as a dict of field number to list of values
+    Length-delimited values are returned as bytes, to be decoded by the caller
+    """
+    fields = dict()
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            if pos + length > len(data):
+                raise ValueError("truncated field")
+            value = bytes(data[pos:pos + length])
+            pos += length
+        elif wire_type == 5:
+            value = struct.unpack_from("<I", data, pos)[0]
+            pos += 4
+        elif wire_type == 1:
+            value = struct.unpack_from("<Q", data, pos)[0]
+            pos += 8
+        else:
+            raise ValueError("unsupported wire type {0}".format(wire_type))
+        fields.setdefault(key >> 3, []).append(value)
+    return fields
+
+def packed_varints(values):
+    """
+    Returns the integers of a repeated field, packed or not
+    """
+    numbers = []
+    for value in values:
+        if isinstance(value, bytes):
+            pos = 0
+            while pos < len(value):
+                number, pos = read_varint(value, pos)
+                numbers.append(number)
+        else:
+            numbers.append(value)
+    return numbers
+
+def parse_init_command(data):
+    """
+    Returns the InitPacket of a protobuf init packet (nrfutil >= 1.5, SDK >= 12)
+    Packet { Command command = 1; SignedCommand signed_command = 2 }, the signed command
+    wraps the command as its field 1, Command.init (field 2) is the InitCommand
+    """
+    packet = decode_message(data)
+    if 2 in packet:
+        command = decode_message(decode_message(packet[2][0]).get(1, [b""])[0])
+    elif 1 in packet:
+        command = decode_message(packet[1][0])
+    else:
+        raise ValueError("not an init packet")
+    if 2 not in command:
+        raise ValueError("no init command")
+    init = decode_message(command[2][0])
+    fw_hash = None
+    if 8 in init:
+        fw_hash = decode_message(init[8][0]).get(2, [b""])[0].hex()
+    first = lambda field, default=None: init[field][0] if field in init else default
+    return InitPacket(FW_TYPES.get(first(4, 0), "unknown"), first(1), first(2), packed_varints(init.get(3, [])),
+                      first(5, 0), first(6, 0), first(7, 0), fw_hash, bool(first(9, 0)))
+
+def parse_legacy_init(data, fw_type):
+    """
+    Returns the InitPacket of a legacy init packet (SDK <= 11)
+    device_type, device_rev, application_version, softdevice_len, softdevice[], crc16
+    """
+    device_type, device_rev, app_version, sd_len = struct.unpack_from("<HHIH", data)
+    sd_req = list(struct.unpack_from("<{0}H".format(sd_len), data, 10))
+    return InitPacket(fw_type, app_version, device_type, sd_req, 0, 0, 0, None, False)
+
+def parse_init_packet(data, fw_type):
+    """
+    Returns the InitPacket of a .dat init packet, protobuf or legacy
+    """
+    try:
+        return parse_init_command(data)
+    except (ValueError, IndexError, struct.error):
+        return parse_legacy_init(data, fw_type)
+
+def requirements(sd_req, db):
+    """
+    Returns the SoftDevices of nRF.db matching the FWIDs of an sd_req list
+    """
+    reqs = []
+    for fwid in sd_req:
+        if fwid == SD_ANY or fwid not in SD_FWIDS:
+            reqs.append(Requirement(fwid, None, None, []))
+            continue
+        softdevice_v, version, sdk_versions = SD_FWIDS[fwid]
+        softdevices = []
+        for sdk_version in sdk_versions:
+            softdevices += db.softdevices_of(softdevice_v, sdk_version)
+        reqs.append(Requirement(fwid, softdevice_v, version, softdevices))
+    return reqs
+
+def component_images(name, firmware, init):
+    """
+    Returns the (name, image) pairs to identify in a component
+    SoftDevice images are placed after the MBR so their signature area is at the usual offset,
+    the bootloader of a SoftDevice + bootloader component is split with the declared sizes
+    """
+    if name == "softdevice":
+        return [("softdevice", b"\xff" * MBR_SIZE + firmware)]
+    if name == "softdevice_bootloader" and init is not None and init.sd_size:
+        return [("softdevice", b"\xff" * MBR_SIZE + firmware[:init.sd_size]),
+                ("bootloader", firmware[init.sd_size:])]
+    return [(name, firmware)]
+
+def read_manifest(package):
+    """
+    Returns the components of a package manifest: {name: (bin_file, dat_file, entry)}
+    """
+    manifest = json.loads(package.read("manifest.json").decode("utf-8"))["manifest"]
+    components = dict()
+    for name, entry in manifest.items():
+        if isinstance(entry, dict) and "bin_file" in entry:
+            components[name] = (entry["bin_file"], entry.get("dat_file"), entry)
+    return components
+
+def identify_package(source, db=None):
+    """
+    Identifies the firmware components of a DFU package given as a buffer or a .zip path
+    Returns a list of Component, one per identified image, with the SoftDevices required
+    by its init packet and whether the identification is consistent with them:
+    an application is checked against its own sd_req, a SoftDevice against the sd_req of
+    the applications of the package (the sd_req of a SoftDevice is the one it replaces)
+    """
+    if db is None:
+        db = default_db()
+    elif not isinstance(db, NRFDatabase):
+        with NRFDatabase(db) as own_db:
+            return identify_package(source, own_db)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    members = []
+    with zipfile.ZipFile(source) as package:
+        for name, (bin_file, dat_file, entry) in sorted(read_manifest(package).items()):
+            with nrftrace.span("dfu_member", member=bin_file):
+                firmware = package.read(bin_file)
+                init = None
+                if dat_file is not None:
+                    init = parse_init_packet(package.read(dat_file), name)
+                if init is not None and init.sd_req == []:
+                    # legacy manifests also list the requirement in init_packet_data
+                    init = init._replace(sd_req=entry.get("init_packet_data", {}).get("softdevice_req", []))
+                if init is not None and init.sd_size == 0:
+                    init = init._replace(sd_size=entry.get("info_read_only_metadata", {}).get("sd_size", 0))
+            reqs = requirements(init.sd_req if init is not None else [], db)
+            members.append((name, bin_file, firmware, init, reqs))
+    app_required = set(softdevice for name, bin_file, firmware, init, reqs in members
+                       if name == "application" for req in reqs for softdevice in req.softdevices)
+    components = []
+    for name, bin_file, firmware, init, reqs in members:
+        for part, image in component_images(name, firmware, init):
+            with nrftrace.span("dfu_identify", member=bin_file, part=part):
+                result = identify_image(image, db)
+            required = set()
+            if part == "application":
+                required = set(softdevice for req in reqs for softdevice in req.softdevices)
+            elif part == "softdevice":
+                required = app_required
+            consistent = None
+            if result.identified and required:
+                consistent = bool(required & set(tuple(candidate) for candidate in result.candidates))
+            components.append(Component(part, bin_file, len(firmware), init, result, reqs, consistent))
+    return components
+
+def is_package(path):
+    """
+    Returns whether a file is a DFU package
+    """
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as package:
+        return "manifest.json" in package.namelist()
+
+def print_package(path, components):
+    """
+    Prints the identification of the components of a DFU package
+    """
+    print("DFU package {0}: {1} components".format(os.path.basename(path), len(components)))
+    for component in components:
+        print("=========================")
+        print("Component: {0} ({1}, {2} bytes)".format(component.name, component.bin_file, component.size))
+        if component.init is not None:
+            print("Init packet: type {0}, firmware version {1}, hardware version {2}".format(
+                component.init.fw_type, component.init.fw_version, component.init.hw_version))
+        for req in component.requirements:
+            if req.softdevice_v is None:
+                print("Requires SoftDevice FWID {0:#x} ({1})".format(
+                    req.fwid, "any" if req.fwid == SD_ANY else "unknown"))
+            else:
+                print("Requires SoftDevice FWID {0:#x}: {1} {2}, {3} in nRF.db".format(
+                    req.fwid, req.softdevice_v, req.version, len(req.softdevices)))
+        result = component.result
+        if not result.identified:
+            print("Can't be identified")
+            continue
+        print("Identified by {0}: {1}".format(result.method, result.sign))
+        for candidate in result.candidates:
+            print("SDK version: {0}, SoftDevice version: {1}, NRF: {2}".format(candidate.sdk_version,
+                                                                              candidate.softdevice_v, candidate.nrf))
+        if component.consistent is False:
+            print("WARNING: identified SoftDevice does not match the declared requirement")
+        elif component.consistent:
+            print("Consistent with the declared SoftDevice requirement")
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3.5
+
+"""
+NRF5 fleet drift report
+Compares many firmware images in one parallel pass: each image is reduced to the hashes
+of its SoftDevice and application regions and to the SVC numbers its application calls.
+Identical images are clustered and every cluster is compared with the most common one,
+so the report never compares images pairwise.
+"""
+import argparse
+import hashlib
+import json
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from nrfident import read_source, decode_image, identify_image, default_db
+from nrfindex import app_start, svc_sites, list_firmwares
+import nrftrace
+
+Fingerprint = namedtuple("Fingerprint", ["path", "softdevice", "sd_hash", "app_hash", "svcs"])
+Cluster = namedtuple("Cluster", ["name", "paths", "softdevice", "sd_variant", "app_variant", "svcs"])
+
+def region_hash(region):
+    """
+    Returns the hash of a region, erased (0xff) trailing bytes excepted
+    """
+    return hashlib.sha256(bytes(region).rstrip(b"\xff")).hexdigest()
+
+def fingerprint(path, db=None):
+    """
+    Returns the Fingerprint of an image: identified SoftDevice, region hashes and SVC numbers
+    The image is identified against the nRF.db path db, the default nRF.db if None
+    The application region starts at the FLASH origin of the identified SoftDevice, at 0 if none is
+    identified; it is empty when the end of the identified SoftDevice is unknown
+    """
+    image = decode_image(*read_source(path))
+    result = identify_image(image, default_db(db))
+    softdevice = None
+    if result.identified:
+        softdevice = " / ".join(sorted(set("{0} {1} {2}".format(candidate.sdk_version, candidate.softdevice_v,
+                                                                candidate.nrf) for candidate in result.candidates)))
+    start = app_start(result, image)
+    if start is None:
+        start = len(image)
+    svcs = sorted(svc_sites(image, start))
+    return Fingerprint(path, softdevice, region_hash(image[:start]), region_hash(image[start:]), svcs)
+
+def try_fingerprint(path, db=None):
+    """
+    Returns (fingerprint(path, db), None), or (None, error message) when the image cannot be
+    read, decoded or identified: one corrupt image does not abort the comparison
+    """
+    try:
+        return fingerprint(path, db), None
+    except Exception as err:
+        return None, "{0}: {1}".format(type(err).__name__, err)
+
+def variants(hashes):
+    """
+    Returns a name per distinct hash, "0" for the most common one
+    """
+    counts = dict()
+    for value in hashes:
+        counts[value] = counts.get(value, 0) + 1
+    ordered = sorted(counts, key=lambda value: (-counts[value], value))
+    return dict((value, str(i)) for i, value in enumerate(ordered))
+
+def cluster(fingerprints):
+    """
+    Returns the clusters of identical images (same SoftDevice and application regions),
+    the largest first
+    """
+    sd_variants = variants(fp.sd_hash for fp in fingerprints)
+    app_variants = variants(fp.app_hash for fp in fingerprints)
+    groups = dict()
+    for fp in fingerprints:
+        groups.setdefault((fp.sd_hash, fp.app_hash), []).append(fp)
+    ordered = sorted(groups.values(), key=lambda group: (-len(group), group[0].path))
+    clusters = []
+    for i, group in enumerate(ordered):
+        first = group[0]
+        clusters.append(Cluster("C{0}".format(i), sorted(fp.path for fp in group), first.softdevice,
+                                "SD" + sd_variants[first.sd_hash], "APP" + app_variants[first.app_hash],
+                                first.svcs))
+    return clusters
+
+def drift(baseline, other):
+    """
+    Returns the regions in which a cluster differs from the baseline and its added and removed SVCs
+    """
+    regions = []
+    if other.sd_variant != baseline.sd_variant:
+        regions.append("softdevice")
+    if other.app_variant != baseline.app_variant:
+        regions.append("application")
+    added = sorted(set(other.svcs) - set(baseline.svcs))
+    removed = sorted(set(baseline.svcs) - set(other.svcs))
+    return regions, added, removed
+
+def compare(paths, jobs=None, db=None):
+    """
+    Fingerprints the firmwares of the given files and directories in parallel and clusters them
+    Firmwares that cannot be read or decoded are reported and left out
+    """
+    firmwares = list_firmwares(paths)
+    fingerprints = []
+    with ProcessPoolExecutor(jobs) as executor:
+        for path, (fp, error) in zip(firmwares, executor.map(partial(try_fingerprint, db=db), firmwares,
+                                                             chunksize=16)):
+            if error is not None:
+                print("{0}: left out, {1}".format(path, error))
+                continue
+            fingerprints.append(fp)
+    return cluster(fingerprints)
+
+def print_report(clusters):
+    """
+    Prints the drift matrix: one row per cluster compared with the largest one
+    """
+    images = sum(len(group.paths) for group in clusters)
+    print("{0} images, {1} clusters, {2} SoftDevice variants, {3} application variants".format(
+        images, len(clusters), len(set(group.sd_variant for group in clusters)),
+        len(set(group.app_variant for group in clusters))))
+    if clusters == []:
+        return
+    baseline = clusters[0]
+    print("{0:8} {1:>7} {2:6} {3:7} {4:24} {5}".format("cluster", "images", "sd", "app", "differs", "svcs"))
+    for group in clusters:
+        regions, added, removed = drift(baseline, group)
+        svcs = " ".join(["+" + hex(svc) for svc in added] + ["-" + hex(svc) for svc in removed])
+        print("{0:8} {1:>7} {2:6} {3:7} {4:24} {5}".format(group.name, len(group.paths), group.sd_variant,
+                                                           group.app_variant,
+                                                           ",".join(regions) or "baseline", svcs))
+    print()
+    for group in clusters:
+        print("{0} {1}: {2}".format(group.name, group.softdevice or "unidentified SoftDevice",
+                                    " ".join(group.paths)))
+
+def write_json(clusters, path):
+    """
+    Writes the clusters and their drift from the baseline as JSON
+    """
+    report = []
+    for group in clusters:
+        regions, added, removed = drift(clusters[0], group)
+        report.append({"cluster": group.name, "images": group.paths, "softdevice": group.softdevice,
+                       "sd_variant": group.sd_variant, "app_variant": group.app_variant,
+                       "svcs": [hex(svc) for svc in group.svcs], "differs": regions,
+                       "svcs_added": [hex(svc) for svc in added], "svcs_removed": [hex(svc) for svc in removed]})
+    with open(path, "w") as report_file:
+        json.dump(report, report_file, indent=1)
+    print("Report written to {0}".format(path))
+
+def main():
+    """
+    main
+    """
+    parser = argparse.ArgumentParser("nrfdrift.py")
+    parser.add_argument("firmwares", help="firmware files or directories", metavar="FILE", nargs="+")
+    parser.add_argument("--jobs", help="number of worker processes", type=int, default=None)
+    parser.add_argument("--json", help="also write the report as JSON to FILE", metavar="FILE", default=None)
+    parser.add_argument("--db", help="path of nRF.db", default=None)
+    parser.add_argument("--trace", help="write a Chrome trace-event JSON of the comparison to FILE",
+                        metavar="FILE", default=None)
+    args = parser.parse_args()
+    nrftrace.enable(args.trace)
+    with nrftrace.span("compare"):
+        clusters = compare(args.firmwares, args.jobs, args.db)
+    print_report(clusters)
+    if args.json is not None:
+        write_json(clusters, args.json)
+    nrftrace.finish()
+
+if __name__ == "__main__":
+    main()
@@ -4,17 +4,273 @@
 NRF5 identification tool based on
 - their .hex signature
 - or strings contained in their .bin version
+
+With the SDKMarker table of nRF.db, the strings identification is a single scan of
+the image for every known SDK version and nRF part marker.
+
+identify() is the library entry point: it only reads the firmware and nRF.db,
+prints nothing, writes nothing and can be called concurrently from threads.
 """
 import hashlib
-import sqlite3
-import subprocess
-import sys
+import io
+import json
 import os
+import re
 import argparse
+import threading
 import time
+from collections import namedtuple
 from intelhex import IntelHex
 from intelhex import bin2hex
 from tqdm import tqdm
+from nrfdb import NRFDatabase, MemoryMap, db_path
+from nrfcache import IdentCache, content_key
+from nrfsidecar import Sidecar
+import nrftrace
+
+SIGN_OFFSET = 4096
+SIGN_LENGTH = 10000
+STRINGS_RE = re.compile(rb"[\t\x20-\x7e]{4,}")
+FICR_BASE = 0x10000000
+UICR_BOOTLOADERADDR = 0x10001014
+
+Candidate = namedtuple("Candidate", ["sdk_version", "nrf", "softdevice_v"])
+Result = namedtuple("Result", ["identified", "method", "sign", "candidates", "memory_maps", "confidence",
+                               "image_sign"])
+
+_databases = dict()
+_databases_lock = threading.Lock()
+_scanners = dict()
+_scanners_lock = threading.Lock()
+
+def compute_signature(image):
+    """
+    Returns the SoftDevice signature of a binary image
+    The signature is the sha256 hash of 10000 bytes after the MBR page (0x1000)
+    """
+    return hashlib.sha256(bytes(image[SIGN_OFFSET:SIGN_OFFSET + SIGN_LENGTH])).hexdigest()
+
+def strings_signature(image):
+    """
+    Returns the approximate signature (sdk_nrf) built from the SDK paths found in the image strings
+    Same result as: strings | grep Nordic\\ Semiconductor/ | cut -d '/' -f 3,5 | sed s/'\\/'/'_'/g
+    | cut -d ' ' -f 2 | sed s/'SDK_'/''/g | sed s/'.0_'/'_'/g | sort -u
+    """
+    markers = set()
+    for match in STRINGS_RE.finditer(bytes(image)):
+        line = match.group().decode("ascii")
+        if "Nordic Semiconductor/" not in line:
+            continue
+        fields = line.split("/")
+        marker = "/".join(fields[i] for i in (2, 4) if i < len(fields)).replace("/", "_")
+        if " " in marker:
+            marker = marker.split(" ")[1]
+        marker = re.sub(".0_", "_", marker.replace("SDK_", ""))
+        markers.add(marker)
+    return "\n".join(sorted(markers))
+
+class MarkerScanner(object):
+    """
+    Multi-pattern scanner of the SDKMarker table
+    Every marker is searched in one pass over the lowercased image by a single compiled
+    alternation, longest markers first so that "sdk_13.0.0-1.alpha" wins over "sdk_13.0.0".
+    The matched markers are resolved to SoftDevices with dict lookups.
+    """
+    def __init__(self, markers):
+        self.markers = markers
+        patterns = sorted(markers, key=lambda marker: (-len(marker), marker))
+        self.pattern = None
+        if patterns != []:
+            self.pattern = re.compile(b"|".join(re.escape(marker.encode("ascii")) for marker in patterns))
+
+    def scan(self, image):
+        """
+        Returns the set of markers found in an image
+        """
+        if self.pattern is None:
+            return set()
+        return set(match.group().decode("ascii") for match in self.pattern.finditer(bytes(image).lower()))
+
+    def resolve(self, found):
+        """
+        Returns the (signature, SoftDeviceRow) pairs, sorted by SoftDevice, designated by a set of markers
+        SDK markers give the candidates, nRF part markers narrow them when they agree
+        """
+        sdks = set()
+        parts = set()
+        for marker in found:
+            for row in self.markers[marker]:
+                (sdks if row.kind == "sdk" else parts).add((row.sign, row.softdevice))
+        return sorted((sdks & parts) or sdks, key=lambda pair: (pair[1], pair[0]))
+
+def marker_scanner(db):
+    """
+    Returns the MarkerScanner of a nRF.db build, built on first use and shared between threads
+    """
+    with _scanners_lock:
+        scanner = _scanners.get(db.build_id)
+        if scanner is None:
+            scanner = MarkerScanner(db.markers())
+            _scanners[db.build_id] = scanner
+        return scanner
+
+def read_source(source):
+    """
+    Returns the content of a buffer or of a file path, and whether it is in the ihex format
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return source, False
+    path = os.fspath(source)
+    with open(path, "rb") as firmware:
+        return firmware.read(), path.lower().endswith(".hex")
+
+def decode_image(content, is_hex, uicr=None):
+    """
+    Returns the binary image of a firmware content
+    The FICR/UICR bytes of a .hex content are stored in the uicr dict if one is given
+    """
+    if is_hex:
+        ihex = IntelHex(io.StringIO(content.decode("ascii")))
+        if ihex.maxaddr() is not None and ihex.maxaddr() >= FICR_BASE:
+            # FICR/UICR records (bootloader address, customer registers) are not part of the FLASH image
+            for addr in [addr for addr in ihex.addresses() if addr >= FICR_BASE]:
+                if uicr is not None:
+                    uicr[addr] = ihex[addr]
+                del ihex[addr]
+        return ihex.tobinstr()
+    return content
+
+def load_image(source):
+    """
+    Returns the binary image of a buffer, or of a .hex or .bin file path
+    """
+    return decode_image(*read_source(source))
+
+def result_to_json(result):
+    """
+    Serialises a Result for the result cache
+    """
+    fields = result._asdict()
+    fields["candidates"] = [list(candidate) for candidate in result.candidates]
+    fields["memory_maps"] = [list(memory_map) for memory_map in result.memory_maps]
+    return json.dumps(fields)
+
+def result_from_json(text):
+    """
+    Restores a Result serialised by result_to_json
+    """
+    fields = json.loads(text)
+    fields["candidates"] = [Candidate(*candidate) for candidate in fields["candidates"]]
+    fields["memory_maps"] = [MemoryMap(*memory_map) for memory_map in fields["memory_maps"]]
+    return Result(**fields)
+
+def default_db(path=None):
+    """
+    Returns the NRFDatabase of a nRF.db path shared by the calls of the process, the default nRF.db if None
+    identify() calls not providing a database share the default one
+    """
+    path = db_path(path)
+    with _databases_lock:
+        if path not in _databases:
+            _databases[path] = NRFDatabase(path)
+        return _databases[path]
+
+def identify_image(image, db, sidecar=None):
+    """
+    Identifies a binary image against nRF.db
+    Exact signature matches have confidence 1, matches on the SDK strings of the image
+    have confidence 0.5 shared between the possible SoftDevices: SDK markers if nRF.db
+    has an SDKMarker table, the "Nordic Semiconductor/" paths otherwise
+    With a signature sidecar, unknown signatures are rejected without querying nRF.db
+    """
+    image_sign = compute_signature(image)
+    if sidecar is None or sidecar.lookup(image_sign) != []:
+        res = db.softdevices(image_sign)
+    else:
+        res = []
+    if res != []:
+        candidates = [Candidate(*sdv) for sdv in res]
+        return Result(True, "signature", image_sign, candidates, db.memory_maps(image_sign), 1.0, image_sign)
+    if db.markable:
+        return identify_markers(image, db, image_sign)
+    nrf_sign = strings_signature(image)
+    if "_" not in nrf_sign:
+        return Result(False, None, image_sign, [], [], 0.0, image_sign)
+    sdk_version = nrf_sign.split("_")[0]
+    nrf = nrf_sign.split("_")[1]
+    sign = "%" + nrf_sign + "%"
+    versions = db.softdevice_versions(sign, nrf, sdk_version)
+    candidates = [Candidate(sdk_version, nrf, sdv) for sdv in versions]
+    if len(versions) > 1:
+        memory_maps = db.memory_maps(sign)
+    else:
+        memory_maps = db.memory_maps(sign, nrf)
+    confidence = 0.5 / len(candidates) if candidates != [] else 0.0
+    return Result(candidates != [], "strings", sign, candidates, memory_maps, confidence, image_sign)
+
+def identify_markers(image, db, image_sign):
+    """
+    Identifies a binary image by the SDK version and nRF part markers of its strings
+    The signature of the result is the first candidate's, the memory maps are those of every candidate
+    """
+    scanner = marker_scanner(db)
+    with nrftrace.span("marker_scan"):
+        found = scanner.resolve(scanner.scan(image))
+    if found == []:
+        return Result(False, None, image_sign, [], [], 0.0, image_sign)
+    candidates = []
+    memory_maps = []
+    for sign, softdevice in found:
+        if Candidate(*softdevice) not in candidates:
+            candidates.append(Candidate(*softdevice))
+        for memory_map in db.memory_maps(sign, softdevice.nrf):
+            if memory_map not in memory_maps:
+                memory_maps.append(memory_map)
+    return Result(True, "markers", found[0][0], candidates, memory_maps, 0.5 / len(candidates), image_sign)
+
+def identify_offline(source, sidecar):
+    """
+    Identifies a firmware with the signature sidecar only, without nRF.db
+    Returns the candidate SoftDevices of its signature and the ratio of its blocks
+    belonging to known SoftDevices
+    """
+    image = load_image(source)
+    candidates = [Candidate(*softdevice) for softdevice in sidecar.lookup(compute_signature(image))]
+    return candidates, sidecar.known_blocks(image)
+
+def identify_cached(source, db, cache, sidecar=None):
+    """
+    Identifies a firmware through the result cache
+    The firmware is only decoded and identified when its content is not cached
+    """
+    content, is_hex = read_source(source)
+    key = content_key(content)
+    cached = cache.get(key)
+    if cached is not None:
+        return result_from_json(cached)
+    result = identify_image(decode_image(content, is_hex), db, sidecar)
+    cache.put(key, result_to_json(result))
+    return result
+
+def identify(source, db=None, cache=None, sidecar=None):
+    """
+    Identifies a firmware given as a buffer, a .bin or a .hex path
+    db is an NRFDatabase or a nRF.db path, the default nRF.db is used if None
+    cache is an optional IdentCache of the same nRF.db build
+    sidecar is an optional Sidecar of the same nRF.db build, rejecting unknown signatures without sqlite;
+    a sidecar of another build raises ValueError
+    Returns a Result with the candidate SoftDevices, their memory maps and a confidence
+    """
+    if db is None:
+        db = default_db()
+    elif not isinstance(db, NRFDatabase):
+        with NRFDatabase(db) as own_db:
+            return identify(source, own_db, cache, sidecar)
+    if sidecar is not None:
+        sidecar.check(db.build_id)
+    if cache is not None:
+        return identify_cached(source, db, cache, sidecar)
+    return identify_image(load_image(source), db, sidecar)
 
 class NRF5xIdentify(object):
     """
@@ -22,31 +278,46 @@ class NRF5xIdentify(object):
     Given a firmware, computes its signature and looks for it in the database
     returns the SDK version used, the possible SoftDevice versions and associated RAM and ROM binary addresses
     """
-    def __init__(self, binfile, cur, objtype):
-        self.cur = cur
+    def __init__(self, firmware, db, objtype, cache=None):
+        self.db = db
+        self.cache = cache
+        self.cache_key = None
         self.sdk_version = None
         self.sdv_version = None
         self.sign = None
-        self.bin = binfile
+        self.firmware = firmware
+        self.objtype = objtype
+        self.bin = firmware
+        self.image = None
         self.nrf = None
         self.sdvs = []
         self.identified = 0
+        self.multiple = None
+        self.result = None
 
     def signature(self):
         """
         Computes the softdevice signature
         The signature is the sha256 hash of specific bytes of the ihex file
         """
+        if self.cache is not None:
+            with open(self.firmware, "rb") as firmware:
+                self.cache_key = content_key(firmware.read())
+            cached = self.cache.get(self.cache_key)
+            if cached is not None:
+                self.result = result_from_json(cached)
+                self.sign = self.result.image_sign
+                print("\nResult found in cache for this firmware and nRF.db build")
+                print("Signature: ", self.sign)
+                return
+        if self.objtype == "hex":
+            with nrftrace.span("hex_decode"):
+                self.bin = hex_2_binary(self.firmware)
         print("\nComputing signature from binary")
         for i in tqdm(range(1)):
             time.sleep(0.05)
-        with open(self.bin, 'rb+') as sdv_hex:
-            # skip bytes from 0x07C0 to 0x1000 
-            sdv_hex.seek(0)
-            first = sdv_hex.read(1983)
-            sdv_hex.seek(4096)
-            extract = sdv_hex.read(10000)
-            self.sign = hashlib.sha256(extract).hexdigest()
+        self.image = load_image(self.bin)
+        self.sign = compute_signature(self.image)
         print("Signature: ", self.sign)
 
     def identify(self):
@@ -56,35 +327,46 @@ class NRF5xIdentify(object):
         print("Searching for signature in nRF.db")
         for i in tqdm(range(1)):
             time.sleep(0.05)
-        req = "select sdk_version, nrf, softdevice_v from SoftDevice where sign LIKE ?"
-        self.cur.execute(req, (self.sign, ))
-        res = self.cur.fetchall()
+        if self.result is None:
+            self.result = identify_image(self.image, self.db)
+            if self.cache is not None:
+                self.cache.put(self.cache_key, result_to_json(self.result))
+        res = self.result.candidates
         # CASE 1 : signature of the binary file is not in database
-        if res == []:
+        if self.result.method != "signature":
             print("Signature not found in nRF5x database")
             print("\nComputing approximate signature from strings in binary")
-            #content = "Nordic Semiconductor"
-            cmd = "strings " + self.bin + " | grep Nordic\ Semiconductor/ | cut -d '/' -f 3,5"
-            cmd += "| sed -e s/'\/'/'_'/g | cut -d ' ' -f 2 | sed -e s/'SDK_'/''/g | "
-            cmd += "sed -e s/'.0_'/'_'/g | sort -u"
-            nrf_sign = subprocess.getoutput(cmd)
-            print(nrf_sign)
             for i in tqdm(range(1)):
                 time.sleep(0.05)
-            if "_" in nrf_sign:
+            if self.result.method == "markers":
+                self.sign = self.result.sign
+                print("Identified SDK markers in binary")
+                for sdv in res:
+                    if len(res) > 1:
+                        self.multiple = 1
+                    self.sdk_version = sdv.sdk_version
+                    self.nrf = sdv.nrf
+                    self.sdv_version = sdv.softdevice_v
+                    print("Possible SDK version: {0}, SoftDevice version: {1}, NRF: {2}".format(
+                        self.sdk_version, self.sdv_version, self.nrf))
+                print("=========================")
+                with open("nRF_ver", "w") as nrf_version:
+                    nrf_version.write(self.sign)
+                print("nRF5x signature of the first candidate written to file nRF_ver in current directory")
+                print("nRF_ver path must be provided when running nrfreverse.py from IDA")
+                self.identified = 1
+            elif self.result.method == "strings":
+                self.sign = self.result.sign
+                nrf_sign = self.sign.strip("%")
                 self.sdk_version = nrf_sign.split("_")[0]
                 self.nrf = nrf_sign.split("_")[1]
-                self.sign = "%" + nrf_sign + "%"
                 print("Identified the following strings in binary", nrf_sign)
                 print("\nSDK version: ", self.sdk_version)
                 print("NRF type: ", self.nrf)
-                req = "select softdevice_v from SoftDevice where sign LIKE ? and nrf=? and sdk_version=?"
-                self.cur.execute(req, (self.sign, self.nrf, self.sdk_version))
-                res = self.cur.fetchall()
                 for sdv in res:
                     if len(res) > 1:
                         self.multiple = 1
-                    self.sdv_version = sdv[0]
+                    self.sdv_version = sdv.softdevice_v
                     print("Possible SoftDevice version: ", self.sdv_version)
                 print("=========================")
                 with open("nRF_ver", "w") as nrf_version:
@@ -100,9 +382,9 @@ class NRF5xIdentify(object):
             self.identified = 1
             self.multiple = 1
             for sdv in res:
-                self.sdk_version = sdv[0]
-                self.nrf = sdv[1]
-                self.sdv_version = sdv[2]
+                self.sdk_version = sdv.sdk_version
+                self.nrf = sdv.nrf
+                self.sdv_version = sdv.softdevice_v
                 print("=========================")
                 print("SDK version: ", self.sdk_version)
                 print("SoftDevice version:", self.sdv_version)
@@ -118,15 +400,10 @@ class NRF5xIdentify(object):
         Maps the binary at the right memory addresses
         """
         if self.identified == 1:
-            if self.multiple is None:
-                req = "select softdev_v, card_version, ram_origin, ram_length, rom_origin, rom_length from MemoryAddr where softdev_signature LIKE ? and nrf=? GROUP BY card_version, ram_origin, ram_length, rom_origin, rom_length"
-                self.cur.execute(req, (self.sign, self.nrf))
-                for res in self.cur.fetchall():
+            for res in self.result.memory_maps:
+                if self.multiple is None:
                     mem_props(res, "m")
-            else:
-                req = "select softdev_v, card_version, ram_origin, ram_length, rom_origin, rom_length, nrf from MemoryAddr where softdev_signature LIKE ? GROUP BY card_version, ram_origin, ram_length, rom_origin, rom_length"
-                self.cur.execute(req, (self.sign, ))
-                for res in self.cur.fetchall():
+                else:
                     mem_props(res, "")
                 
 def mem_props(res, ident_type):
@@ -143,10 +420,10 @@ def mem_props(res, ident_type):
         print("SoftDevice  : ", softdev)
         print("Card version : ", card_v)
         print(" "*10, "*****")
-        print("RAM address  : ", ram_addr)
-        print("RAM length   : ", ram_length)
-        print("ROM address  : ", rom_addr)
-        print("ROM length   : ", rom_length)
+        print("RAM address  : ", hex(ram_addr))
+        print("RAM length   : ", hex(ram_length))
+        print("ROM address  : ", hex(rom_addr))
+        print("ROM length   : ", hex(rom_length))
     else:
         nrf = res[6]
 
@@ -172,6 +449,24 @@ def hex_2_binary(hexfile):
     print("Dumping binary from hex file to directory: ", bin_file)
     return bin_file
 
+def identify_dfu(package, db):
+    """
+    Identifies the components of a DFU package
+    The signature of the SoftDevice (or else of the first identified component) is written to nRF_ver
+    """
+    from nrfdfu import identify_package, print_package
+    print("DFU package provided {0}".format(package))
+    with nrftrace.span("identify_package"):
+        components = identify_package(package, db)
+    print_package(package, components)
+    identified = [component for component in components if component.result.identified]
+    identified.sort(key=lambda component: component.name != "softdevice")
+    if identified != []:
+        with open("nRF_ver", "w") as nrf_version:
+            nrf_version.write(identified[0].result.sign)
+        print("                               ==================")
+        print("nRF5x signature of the {0} written to file nRF_ver in current directory".format(identified[0].name))
+
 def helper():
     """
     Arguments parser
@@ -189,6 +484,7 @@ def is_valid_file(parser, arg):
     """
     if not os.path.exists(arg):
         parser.error("The file %s does not exist!" % arg)
+    return arg
 
 def main():
     """
@@ -196,28 +492,64 @@ def main():
     """
     helper()
     parser = argparse.ArgumentParser("nrfident.py")
-    parser.add_argument("format", choices=['bin', 'hex'], help="the object format bfdname")
+    parser.add_argument("format", choices=['bin', 'hex', 'zip'], help="the object format bfdname, zip for DFU packages")
     parser.add_argument("firmware", help="input file to identify", metavar="FILE",
                         type=lambda x: is_valid_file(parser, x))
+    parser.add_argument("--db", help="path of nRF.db (default: $NRF_DB or nRF.db next to the tools)",
+                        metavar="DB", default=None)
+    parser.add_argument("--trace", help="write a Chrome trace-event JSON of the identification stages to FILE",
+                        metavar="FILE", default=None)
+    parser.add_argument("--cache", help="path of the result cache (default: ~/.cache/nrf5x/ident.db)",
+                        metavar="CACHE", default=None)
+    parser.add_argument("--no-cache", help="do not use the result cache", action="store_true")
+    parser.add_argument("--sidecar", help="answer from the signature sidecar (nRF.sig) only, without nRF.db",
+                        metavar="SIDECAR", default=None)
     args = parser.parse_args()
-    con = sqlite3.connect("./nRF.db")
-    cur = con.cursor()
-    binfile = ""
-    hexfile = ""
+    nrftrace.enable(args.trace)
+    if args.sidecar is not None and args.format != 'zip':
+        with Sidecar(args.sidecar) as sidecar, nrftrace.span("identify_offline"):
+            candidates, known = identify_offline(args.firmware, sidecar)
+        print("Sidecar of nRF.db build {0}".format(sidecar.build_id))
+        if os.path.isfile(db_path(args.db)):
+            with NRFDatabase(args.db) as db:
+                try:
+                    sidecar.check(db.build_id)
+                except ValueError as err:
+                    print("Warning: stale sidecar, {0}".format(err))
+        print("Known SoftDevice blocks: {0:.0%}".format(known))
+        for candidate in candidates:
+            print("SDK version: {0}, SoftDevice version: {1}, NRF: {2}".format(candidate.sdk_version,
+                                                                              candidate.softdevice_v, candidate.nrf))
+        if candidates == []:
+            print("Signature not found in the sidecar")
+        nrftrace.finish()
+        return
+    db = NRFDatabase(args.db)
+    cache = None
+    if not args.no_cache:
+        cache = IdentCache(db.build_id, args.cache)
+    if args.format == 'zip':
+        identify_dfu(args.firmware, db)
+        db.close()
+        if cache is not None:
+            cache.close()
+        nrftrace.finish()
+        return
     if args.format == 'hex':
-        hexfile = sys.argv[2]
-        objtype = 'hex'
-        print("Hex file provided {0}".format(hexfile))
-        binfile = hex_2_binary(hexfile)
+        print("Hex file provided {0}".format(args.firmware))
     elif args.format == 'bin':
-        binfile = sys.argv[2]
-        objtype = 'bin'
-        print("Binary file provided {0}".format(binfile))
-    nrf = NRF5xIdentify(binfile, cur, objtype)
-    nrf.signature()
-    nrf.identify()
-    nrf.map_binary()
-    con.close()
+        print("Binary file provided {0}".format(args.firmware))
+    nrf = NRF5xIdentify(args.firmware, db, args.format, cache)
+    with nrftrace.span("signature"):
+        nrf.signature()
+    with nrftrace.span("identify"):
+        nrf.identify()
+    with nrftrace.span("map_binary"):
+        nrf.map_binary()
+    db.close()
+    if cache is not None:
+        cache.close()
+    nrftrace.finish()
 
 if __name__ == "__main__":
     main()
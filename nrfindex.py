@@ -0,0 +1,259 @@
+#!/usr/bin/env python3.5
+
+"""
+NRF5 corpus indexing tool
+Extracts the SVC call sites of many firmware images into an inverted index,
+to find which images call a SoftDevice function or SVC number
+"""
+import argparse
+import os
+import sqlite3
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from nrfcache import content_key
+from nrfident import read_source, decode_image, identify_image, default_db
+import nrftrace
+
+SVC_OPCODE = b"\xdf"
+FIRMWARE_EXT = (".bin", ".hex")
+PAGE_SIZE = 0x1000
+# SoftDevice information structure, 0x2000 after the start of the SoftDevice (behind the MBR)
+SD_INFO_MAGIC = 0x51b1e5db
+SD_INFO = struct.Struct("<II")
+SD_INFO_OFFSET = 0x3004
+
+def softdevice_end(image):
+    """
+    Returns the page rounded end of the SoftDevice of an image, read from its information
+    structure, None if the image holds none
+    """
+    if len(image) < SD_INFO_OFFSET + SD_INFO.size:
+        return None
+    magic, end = SD_INFO.unpack_from(image, SD_INFO_OFFSET)
+    if magic != SD_INFO_MAGIC or end <= SD_INFO_OFFSET:
+        return None
+    return (end + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+
+def app_start(result, image):
+    """
+    Returns the start of the application region of an image
+    It is the end of the SoftDevice given by its information structure in the image: the FLASH
+    origin of the right SoftDevice's maps is this end, but the candidates sharing a signature come
+    with the maps of other SoftDevices, starting inside or past it
+    Without information structure, it is the FLASH origin of the maps of the first candidate
+    SoftDevice having maps, in (SDK version, SoftDevice version, nRF) order
+    Returns 0 when no SoftDevice is identified nor found, None when the end of the identified
+    SoftDevice is unknown
+    """
+    end = softdevice_end(image)
+    if end is not None:
+        return end
+    for candidate in sorted(result.candidates):
+        origins = [memory_map.rom_origin for memory_map in result.memory_maps
+                   if memory_map.softdev_v == candidate.softdevice_v]
+        if origins != []:
+            return min(origins)
+    if result.identified:
+        return None
+    return 0
+
+def svc_sites(image, start=0):
+    """
+    Returns a dict of the SVC numbers called in the image and their number of call sites
+    Thumb "SVC #imm8" is the halfword 0xDFxx, stored as xx DF at an even address
+    """
+    counts = dict()
+    image = bytes(image)
+    pos = image.find(SVC_OPCODE, start + 1)
+    while pos != -1:
+        if pos % 2 == 1:
+            svc = image[pos - 1]
+            counts[svc] = counts.get(svc, 0) + 1
+        pos = image.find(SVC_OPCODE, pos + 1)
+    return counts
+
+def extract_image(path, db=None):
+    """
+    Identifies an image against the nRF.db path db (the default nRF.db if None) and extracts its SVC usage
+    Returns (path, content hash, signature, {term: count})
+    Terms are "svc:0xNN" for every SVC number and "fn:name" when the signature resolves it
+    """
+    content, is_hex = read_source(path)
+    key = content_key(content)
+    image = decode_image(content, is_hex)
+    db = default_db(db)
+    result = identify_image(image, db)
+    svc_table = db.svc_table(result.sign) if result.identified else dict()
+    start = app_start(result, image)
+    if start is None:
+        # the SoftDevice and the application cannot be told apart: no SVC is indexed
+        start = len(image)
+    terms = dict()
+    for svc, count in svc_sites(image, start).items():
+        terms["svc:" + hex(svc)] = count
+        if svc in svc_table:
+            term = "fn:" + svc_table[svc]
+            terms[term] = terms.get(term, 0) + count
+    return path, key, result.sign if result.identified else None, terms
+
+def try_extract_image(path, db=None):
+    """
+    Returns (extract_image(path, db), None), or (None, error message) when the image cannot be
+    read, decoded or identified: one corrupt image does not abort a corpus run
+    """
+    try:
+        return extract_image(path, db), None
+    except Exception as err:
+        return None, "{0}: {1}".format(type(err).__name__, err)
+
+def list_firmwares(paths):
+    """
+    Returns the .bin and .hex files of the given files and directories
+    """
+    firmwares = []
+    for path in paths:
+        if os.path.isdir(path):
+            for curdir, subdir, files in os.walk(path):
+                for fname in sorted(files):
+                    if fname.lower().endswith(FIRMWARE_EXT):
+                        firmwares.append(os.path.join(curdir, fname))
+        else:
+            firmwares.append(path)
+    return firmwares
+
+def query_term(term):
+    """
+    Returns the index term of a query: an SVC number (0x60, 96) or a function name
+    """
+    try:
+        return "svc:" + hex(int(term, 0))
+    except ValueError:
+        return "fn:" + term
+
+class SVCIndex(object):
+    """
+    Inverted index of SVC usage over a firmware corpus
+    Postings are (term, image, count) rows clustered by term, so a query reads
+    only the postings of its terms
+    """
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(self.path)
+        self.con.execute("create table if not exists Images (id integer primary key, path text unique, "
+                         "hash text, sign text)")
+        self.con.execute("create index if not exists Images_hash on Images (hash)")
+        self.con.execute("create table if not exists Postings (term text, image_id integer, count integer, "
+                         "primary key (term, image_id)) without rowid")
+
+    def close(self):
+        """
+        Closes the index
+        """
+        self.con.close()
+
+    def indexed(self, path):
+        """
+        Returns the content hash an image path was indexed with, None if it is not indexed
+        """
+        res = self.con.execute("select hash from Images where path=?", (path, )).fetchone()
+        return res[0] if res is not None else None
+
+    def add(self, path, key, sign, terms):
+        """
+        Adds (or replaces) the postings of an image
+        """
+        with self.con:
+            res = self.con.execute("select id from Images where path=?", (path, )).fetchone()
+            if res is not None:
+                self.con.execute("delete from Postings where image_id=?", (res[0], ))
+                self.con.execute("delete from Images where id=?", (res[0], ))
+            cur = self.con.execute("insert into Images (path, hash, sign) values (?, ?, ?)", (path, key, sign))
+            image_id = cur.lastrowid
+            self.con.executemany("insert into Postings values (?, ?, ?)",
+                                 [(term, image_id, count) for term, count in terms.items()])
+
+    def add_firmwares(self, paths, jobs=None, db=None):
+        """
+        Indexes new or modified firmwares, extraction runs in parallel worker processes
+        db is the path of the nRF.db identifying them, the default nRF.db if None
+        Firmwares that cannot be read or decoded are reported and skipped
+        Returns the number of firmwares indexed
+        """
+        todo = []
+        for path in list_firmwares(paths):
+            path = os.path.abspath(path)
+            known = self.indexed(path)
+            if known is not None:
+                try:
+                    with open(path, "rb") as firmware:
+                        if content_key(firmware.read()) == known:
+                            continue
+                except IOError as err:
+                    print("{0}: not indexed, {1}".format(path, err))
+                    continue
+            todo.append(path)
+        print("{0} firmwares to index".format(len(todo)))
+        indexed = 0
+        with ProcessPoolExecutor(jobs) as executor:
+            for path, (extracted, error) in zip(todo, executor.map(partial(try_extract_image, db=db), todo,
+                                                                   chunksize=16)):
+                if error is not None:
+                    print("{0}: not indexed, {1}".format(path, error))
+                    continue
+                self.add(*extracted)
+                indexed += 1
+        return indexed
+
+    def query(self, terms, match_all=False):
+        """
+        Returns the (path, {term: count}) of the images calling any (or all) of the terms
+        """
+        terms = [query_term(term) for term in terms]
+        placeholders = ",".join("?" * len(terms))
+        req = "select i.path, p.term, p.count from Postings p join Images i on i.id=p.image_id where p.term in (" + placeholders + ") order by i.path"
+        images = dict()
+        for path, term, count in self.con.execute(req, terms):
+            images.setdefault(path, dict())[term] = count
+        if match_all:
+            images = dict((path, hits) for path, hits in images.items() if len(hits) == len(set(terms)))
+        return sorted(images.items())
+
+def main():
+    """
+    main
+    """
+    parser = argparse.ArgumentParser("nrfindex.py")
+    parser.add_argument("--trace", help="write a Chrome trace-event JSON of the indexing stages to FILE",
+                        metavar="FILE", default=None)
+    subparsers = parser.add_subparsers(dest="command")
+    add_parser = subparsers.add_parser("add", help="index firmwares (.bin/.hex files or directories)")
+    add_parser.add_argument("index", help="index file", metavar="INDEX")
+    add_parser.add_argument("firmwares", help="firmware files or directories", metavar="FILE", nargs="+")
+    add_parser.add_argument("--jobs", help="number of worker processes", type=int, default=None)
+    add_parser.add_argument("--db", help="path of nRF.db", default=None)
+    query_parser = subparsers.add_parser("query", help="find the firmwares calling functions or SVC numbers")
+    query_parser.add_argument("index", help="index file", metavar="INDEX")
+    query_parser.add_argument("terms", help="function name (sd_flash_write) or SVC number (0x29)",
+                              metavar="TERM", nargs="+")
+    query_parser.add_argument("--all", help="only firmwares calling all the terms", action="store_true")
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error("a command is required")
+    nrftrace.enable(args.trace)
+    index = SVCIndex(args.index)
+    if args.command == "add":
+        with nrftrace.span("index_add"):
+            count = index.add_firmwares(args.firmwares, args.jobs, args.db)
+        print("{0} firmwares indexed".format(count))
+    else:
+        with nrftrace.span("index_query"):
+            images = index.query(args.terms, args.all)
+        for path, hits in images:
+            print(path, " ".join("{0}={1}".format(term, count) for term, count in sorted(hits.items())))
+        print("{0} firmwares".format(len(images)))
+    index.close()
+    nrftrace.finish()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,601 @@
+#!/usr/bin/env python3.5
+
+"""
+Struct and union layouts of the SoftDevice headers
+The typedef structures and unions of the headers of a SoftDevice are parsed and laid out
+for its target core: every member gets its type, offset and size, bit-fields their
+position in their container. nrfparse stores the layouts in nRF.db, nrfreverse builds
+the IDA types from them without reparsing member declarations.
+"""
+import argparse
+import ast
+import glob
+import operator
+import os
+import re
+from nrfdb import NRFDatabase, Layout, LayoutMember
+
+# AAPCS fundamental types (size, alignment), identical for the Cortex-M0 (nRF51) and Cortex-M4 (nRF52)
+AAPCS_TYPES = {
+    "char": (1, 1), "signed char": (1, 1), "unsigned char": (1, 1), "int8_t": (1, 1), "uint8_t": (1, 1),
+    "bool": (1, 1), "_Bool": (1, 1),
+    "short": (2, 2), "short int": (2, 2), "unsigned short": (2, 2), "unsigned short int": (2, 2),
+    "int16_t": (2, 2), "uint16_t": (2, 2),
+    "int": (4, 4), "signed": (4, 4), "signed int": (4, 4), "unsigned": (4, 4), "unsigned int": (4, 4),
+    "long": (4, 4), "long int": (4, 4), "unsigned long": (4, 4), "unsigned long int": (4, 4),
+    "int32_t": (4, 4), "uint32_t": (4, 4), "size_t": (4, 4), "float": (4, 4),
+    "long long": (8, 8), "unsigned long long": (8, 8), "int64_t": (8, 8), "uint64_t": (8, 8), "double": (8, 8),
+}
+POINTER = (4, 4)
+ABIS = {"cortex-m0": AAPCS_TYPES, "cortex-m4": AAPCS_TYPES}
+NRF51_SOFTDEVICES = ("s110", "s120", "s130", "s210", "s310")
+
+QUALIFIERS = ("const", "volatile", "static", "extern", "inline", "__INLINE", "__STATIC_INLINE")
+BASE_WORDS = ("unsigned", "signed", "char", "short", "int", "long", "float", "double", "void", "_Bool")
+TOKEN_RE = re.compile(r'"(?:\\.|[^"\\])*"|[A-Za-z_]\w*|0[xX][0-9a-fA-F]+[uUlL]*|\d+[uUlL]*|\S')
+IDENT_RE = re.compile(r"\b[A-Za-z_]\w*")
+DEFINE_RE = re.compile(r"^\s*#\s*define\s+([A-Za-z_]\w*)(?!\()\s+(.+?)\s*$")
+COMMENT_RE = re.compile(r"/\*.*?\*/|//[^\n]*", re.S)
+CAST_RE = re.compile(r"\(\s*(?:unsigned |signed )?(?:u?int(?:8|16|32|64)_t|int|char|short|long)\s*\)")
+INT_SUFFIX_RE = re.compile(r"\b(0[xX][0-9a-fA-F]+|\d+)[uUlL]+\b")
+MAX_SHIFT = 64
+
+class LayoutError(Exception):
+    """
+    Raised for a type that can't be laid out (unknown type, unevaluable array length)
+    """
+    pass
+
+def target_abi(softdevice_v):
+    """
+    Returns the target ABI of a SoftDevice: nRF51 SoftDevices run on a Cortex-M0, the others on a Cortex-M4
+    """
+    if softdevice_v in NRF51_SOFTDEVICES:
+        return "cortex-m0"
+    return "cortex-m4"
+
+def round_up(value, align):
+    """
+    Returns value rounded up to a multiple of align
+    """
+    return (value + align - 1) // align * align
+
+def c_div(left, right):
+    """
+    Returns the C quotient of two integers, truncated toward zero
+    """
+    quotient = abs(left) // abs(right)
+    return -quotient if (left < 0) != (right < 0) else quotient
+
+def c_mod(left, right):
+    """
+    Returns the C remainder of two integers, of the sign of the dividend
+    """
+    return left - right * c_div(left, right)
+
+def shift(operation):
+    """
+    Returns a shift operation refusing the counts a header can't mean
+    """
+    def shift_by(value, count):
+        if not 0 <= count < MAX_SHIFT:
+            raise ValueError("shift count {0}".format(count))
+        return operation(value, count)
+    return shift_by
+
+BINARY_OPS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: c_div, ast.Mod: c_mod,
+    ast.LShift: shift(operator.lshift), ast.RShift: shift(operator.rshift),
+    ast.BitOr: operator.or_, ast.BitAnd: operator.and_, ast.BitXor: operator.xor,
+}
+UNARY_OPS = {ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Invert: operator.invert}
+
+def evaluate_node(node):
+    """
+    Returns the value of an integer arithmetic expression tree
+    Only integer literals and the C integer operators are evaluated, anything else raises ValueError
+    """
+    if isinstance(node, ast.Expression):
+        return evaluate_node(node.body)
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPS:
+        return BINARY_OPS[type(node.op)](evaluate_node(node.left), evaluate_node(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPS:
+        return UNARY_OPS[type(node.op)](evaluate_node(node.operand))
+    # integer literals are ast.Num nodes before Python 3.8
+    if type(node).__name__ in ("Constant", "Num"):
+        value = getattr(node, "value", getattr(node, "n", None))
+        if type(value) is int:
+            return value
+    raise ValueError("{0} not allowed".format(type(node).__name__))
+
+def evaluate(expr, defines):
+    """
+    Returns the value of a constant integer expression of a header, macros expanded
+    """
+    text = expr
+    for i in range(16):
+        expanded = IDENT_RE.sub(lambda match: "(" + defines[match.group()] + ")"
+                                if match.group() in defines else match.group(), text)
+        if expanded == text:
+            break
+        text = expanded
+    text = INT_SUFFIX_RE.sub(r"\1", CAST_RE.sub("", text))
+    try:
+        return evaluate_node(ast.parse(text.strip(), mode="eval"))
+    except (SyntaxError, ValueError, RecursionError, ZeroDivisionError):
+        raise LayoutError("can't evaluate {0!r}".format(expr))
+
+def read_header(path):
+    """
+    Returns the object-like macros and the C tokens of a header file
+    """
+    with open(path, "r", errors="replace") as header:
+        text = COMMENT_RE.sub(" ", header.read()).replace("\\\n", " ")
+    defines = dict()
+    code = []
+    for line in text.splitlines():
+        if line.lstrip().startswith("#"):
+            define = DEFINE_RE.match(line)
+            if define is not None:
+                defines[define.group(1)] = define.group(2)
+            continue
+        code.append(line)
+    return defines, TOKEN_RE.findall("\n".join(code))
+
+def is_identifier(token):
+    """
+    Returns whether a token is a C identifier
+    """
+    return token is not None and IDENT_RE.match(token) is not None and token[0] != '"'
+
+class TypeParser(object):
+    """
+    Parser of the type declarations of a header
+    Types are kept as tuples: ("name", "uint8_t"), ("ptr", type), ("array", type, length expression),
+    ("record", "struct" or "union", [(member, type, bit width expression)]), ("enum", [(name, expression)])
+    """
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.typedefs = dict()
+        self.tags = dict()
+
+    def peek(self, ahead=0):
+        """
+        Returns a token after the current position, None at the end
+        """
+        if self.pos + ahead < len(self.tokens):
+            return self.tokens[self.pos + ahead]
+        return None
+
+    def next(self):
+        """
+        Returns the current token and advances
+        """
+        token = self.peek()
+        if token is None:
+            raise LayoutError("unexpected end of header")
+        self.pos += 1
+        return token
+
+    def expect(self, token):
+        """
+        Consumes an expected token
+        """
+        if self.next() != token:
+            raise LayoutError("expected {0!r} before {1!r}".format(token, self.peek()))
+
+    def parse(self):
+        """
+        Collects the typedefs and tagged structures and unions of the header
+        Everything else (enumerations of constants, inline functions, SVCALLs) is skipped
+        """
+        while self.peek() is not None:
+            start = self.pos
+            try:
+                if self.peek() == "typedef":
+                    self.next()
+                    base = self.type_spec()
+                    while True:
+                        name, ctype, width = self.declarator(base)
+                        self.typedefs[name] = ctype
+                        if self.peek() != ",":
+                            break
+                        self.next()
+                    self.expect(";")
+                elif self.peek() in ("struct", "union") and is_identifier(self.peek(1)) and self.peek(2) == "{":
+                    record = self.type_spec()
+                    self.tags[record[1] + " " + record[3]] = record
+                else:
+                    self.pos += 1
+            except LayoutError:
+                self.pos = start + 1
+        return self.typedefs, self.tags
+
+    def type_spec(self):
+        """
+        Parses a type specifier: base type words, typedef name, struct, union or enum
+        """
+        words = []
+        while True:
+            token = self.peek()
+            if token in QUALIFIERS:
+                self.next()
+            elif token in ("struct", "union") and words == []:
+                kind = self.next()
+                tag = None
+                if is_identifier(self.peek()):
+                    tag = self.next()
+                if self.peek() == "{":
+                    return ("record", kind, self.members(), tag)
+                if tag is None:
+                    raise LayoutError("anonymous {0} without body".format(kind))
+                return ("name", kind + " " + tag)
+            elif token == "enum" and words == []:
+                self.next()
+                tag = None
+                if is_identifier(self.peek()):
+                    tag = self.next()
+                if self.peek() == "{":
+                    return ("enum", self.enumerators())
+                return ("name", "enum " + str(tag))
+            elif is_identifier(token) and (words == [] or (token in BASE_WORDS and words[-1] in BASE_WORDS)):
+                words.append(self.next())
+            else:
+                break
+        if words == []:
+            raise LayoutError("type expected before {0!r}".format(self.peek()))
+        return ("name", " ".join(words))
+
+    def members(self):
+        """
+        Parses the member declarations of a structure or union body
+        """
+        self.expect("{")
+        fields = []
+        while self.peek() != "}":
+            base = self.type_spec()
+            if self.peek() == ";":
+                # anonymous structure or union member
+                fields.append((None, base, None))
+                self.next()
+                continue
+            while True:
+                fields.append(self.declarator(base))
+                if self.peek() != ",":
+                    break
+                self.next()
+            self.expect(";")
+        self.expect("}")
+        return fields
+
+    def enumerators(self):
+        """
+        Parses the body of an enumeration: (name, value expression or None)
+        """
+        self.expect("{")
+        values = []
+        while self.peek() != "}":
+            name = self.next()
+            expr = None
+            if self.peek() == "=":
+                self.next()
+                tokens = []
+                while self.peek() not in (",", "}"):
+                    tokens.append(self.next())
+                expr = " ".join(tokens)
+            values.append((name, expr))
+            if self.peek() == ",":
+                self.next()
+        self.expect("}")
+        return values
+
+    def declarator(self, base):
+        """
+        Parses a declarator of the base type: pointers, name, array lengths and bit-field width
+        Returns the (name, type, width expression or None)
+        """
+        pointers = 0
+        while self.peek() in ("*", ) + QUALIFIERS:
+            if self.next() == "*":
+                pointers += 1
+        if self.peek() == "(":
+            # function pointer: (*name)(parameters)
+            self.next()
+            while self.peek() in ("*", ) + QUALIFIERS:
+                self.next()
+            name = self.next()
+            self.expect(")")
+            self.skip_group()
+            return name, ("ptr", None), None
+        name = None
+        if self.peek() != ":":
+            # unnamed bit-fields only pad
+            name = self.next()
+            if not is_identifier(name):
+                raise LayoutError("declarator expected, found {0!r}".format(name))
+        lengths = []
+        while self.peek() == "[":
+            self.next()
+            tokens = []
+            while self.peek() != "]":
+                tokens.append(self.next())
+            self.next()
+            lengths.append(" ".join(tokens))
+        width = None
+        if self.peek() == ":":
+            self.next()
+            tokens = []
+            while self.peek() not in (",", ";"):
+                tokens.append(self.next())
+            width = " ".join(tokens)
+        ctype = base
+        for i in range(pointers):
+            ctype = ("ptr", ctype)
+        for length in reversed(lengths):
+            ctype = ("array", ctype, length)
+        return name, ctype, width
+
+    def skip_group(self):
+        """
+        Skips a parenthesised group
+        """
+        self.expect("(")
+        depth = 1
+        while depth:
+            token = self.next()
+            if token == "(":
+                depth += 1
+            elif token == ")":
+                depth -= 1
+
+class LayoutEngine(object):
+    """
+    Lays out the records of a set of headers for a target ABI
+    Members are naturally aligned; a bit-field is placed in a container of its declared type,
+    starting a new container when it would straddle one. Enumerations are short (-fshort-enums).
+    Anonymous nested records are laid out as <parent>__<member>.
+    """
+    def __init__(self, typedefs, tags, defines, abi):
+        self.typedefs = typedefs
+        self.tags = tags
+        self.defines = defines
+        self.abi = abi
+        self.types = ABIS[abi]
+        self.layouts = dict()
+        self.resolving = set()
+
+    def size_align(self, ctype, name=None):
+        """
+        Returns the (size, alignment) of a type, name being the layout name of an anonymous record
+        """
+        kind = ctype[0]
+        if kind == "ptr":
+            return POINTER
+        if kind == "array":
+            size, align = self.size_align(ctype[1], name)
+            length = self.evaluate(ctype[2]) if ctype[2] != "" else 0
+            return size * length, align
+        if kind == "enum":
+            return self.enum_size(ctype[1])
+        if kind == "record":
+            layout = self.lay_out(name, ctype)
+            return layout.size, layout.align
+        type_name = ctype[1]
+        if type_name in self.types:
+            return self.types[type_name]
+        if type_name in self.typedefs:
+            target = self.typedefs[type_name]
+            if target[0] == "record":
+                layout = self.lay_out(type_name, target)
+                return layout.size, layout.align
+            if type_name in self.resolving:
+                raise LayoutError("recursive type {0}".format(type_name))
+            self.resolving.add(type_name)
+            try:
+                return self.size_align(target, type_name)
+            finally:
+                self.resolving.discard(type_name)
+        if type_name in self.tags:
+            layout = self.lay_out(type_name.split(" ")[1], self.tags[type_name])
+            return layout.size, layout.align
+        raise LayoutError("unknown type {0}".format(type_name))
+
+    def evaluate(self, expr):
+        """
+        Returns the value of an array length or bit-field width
+        """
+        return evaluate(expr, self.defines)
+
+    def enum_size(self, values):
+        """
+        Returns the (size, alignment) of a short enumeration, int sized when a value can't be evaluated
+        """
+        known = dict(self.defines)
+        numbers = []
+        value = -1
+        try:
+            for name, expr in values:
+                value = evaluate(expr, known) if expr is not None else value + 1
+                known[name] = str(value)
+                numbers.append(value)
+        except LayoutError:
+            return 4, 4
+        low, high = min(numbers + [0]), max(numbers + [0])
+        for size in (1, 2):
+            if (low >= 0 and high < 1 << (8 * size)) or (-(1 << (8 * size - 1)) <= low and high < 1 << (8 * size - 1)):
+                return size, size
+        return 4, 4
+
+    def type_name(self, ctype, name):
+        """
+        Returns the element type name of a member type and its array length (None if not an array)
+        """
+        count = None
+        while ctype[0] == "array":
+            length = self.evaluate(ctype[2]) if ctype[2] != "" else 0
+            count = length if count is None else count * length
+            ctype = ctype[1]
+        pointers = ""
+        while ctype is not None and ctype[0] == "ptr":
+            pointers += " *"
+            ctype = ctype[1]
+        if ctype is None:
+            return "void (*)()", count
+        if ctype[0] == "record":
+            return name + pointers, count
+        if ctype[0] == "enum":
+            return "enum" + pointers, count
+        if ctype[1] in self.tags:
+            # tagged records are laid out under their tag
+            return ctype[1].split(" ")[1] + pointers, count
+        return ctype[1] + pointers, count
+
+    def lay_out(self, name, record):
+        """
+        Returns the Layout of a structure or union, computed once per name
+        """
+        if name in self.layouts:
+            return self.layouts[name]
+        if name in self.resolving:
+            raise LayoutError("recursive record {0}".format(name))
+        self.resolving.add(name)
+        try:
+            kind, fields = record[1], record[2]
+            members = []
+            bits = 0
+            size = 0
+            align = 1
+            for i, (field, ctype, width) in enumerate(fields):
+                if field is None:
+                    field = "anon{0}".format(i)
+                nested = name + "__" + field
+                field_size, field_align = self.size_align(ctype, nested)
+                type_name, count = self.type_name(ctype, nested)
+                start = 0 if kind == "union" else bits
+                if width is not None:
+                    width = self.evaluate(width)
+                    if width == 0:
+                        bits = round_up(bits, 8 * field_align)
+                        continue
+                    if start % (8 * field_align) + width > 8 * field_size:
+                        start = round_up(start, 8 * field_align)
+                    offset = start // (8 * field_align) * field_align
+                    if fields[i][0] is not None:
+                        members.append(LayoutMember(field, type_name, offset, field_size, None,
+                                                    start - 8 * offset, width))
+                    end = start + width
+                    size = max(size, offset + field_size)
+                else:
+                    start = round_up(start, 8 * field_align)
+                    members.append(LayoutMember(field, type_name, start // 8, field_size, count, None, None))
+                    end = start + 8 * field_size
+                    size = max(size, start // 8 + field_size)
+                align = max(align, field_align)
+                if kind == "struct":
+                    bits = end
+            if kind == "struct":
+                size = (bits + 7) // 8
+            layout = Layout(name, kind, self.abi, round_up(size, align), align, members)
+            self.layouts[name] = layout
+            return layout
+        finally:
+            self.resolving.discard(name)
+
+def compute_layouts(headers, abi):
+    """
+    Returns the layouts of the typedef structures and unions of a set of headers, sorted by name,
+    and the names of the records that can't be laid out (unknown member types)
+    """
+    defines = dict()
+    typedefs = dict()
+    tags = dict()
+    for path in headers:
+        header_defines, tokens = read_header(path)
+        defines.update(header_defines)
+        header_typedefs, header_tags = TypeParser(tokens).parse()
+        typedefs.update(header_typedefs)
+        tags.update(header_tags)
+    engine = LayoutEngine(typedefs, tags, defines, abi)
+    skipped = []
+    for name, ctype in sorted(typedefs.items()):
+        if ctype[0] != "record":
+            continue
+        try:
+            engine.lay_out(name, ctype)
+        except LayoutError:
+            skipped.append(name)
+    layouts = []
+    for name, layout in sorted(engine.layouts.items()):
+        # records nested in a record that failed are dropped with it
+        if name.split("__")[0] not in skipped:
+            layouts.append(layout)
+    return layouts, skipped
+
+def layout_order(layouts):
+    """
+    Returns the layouts sorted so that every record comes after the records its members embed
+    """
+    by_name = dict((layout.name, layout) for layout in layouts)
+    ordered = []
+    done = set()
+    def visit(name):
+        if name in done or name not in by_name:
+            return
+        done.add(name)
+        for member in by_name[name].members:
+            if "*" not in member.type_name:
+                visit(member.type_name)
+        ordered.append(by_name[name])
+    for name in sorted(by_name):
+        visit(name)
+    return ordered
+
+def format_layout(layout):
+    """
+    Returns the text of a layout: one line per member with its offset, size and type
+    """
+    lines = ["{0} {1} {{ /* {2} bytes, align {3}, {4} */".format(layout.kind, layout.name, layout.size,
+                                                                   layout.align, layout.abi)]
+    for member in layout.members:
+        if member.bit_size is not None:
+            place = "{0:#06x}:{1}".format(member.offset, member.bit_offset)
+            decl = "{0} {1} : {2};".format(member.type_name, member.name, member.bit_size)
+        else:
+            place = "{0:#06x}".format(member.offset)
+            decl = "{0} {1}{2};".format(member.type_name, member.name,
+                                       "[{0}]".format(member.count) if member.count is not None else "")
+        lines.append("    {0:9} {1:>5}  {2}".format(place, member.size, decl))
+    lines.append("};")
+    return "\n".join(lines)
+
+def main():
+    """
+    main
+    """
+    parser = argparse.ArgumentParser("nrflayout.py")
+    parser.add_argument("names", help="structures or unions to print (default: all)", metavar="NAME", nargs="*")
+    parser.add_argument("--sign", help="signature of the SoftDevice in nRF.db (nRF_ver content)", default=None)
+    parser.add_argument("--headers", help="lay out the cln_*.h headers of DIR instead of reading nRF.db",
+                        metavar="DIR", default=None)
+    parser.add_argument("--abi", help="target ABI of --headers", choices=sorted(ABIS), default="cortex-m4")
+    parser.add_argument("--db", help="path of nRF.db", default=None)
+    args = parser.parse_args()
+    if args.headers is not None:
+        layouts, skipped = compute_layouts(sorted(glob.glob(os.path.join(args.headers, "cln_*.h"))), args.abi)
+        layouts = dict((layout.name, layout) for layout in layouts)
+        if skipped != []:
+            print("Not laid out (unknown member types): {0}".format(" ".join(skipped)))
+    elif args.sign is not None:
+        with NRFDatabase(args.db) as db:
+            layouts = db.layouts(args.sign)
+    else:
+        parser.error("--sign or --headers is required")
+    for name in args.names or sorted(layouts):
+        if name not in layouts:
+            print("{0}: no layout".format(name))
+            continue
+        print(format_layout(layouts[name]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3.5
+
+"""
+NRF5 address classification tool
+Answers "which region, for which SoftDevice layout, contains this address" for
+every memory map of nRF.db with a sorted-array interval index.
+"""
+import argparse
+from bisect import bisect_right
+from collections import namedtuple
+from nrfdb import NRFDatabase
+import nrftrace
+
+RAM_BASE = 0x20000000
+
+Region = namedtuple("Region", ["start", "end", "kind", "sign", "memory_map"])
+
+def layout_regions(sign, memory_map):
+    """
+    Returns the regions of a memory map: the MBR and SoftDevice below the application FLASH,
+    the application FLASH, the RAM reserved by the SoftDevice and the application RAM
+    """
+    regions = [Region(0, memory_map.rom_origin, "softdevice", sign, memory_map),
+               Region(memory_map.rom_origin, memory_map.rom_origin + memory_map.rom_length, "flash", sign,
+                      memory_map),
+               Region(RAM_BASE, memory_map.ram_origin, "softdevice_ram", sign, memory_map),
+               Region(memory_map.ram_origin, memory_map.ram_origin + memory_map.ram_length, "ram", sign,
+                      memory_map)]
+    return [region for region in regions if region.start < region.end]
+
+class RegionIndex(object):
+    """
+    Interval index over memory regions
+    The region bounds split the address space in elementary intervals, slots[i] holds the
+    regions covering [bounds[i], bounds[i + 1]). A lookup is one binary search over the bounds;
+    addresses below the first bound fall in slots[-1], which no region covers.
+    """
+    def __init__(self, regions):
+        self.regions = list(regions)
+        self.bounds = sorted(set(region.start for region in self.regions) |
+                             set(region.end for region in self.regions))
+        slots = [[] for bound in self.bounds]
+        positions = dict((bound, i) for i, bound in enumerate(self.bounds))
+        for region in self.regions:
+            for i in range(positions[region.start], positions[region.end]):
+                slots[i].append(region)
+        self.slots = [tuple(slot) for slot in slots]
+
+    @classmethod
+    def from_db(cls, db, signs=None):
+        """
+        Returns the index of the memory maps of nRF.db, optionally of some signatures only
+        """
+        regions = []
+        for sign, memory_map in db.all_memory_maps():
+            if signs is None or sign in signs:
+                regions += layout_regions(sign, memory_map)
+        return cls(regions)
+
+    def lookup(self, addr):
+        """
+        Returns the regions containing an address
+        """
+        return self.slots[bisect_right(self.bounds, addr) - 1]
+
+    def classify(self, addresses):
+        """
+        Returns the regions containing each address of an iterable
+        """
+        bounds = self.bounds
+        slots = self.slots
+        return [slots[bisect_right(bounds, addr) - 1] for addr in addresses]
+
+def main():
+    """
+    main
+    """
+    parser = argparse.ArgumentParser("nrfmap.py")
+    parser.add_argument("addresses", help="addresses to classify (0x1f000, 131072)", metavar="ADDR", nargs="+",
+                        type=lambda x: int(x, 0))
+    parser.add_argument("--sign", help="only the layouts of this signature (nRF_ver content)", default=None)
+    parser.add_argument("--db", help="path of nRF.db", default=None)
+    parser.add_argument("--trace", help="write a Chrome trace-event JSON of the lookups to FILE",
+                        metavar="FILE", default=None)
+    args = parser.parse_args()
+    nrftrace.enable(args.trace)
+    with NRFDatabase(args.db) as db:
+        with nrftrace.span("build_index"):
+            index = RegionIndex.from_db(db, [args.sign] if args.sign is not None else None)
+    with nrftrace.span("classify", count=len(args.addresses)):
+        classified = index.classify(args.addresses)
+    for addr, regions in zip(args.addresses, classified):
+        print("{0:#010x}: {1} regions".format(addr, len(regions)))
+        for region in regions:
+            memory_map = region.memory_map
+            print("    {0:14} {1:#010x}-{2:#010x} {3} {4} {5} ({6})".format(
+                region.kind, region.start, region.end, memory_map.softdev_v, memory_map.nrf,
+                memory_map.card_version, region.sign))
+    nrftrace.finish()
+
+if __name__ == "__main__":
+    main()
@@ -5,21 +5,34 @@ This script will parse the development kits of Nordic Semiconductor
 from the 'developer.nordicsemi.com/' directory
 """
 
+import argparse
 import fnmatch
 import os
 import urllib.request
 import zipfile
 import hashlib
+import json
+import re
+import sqlite3
+import tempfile
+import time
+import uuid
 from pathlib import Path
 
 from bs4 import BeautifulSoup
-from sqlalchemy import Column, Integer, String, create_engine, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Integer, String, create_engine, ForeignKey, UniqueConstraint, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from intelhex import IntelHex
+from nrfdb import db_path, SoftDeviceRow, Layout, LayoutMember
+from nrflayout import compute_layouts, target_abi
+from nrfsidecar import SidecarBuilder, sidecar_path
+import nrftrace
 
 NRFBase = declarative_base()
-engine = create_engine("sqlite:///nRF.db")
+PARSE_CACHE_VERSION = 2
+DEFAULT_PARSE_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nrfparse-cache.db")
+SDKS_ROOT = "./SDKs"
 
 class SoftDevice(NRFBase):
     """
@@ -31,15 +44,18 @@ class SoftDevice(NRFBase):
     sign = Column(String(64))
     softdevice_v = Column(String(32))
     nrf = Column(String(32))
-    svcalls = relationship("SVCALL")
+    prototypes = relationship("SoftDevicePrototype")
     svc_rbase = relationship("SVCBase")
     svc_rlast = relationship("SVCLast")
-    structs = relationship("Structures")
+    structs = relationship("SoftDeviceStruct")
+    layouts = relationship("SoftDeviceLayout")
     mem_addr = relationship("MemoryAddr")
 
-    def __init__(self, sdk_version, softdevice, nrf, header_dir, linker_dir, hex_dir, session):
+    def __init__(self, sdk_version, softdevice, nrf, header_dir, linker_dir, hex_dir, session, parse_cache=None,
+                 root=SDKS_ROOT):
         """
         SoftDevice Class attributes and methods
+        The SDK files are read from root/sdk_version/
         """
         self.sdk_version = sdk_version
         self.softdevice_v = softdevice
@@ -48,28 +64,29 @@ class SoftDevice(NRFBase):
         self.linker_dir = linker_dir
         self.hex_dir = hex_dir
         self.sign = None
+        self.image = None
         self.headers = []
         self.linkers = []
         self.svc_base = dict()
         self.svc_last = dict()
         self.svcs = dict()
-        #self.structs = dict()
-        self.enum = 0
         self.session = session
+        self.parse_cache = parse_cache
+        self.sdk_dir = root + "/" + sdk_version + "/"
     def set_linkers(self):
         """
         Sets the list of linkers'paths of the associated softdevice
         """
-        linkers_path = "./SDKs/" + self.sdk_version + "/" + self.linker_dir
-        for linker_file in os.listdir(linkers_path):
+        linkers_path = self.sdk_dir + self.linker_dir
+        for linker_file in sorted(os.listdir(linkers_path)):
             if fnmatch.fnmatch(linker_file, "*.ld"):
                 self.linkers.append(linkers_path+linker_file)
     def set_headers(self):
         """
         Sets the list of headers'paths to the associated softdevice
         """
-        headers_path = "./SDKs/" + self.sdk_version + "/" + self.header_dir
-        for header_file in os.listdir(headers_path):
+        headers_path = self.sdk_dir + self.header_dir
+        for header_file in sorted(os.listdir(headers_path)):
             if fnmatch.fnmatch(header_file, "*.h"):
                 #Add the other case
                 if "cln" in header_file:
@@ -78,18 +95,13 @@ class SoftDevice(NRFBase):
         """
         Returns softdevice's binary's signature
         The signature is the sha256 hash of specific bytes of the firmware
+        The firmware is converted from intelHex to binary in memory, the SDK tree is left untouched
         """
         if (self.hex_dir != None):
-            hex_path = "./SDKs/"+ self.sdk_version + "/" + self.hex_dir
-            # Converting ihex to binary format
-            print("Converting the firmware from intelHex format to binary")
-            ih = IntelHex(hex_path)
-            bin_file = hex_path.replace(".hex", ".bin")
-            ih.tobinfile(bin_file)
-            with open(bin_file, 'rb+') as sdv_hex:
-                sdv_hex.seek(4096)
-                extract = sdv_hex.read(10000)
-                self.sign = hashlib.sha256(extract).hexdigest()
+            hex_path = self.sdk_dir + self.hex_dir
+            self.image = IntelHex(hex_path).tobinstr()
+            extract = self.image[4096:14096]
+            self.sign = hashlib.sha256(extract).hexdigest()
         else:
             self.sign = self.sdk_version + "_" + self.nrf + "_" + self.softdevice_v
     def mem_parser(self):
@@ -97,6 +109,7 @@ class SoftDevice(NRFBase):
         Extracts memory mapping of RAM and Flash sections of the binary from linkers files
         """
         softdev_v = None
+        memory = dict()
         for mem_path in self.linkers:
             mem_file = 0
             nrf_props = mem_path.rsplit("/")[-1].rsplit("_")
@@ -104,7 +117,7 @@ class SoftDevice(NRFBase):
             if len(nrf_props) == 4:
                 card_version = nrf_props[3].replace(".ld", "")
                 if "/Source/templates/gcc/" in mem_path and self.softdevice_v in mem_path:
-                    self.nrf = mem_path.split("/")[3]
+                    self.nrf = mem_path[len(self.sdk_dir):].split("/")[0]
                     mem_file = 1
                     softdev_v = nrf_props[2]
                 elif "/components/softdevice/" in mem_path and "/toolchain/armgcc/armgcc_s" in mem_path and self.softdevice_v in mem_path and "xx" in mem_path:
@@ -118,25 +131,10 @@ class SoftDevice(NRFBase):
                     if nrf_props[2].startswith("s"):
                         softdev_v = nrf_props[2]
                 if mem_file == 1:
-                    with open(mem_path, 'r+') as memfile:
-                        for line in memfile:
-                            if ("FLASH" in line and "ORIGIN" in line and "LENGTH" in line):
-                                addr = line.split(":")[1].rsplit(',')
-                                for mem_addr in addr:
-                                    if "ORIGIN" in mem_addr:
-                                        rom_origin = mem_addr.split("=")[1].strip()
-                                    elif "LENGTH" in mem_addr:
-                                        rom_length = mem_addr.split("=")[1].strip().replace("\n", "")
-                            if ("RAM" in line and "ORIGIN" in line and "LENGTH" in line):
-                                addr = line.split(":")[1].rsplit(',')
-                                for mem_addr in addr:
-                                    if "ORIGIN" in mem_addr:
-                                        ram_origin = mem_addr.split("=")[1].strip()
-                                    elif "LENGTH" in mem_addr:
-                                        ram_length = mem_addr.split("=")[1].strip().replace("\n", "")
-                        print("adding ", card_version, self.nrf, self.sign, softdev_v)
-                        mem_addr = MemoryAddr(ram_origin, ram_length, rom_origin, rom_length, softdev_v, self.nrf, card_version, self.sign, self.sdk_version)
-                        self.session.add(mem_addr)
+                    memory.update(self.cached_parse("linker", mem_path, parse_linker))
+                    print("adding ", card_version, self.nrf, self.sign, softdev_v)
+                    mem_addr = MemoryAddr(memory["ram_origin"], memory["ram_length"], memory["rom_origin"], memory["rom_length"], softdev_v, self.nrf, card_version, self.sign, self.sdk_version)
+                    self.session.add(mem_addr)
     def define_nrf(self):
         """
         Finds which NRF is associated to the provided softdevice, and SDK version
@@ -145,7 +143,7 @@ class SoftDevice(NRFBase):
             nrf_props = mem_path.rsplit("/")[-1].rsplit("_")
             if len(nrf_props) == 4 and 'xx' in nrf_props[3]:
                 if "/Source/templates/gcc/" in mem_path and self.softdevice_v in mem_path:
-                    self.nrf = mem_path.split("/")[3]
+                    self.nrf = mem_path[len(self.sdk_dir):].split("/")[0]
                 elif "/components/softdevice/" in mem_path and "/toolchain/armgcc/armgcc_s" in mem_path and self.softdevice_v in mem_path and "xx" in mem_path:
                     self.nrf = nrf_props[2]
                 elif "/components/toolchain/gcc/gcc_nrf5" in mem_path and "xx" in mem_path and self.softdevice_v in mem_path:
@@ -163,6 +161,66 @@ class SoftDevice(NRFBase):
             self.structures(h_path)
         for h_path in self.headers:
             self.svcall_parse(h_path)
+        self.struct_layouts()
+
+    def add_prototype(self, prototype):
+        """
+        Links the SoftDevice to a prototype, stored once for all SoftDevices sharing it
+        """
+        if add_once(self.session, Prototype, prototype.proto_hash):
+            self.session.add(prototype)
+        if add_once(self.session, SoftDevicePrototype, self.sign, prototype.proto_hash):
+            self.session.add(SoftDevicePrototype(self.sign, prototype.proto_hash))
+
+    def add_struct(self, struct_name, args):
+        """
+        Links the SoftDevice to a structure, stored once for all SoftDevices sharing it
+        """
+        struct_hash = content_hash(struct_name, *args)
+        if add_once(self.session, StructDef, struct_hash):
+            self.session.add(StructDef(struct_name, args))
+        if add_once(self.session, SoftDeviceStruct, self.sign, struct_hash):
+            self.session.add(SoftDeviceStruct(self.sign, struct_hash))
+
+    def add_layout(self, layout):
+        """
+        Links the SoftDevice to a structure layout, stored once for all SoftDevices sharing it
+        """
+        hash_layout = layout_hash(layout)
+        if add_once(self.session, StructLayout, hash_layout):
+            self.session.add(StructLayout(layout))
+        if add_once(self.session, SoftDeviceLayout, self.sign, hash_layout):
+            self.session.add(SoftDeviceLayout(self.sign, hash_layout))
+
+    def struct_layouts(self):
+        """
+        Computes the layouts of the structures and unions of all the headers for the target ABI
+        Layouts depend on every header (member types, array lengths), the parse cache keys
+        them by the first header and the hashes of all of them
+        """
+        headers = [h_path for h_path in self.headers if os.path.exists(h_path)]
+        if headers == []:
+            return
+        abi = target_abi(self.softdevice_v)
+        parse = lambda path: compute_layouts(headers, abi)
+        if self.parse_cache is None:
+            layouts, skipped = parse(headers[0])
+        else:
+            context = {"abi": abi, "headers": [self.parse_cache.file_hash(h_path) for h_path in headers]}
+            layouts, skipped = self.parse_cache.get_or_parse("layouts", headers[0], parse, context)
+        for layout in layouts:
+            name, kind, abi, size, align, members = layout
+            self.add_layout(Layout(name, kind, abi, size, align, [LayoutMember(*member) for member in members]))
+        if skipped != []:
+            print("Structures without layout (unknown member types): {0}".format(" ".join(skipped)))
+
+    def cached_parse(self, kind, path, parse, context=None):
+        """
+        Returns the parse result of a header or linker file, through the parse cache if enabled
+        """
+        if self.parse_cache is None:
+            return parse(path)
+        return self.parse_cache.get_or_parse(kind, path, parse, context)
 
     def svc_ranges(self, headerfile):
         """
@@ -171,20 +229,15 @@ class SoftDevice(NRFBase):
         """
         try:
             if os.path.exists(headerfile):
-                with open(headerfile, 'r') as header:
-                    for line in header:
-                        if "SVC_BASE" in line and "#define" in line:
-                            svc_base = line.split("#define ")[1].replace("(", "").replace(")", "").rsplit()
-                            self.svc_base[svc_base[0]] = svc_base[1]
-                            svc_b = SVCBase(svc_base[0], svc_base[1], self.sign)
-                            self.session.add(svc_b)
-                        elif "SVC_LAST" in line and "#define" in line:
-                            svc_last = line.split("#define ")[1].rsplit()
-                            self.svc_last[svc_last[0]] = svc_last[1]
-                            svc_l = SVCLast(svc_last[0], svc_last[1], self.sign)
-                            self.session.add(svc_l)
-                        else:
-                            pass
+                for svc_range, name, num in self.cached_parse("svc_ranges", headerfile, parse_svc_ranges):
+                    if svc_range == "base":
+                        self.svc_base[name] = num
+                        svc_b = SVCBase(name, num, self.sign)
+                        self.session.add(svc_b)
+                    else:
+                        self.svc_last[name] = num
+                        svc_l = SVCLast(name, num, self.sign)
+                        self.session.add(svc_l)
             else:
                 print(headerfile, "doesn't exist")
         except IOError as err:
@@ -196,42 +249,8 @@ class SoftDevice(NRFBase):
         """
         try:
             if os.path.exists(headerfile):
-                with open(headerfile, 'r') as header:
-                    for line in header:
-                        if "typedef struct" in line:
-                            args_tmp = []
-                            newline = header.readline()
-                            if "{" in newline:
-                                newline = header.readline()
-                            arg = newline
-                            while "}" not in newline:
-                                #If structure contains another structure or union
-                                if ("union" in newline or "struct" in newline):
-                                    union_args = []
-                                    if "union" in newline:
-                                        arg = "union "
-                                    elif "struct" in newline:
-                                        arg = "struct "
-                                    union_line = header.readline()
-                                    while "}" not in union_line:
-                                        union_line = header.readline()
-                                        union_line = union_line.split(";")[0].strip()
-                                        union_args.append(union_line)
-                                    union_name = union_line.replace("}", "").replace(";", "")
-                                    union_args = union_args[:-1]
-                                    arg = "union " + union_name + "(" + ','.join(union_args) + ")"
-                                    args_tmp.append(arg)
-                                    newline = header.readline()
-                                else:
-                                    arg = newline.replace(";", "").strip()
-                                    args_tmp.append(arg)
-                                    newline = header.readline()
-                            struct_name = newline.replace("} ", "").replace("\n", "").replace(";", "")
-                            structure = Structures(self.sign, struct_name, None, None)
-                            self.session.add(structure)
-                            for arg in args_tmp:
-                                argument = StructArgs(self.sign, arg, struct_name)
-                                self.session.add(argument)
+                for struct_name, args_tmp in self.cached_parse("structures", headerfile, parse_structures):
+                    self.add_struct(struct_name, args_tmp)
         except IOError as err:
             print("I/O error: {0}".format(err))
 
@@ -242,31 +261,11 @@ class SoftDevice(NRFBase):
         """
         try:
             if os.path.exists(headerfile):
-                with open(headerfile, 'r') as header:
-                    header.readline()
-                    for line in header:
-                        if "SVCALL(" in line:
-                            svc = line.split(",")[0].split("(")[1].strip()
-                            if svc == "number":
-                                pass
-                            else:
-                                func_name = line.split(",")[2].split("(")[0].strip()
-                                return_type = line.split(",")[1]
-                                #SVCALL(svc, ret_type, prototype) defined on one line
-                                if "));" in line:
-                                    func_args = line.split("(")[2].replace("));", "").replace("\n", "")
-                                #SVCALL defined on multiple lines
-                                else:
-                                    newline = header.readline()
-                                    while "));" not in newline:
-                                        newline = header.readline()
-                                    func_args = newline.replace("));", "").replace("\n", "")
-                                if svc in self.svcs.keys():
-                                    svcall = SVCALL(svc, self.svcs[svc], func_name, return_type, func_args, self.sign)
-                                    self.session.add(svcall)
-                                else:
-                                    print("else condition", svc, self.svcs, headerfile)
-                                    pass
+                for svc, func_name, return_type, func_args in self.cached_parse("svcalls", headerfile, parse_svcalls):
+                    if svc in self.svcs.keys():
+                        self.add_prototype(Prototype(svc, self.svcs[svc], func_name, return_type, func_args))
+                    else:
+                        print("else condition", svc, self.svcs, headerfile)
         except IOError as err:
             print("I/O error: {0}".format(err))
 
@@ -277,72 +276,248 @@ class SoftDevice(NRFBase):
         """
         try:
             if os.path.exists(headerfile):
-                with open(headerfile, 'r') as header:
-                    previous = header.readline()
-                    for line in header:
-                        if "_SVCS" in line and "enum" in line:
-                            #parse SVCs from file
-                            header.readline()
-                            self.enum = 1
-                            i = 0
-                            while 1:
-                                enumline = header.readline()
-                                if (not("};" in enumline) and self.enum == 1):
-                                    svc_func = enumline.split(",")[0].strip()
-                                    # Get the SVC_BASE number
-                                    if "=" in svc_func:
-                                        svc_base = svc_func.split("=")[1].strip()
-                                        svc_func = svc_func.split("=")[0].strip()
-                                    if svc_base in self.svc_base.keys():
-                                        svc_numbase = self.svc_base[svc_base]
-                                        if "0x" in svc_numbase:
-                                            svc_num = hex(int(svc_numbase, 16)+i)
-                                            self.svcs[svc_func] = svc_num
-                                        i += 1
-                                    #special parsing for BLE_GAP_SVC_BASE + i  in header files
-                                    elif " + " in svc_base:
-                                        svc_sbase = svc_base.split(" + ")[0].strip()
-                                        j = int(svc_base.split(" + ")[1].strip())
-                                        if svc_sbase in self.svc_base.keys():
-                                            svc_numbase = self.svc_base[svc_sbase]
-                                            if "0x" in svc_numbase:
-                                                svc_num = hex(int(svc_numbase, 16)+j)
-                                                self.svcs[svc_func] = svc_num
-                                else:
-                                    self.enum = 0
-                                    break
-                        #special parsing for ant_interface.h, ANT Stack API SVC numbers enumeration
-                        elif "ant_interface.h" in headerfile and "enum" in line:
-                            self.enum = 1
-                            i = 0
-                            while 1:
-                                enumline = header.readline()
-                                if "};" not in enumline and self.enum == 1:
-                                    if "," in enumline:
-                                        svc_func = enumline.split(",")[0].strip()
-                                        if "=" in svc_func:
-                                            svc_base = svc_func.split("=")[1].strip()
-                                            svc_func = svc_func.split("=")[0].strip()
-                                        if svc_base in self.svc_base.keys():
-                                            svc_numbase = self.svc_base[svc_base]
-                                            if "0x" in svc_numbase:
-                                                svc_num = hex(int(svc_numbase, 16)+i)
-                                                self.svcs[svc_func] = svc_num
-                                            i += 1
-                                else:
-                                    self.enum = 0
-                                    break
-                        #redefinitions of the SVC numbers used by the NRF Radio Disable implementation
-                        elif "#define" in line and ("SD_RADIO_REQUEST" in line or "SD_RADIO_SESSION_OPEN" in line or "SD_RADIO_SESSION_CLOSE" in line):
-                            svc_radio = line.split("#define ")[1].replace("(", "").replace(")", "").rsplit()
-                            svc = svc_radio[0]
-                            svc_num = svc_radio[1]
-                            self.svcs[svc] = svc_num
-                        else:
-                            pass
+                # svc numbers depend on the SVC_BASE values parsed from all the headers
+                svcs = self.cached_parse("svc_func", headerfile,
+                                         lambda path: parse_svc_func(path, self.svc_base), self.svc_base)
+                self.svcs.update(svcs)
         except IOError as err:
             print("I/O error: {0}".format(err))
 
+def parse_address(assignment):
+    """
+    Returns the integer value of a linker "ORIGIN = 0x1b000" or "LENGTH = 0x25000" assignment
+    """
+    return int(assignment.split("=")[1].split()[0], 0)
+
+def parse_linker(mem_path):
+    """
+    Returns the FLASH and RAM origins and lengths found in a linker file
+    """
+    memory = dict()
+    with open(mem_path, 'r+') as memfile:
+        for line in memfile:
+            if ("FLASH" in line and "ORIGIN" in line and "LENGTH" in line):
+                addr = line.split(":")[1].rsplit(',')
+                for mem_addr in addr:
+                    if "ORIGIN" in mem_addr:
+                        memory["rom_origin"] = parse_address(mem_addr)
+                    elif "LENGTH" in mem_addr:
+                        memory["rom_length"] = parse_address(mem_addr)
+            if ("RAM" in line and "ORIGIN" in line and "LENGTH" in line):
+                addr = line.split(":")[1].rsplit(',')
+                for mem_addr in addr:
+                    if "ORIGIN" in mem_addr:
+                        memory["ram_origin"] = parse_address(mem_addr)
+                    elif "LENGTH" in mem_addr:
+                        memory["ram_length"] = parse_address(mem_addr)
+    return memory
+
+def parse_svc_ranges(headerfile):
+    """
+    Returns the ("base" or "last", name, number) SVC ranges defined in a header file
+    """
+    svc_ranges = []
+    with open(headerfile, 'r') as header:
+        for line in header:
+            if "SVC_BASE" in line and "#define" in line:
+                svc_base = line.split("#define ")[1].replace("(", "").replace(")", "").rsplit()
+                svc_ranges.append(("base", svc_base[0], svc_base[1]))
+            elif "SVC_LAST" in line and "#define" in line:
+                svc_last = line.split("#define ")[1].rsplit()
+                svc_ranges.append(("last", svc_last[0], svc_last[1]))
+    return svc_ranges
+
+def parse_structures(headerfile):
+    """
+    Returns the (name, members) of the typedef structures of a header file
+    """
+    structs = []
+    with open(headerfile, 'r') as header:
+        for line in header:
+            if "typedef struct" in line:
+                args_tmp = []
+                newline = header.readline()
+                if "{" in newline:
+                    newline = header.readline()
+                arg = newline
+                while "}" not in newline:
+                    #If structure contains another structure or union
+                    if ("union" in newline or "struct" in newline):
+                        union_args = []
+                        if "union" in newline:
+                            arg = "union "
+                        elif "struct" in newline:
+                            arg = "struct "
+                        union_line = header.readline()
+                        while "}" not in union_line:
+                            union_line = header.readline()
+                            union_line = union_line.split(";")[0].strip()
+                            union_args.append(union_line)
+                        union_name = union_line.replace("}", "").replace(";", "")
+                        union_args = union_args[:-1]
+                        arg = "union " + union_name + "(" + ','.join(union_args) + ")"
+                        args_tmp.append(arg)
+                        newline = header.readline()
+                    else:
+                        arg = newline.replace(";", "").strip()
+                        args_tmp.append(arg)
+                        newline = header.readline()
+                struct_name = newline.replace("} ", "").replace("\n", "").replace(";", "")
+                structs.append((struct_name, args_tmp))
+    return structs
+
+def parse_svcalls(headerfile):
+    """
+    Returns the (svc, function, return type, arguments) SVCALL declarations of a header file
+    """
+    svcalls = []
+    with open(headerfile, 'r') as header:
+        header.readline()
+        for line in header:
+            if "SVCALL(" in line:
+                svc = line.split(",")[0].split("(")[1].strip()
+                if svc == "number":
+                    pass
+                else:
+                    func_name = line.split(",")[2].split("(")[0].strip()
+                    return_type = line.split(",")[1]
+                    #SVCALL(svc, ret_type, prototype) defined on one line
+                    if "));" in line:
+                        func_args = line.split("(")[2].replace("));", "").replace("\n", "")
+                    #SVCALL defined on multiple lines
+                    else:
+                        newline = header.readline()
+                        while "));" not in newline:
+                            newline = header.readline()
+                        func_args = newline.replace("));", "").replace("\n", "")
+                    svcalls.append((svc, func_name, return_type, func_args))
+    return svcalls
+
+def parse_svc_func(headerfile, svc_bases):
+    """
+    Returns the svc numbers of the SVC enumerations of a header file
+    svc_bases holds the SVC_BASE values the enumerations start from
+    """
+    svcs = dict()
+    enum = 0
+    with open(headerfile, 'r') as header:
+        header.readline()
+        for line in header:
+            if "_SVCS" in line and "enum" in line:
+                #parse SVCs from file
+                header.readline()
+                enum = 1
+                i = 0
+                while 1:
+                    enumline = header.readline()
+                    if (not("};" in enumline) and enum == 1):
+                        svc_func = enumline.split(",")[0].strip()
+                        # Get the SVC_BASE number
+                        if "=" in svc_func:
+                            svc_base = svc_func.split("=")[1].strip()
+                            svc_func = svc_func.split("=")[0].strip()
+                        if svc_base in svc_bases.keys():
+                            svc_numbase = svc_bases[svc_base]
+                            if "0x" in svc_numbase:
+                                svc_num = hex(int(svc_numbase, 16)+i)
+                                svcs[svc_func] = svc_num
+                            i += 1
+                        #special parsing for BLE_GAP_SVC_BASE + i  in header files
+                        elif " + " in svc_base:
+                            svc_sbase = svc_base.split(" + ")[0].strip()
+                            j = int(svc_base.split(" + ")[1].strip())
+                            if svc_sbase in svc_bases.keys():
+                                svc_numbase = svc_bases[svc_sbase]
+                                if "0x" in svc_numbase:
+                                    svc_num = hex(int(svc_numbase, 16)+j)
+                                    svcs[svc_func] = svc_num
+                    else:
+                        enum = 0
+                        break
+            #special parsing for ant_interface.h, ANT Stack API SVC numbers enumeration
+            elif "ant_interface.h" in headerfile and "enum" in line:
+                enum = 1
+                i = 0
+                while 1:
+                    enumline = header.readline()
+                    if "};" not in enumline and enum == 1:
+                        if "," in enumline:
+                            svc_func = enumline.split(",")[0].strip()
+                            if "=" in svc_func:
+                                svc_base = svc_func.split("=")[1].strip()
+                                svc_func = svc_func.split("=")[0].strip()
+                            if svc_base in svc_bases.keys():
+                                svc_numbase = svc_bases[svc_base]
+                                if "0x" in svc_numbase:
+                                    svc_num = hex(int(svc_numbase, 16)+i)
+                                    svcs[svc_func] = svc_num
+                                i += 1
+                    else:
+                        enum = 0
+                        break
+            #redefinitions of the SVC numbers used by the NRF Radio Disable implementation
+            elif "#define" in line and ("SD_RADIO_REQUEST" in line or "SD_RADIO_SESSION_OPEN" in line or "SD_RADIO_SESSION_CLOSE" in line):
+                svc_radio = line.split("#define ")[1].replace("(", "").replace(")", "").rsplit()
+                svc = svc_radio[0]
+                svc_num = svc_radio[1]
+                svcs[svc] = svc_num
+            else:
+                pass
+    return svcs
+
+class ParseCache(object):
+    """
+    Content-addressed cache of header and linker parse results
+    Results are keyed by the parser kind and the sha256 of the parsed file, so a file
+    shared byte for byte by several SDK versions is parsed once, across runs.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(self.path)
+        self.con.execute("create table if not exists ParseResults (key text primary key, result text)")
+        self.results = dict()
+        self.hashes = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def file_hash(self, path):
+        """
+        Returns the sha256 of a file, computed once per run
+        """
+        if path not in self.hashes:
+            with open(path, 'rb') as parsed:
+                self.hashes[path] = hashlib.sha256(parsed.read()).hexdigest()
+        return self.hashes[path]
+
+    def get_or_parse(self, kind, path, parse, context=None):
+        """
+        Returns the cached result of parse(path), parsing and storing it on a miss
+        context holds the other inputs of the parser, if any
+        """
+        key = "{0}:{1}:{2}".format(PARSE_CACHE_VERSION, kind, self.file_hash(path))
+        if context is not None:
+            key += ":" + content_hash(json.dumps(context, sort_keys=True))
+        if key not in self.results:
+            res = self.con.execute("select result from ParseResults where key=?", (key, )).fetchone()
+            if res is not None:
+                self.results[key] = json.loads(res[0])
+                self.hits += 1
+            else:
+                self.results[key] = json.loads(json.dumps(parse(path)))
+                self.con.execute("insert into ParseResults values (?, ?)", (key, json.dumps(self.results[key])))
+                self.misses += 1
+        else:
+            self.hits += 1
+        return self.results[key]
+
+    def close(self):
+        """
+        Commits the new parse results and closes the cache
+        """
+        print("Parse cache: {0} hits, {1} files parsed".format(self.hits, self.misses))
+        self.con.commit()
+        self.con.close()
+
 class MemoryAddr(NRFBase):
     """MemoryAddr table"""
     __tablename__ = "MemoryAddr"
@@ -350,10 +525,10 @@ class MemoryAddr(NRFBase):
     softdev_v = Column(String(64))
     nrf = Column(String(12))
     card_version = Column(String(64))
-    ram_origin = Column(String(256))
-    ram_length = Column(String(256))
-    rom_origin = Column(String(256))
-    rom_length = Column(String(256))
+    ram_origin = Column(Integer)
+    ram_length = Column(Integer)
+    rom_origin = Column(Integer)
+    rom_length = Column(Integer)
     sdk_version = Column(String(256))
     softdev_signature = Column(String(64), ForeignKey('SoftDevice.sign'))
     #__table_args__ = (UniqueConstraint('softdev_v', 'nrf', 'card_version', name='_memory_map'),)
@@ -371,27 +546,64 @@ class MemoryAddr(NRFBase):
         self.softdev_signature = softdev_signature
         self.sdk_version = sdk_version
 
-class SVCALL(NRFBase):
-    """SVCALL table"""
-    __tablename__ = "SVCALL"
-    svc_id = Column("id", Integer, primary_key=True)
+def content_hash(*fields):
+    """
+    Returns the sha256 content address of the given text fields
+    """
+    return hashlib.sha256("\0".join(fields).encode("utf-8")).hexdigest()
+
+def layout_hash(layout):
+    """
+    Returns the content address of a structure layout
+    """
+    fields = [layout.name, layout.kind, layout.abi, str(layout.size), str(layout.align)]
+    fields += [str(list(member)) for member in layout.members]
+    return content_hash(*fields)
+
+def add_once(session, table, *key):
+    """
+    Returns True the first time a primary key of a shared or link table is added during the build
+    The keys already stored are read once per table, which spares a session lookup (and its
+    autoflush) per parsed row; SoftDevices sharing a signature across SDKs are linked once
+    """
+    stored = session.info.setdefault("stored", dict())
+    if table not in stored:
+        stored[table] = set(tuple(row) for row in session.query(*table.__table__.primary_key.columns))
+    if key in stored[table]:
+        return False
+    stored[table].add(key)
+    return True
+
+class Prototype(NRFBase):
+    """SVCALL prototypes table, content-addressed and shared by SoftDevices"""
+    __tablename__ = "Prototype"
+    proto_hash = Column("hash", String(64), primary_key=True)
     svc = Column(String(64))
     syscall = Column(String(12))
     function = Column(String(64))
     ret_type = Column(String(48))
     arguments = Column(String(256))
-    softdev_signature = Column(String(64), ForeignKey('SoftDevice.sign'))
-    #__table__args = (UniqueConstraint('svc','softdev_signature', name='_svc_unique_softdev'), )
-    def __init__(self, svc, syscall, function, ret_type, arguments, softdev_signature):
+    def __init__(self, svc, syscall, function, ret_type, arguments):
         """
-        SVCALL class
+        Prototype class
         """
+        self.proto_hash = content_hash(svc, syscall, function, ret_type, arguments)
         self.function = function
         self.svc = svc
         self.syscall = syscall
         self.ret_type = ret_type
         self.arguments = arguments
-        self.softdev_signature = softdev_signature
+
+class SoftDevicePrototype(NRFBase):
+    """Link table between SoftDevice signatures and their SVCALL prototypes"""
+    __tablename__ = "SoftDevicePrototype"
+    # the link is its own primary key, stored without rowid nor extra index
+    __table_args__ = {"sqlite_with_rowid": False}
+    softdev_signature = Column(String(64), ForeignKey('SoftDevice.sign'), primary_key=True)
+    proto_hash = Column(String(64), ForeignKey('Prototype.hash'), primary_key=True)
+    def __init__(self, soft_sign, proto_hash):
+        self.softdev_signature = soft_sign
+        self.proto_hash = proto_hash
 
 class SVCBase(NRFBase):
     """SVCBast class svc_base ranges for nRF5 version"""
@@ -407,43 +619,95 @@ class SVCBase(NRFBase):
         self.svc_base_num = svc_base_num
         self.softdev_signature = soft_sign
 
-class StructArgs(NRFBase):
-    """Structures' arguments table"""
-    __tablename__ = "StructArgs"
-    arg_id = Column("id", Integer, primary_key=True)
+class StructDef(NRFBase):
+    """Structures table, content-addressed by name and members and shared by SoftDevices"""
+    __tablename__ = "StructDef"
+    struct_hash = Column("hash", String(64), primary_key=True)
+    name = Column(String(96))
+    members = relationship("StructMember", order_by="StructMember.position")
+    def __init__(self, name, args):
+        self.struct_hash = content_hash(name, *args)
+        self.name = name
+        for position, arg in enumerate(args):
+            self.members.append(StructMember(self.struct_hash, position, arg))
+
+class StructMember(NRFBase):
+    """Structures' members table"""
+    __tablename__ = "StructMember"
+    __table_args__ = {"sqlite_with_rowid": False}
+    struct_hash = Column(String(64), ForeignKey('StructDef.hash'), primary_key=True)
+    position = Column(Integer, primary_key=True)
     arg_name = Column(String(96))
-    struct_name = Column(String(96), ForeignKey('Structures.name'))
-    softdev_signature = Column(String(64), ForeignKey('SoftDevice.sign'))
-    def __init__(self, soft_sign, arg_name, struct_name):
+    def __init__(self, struct_hash, position, arg_name):
+        self.struct_hash = struct_hash
+        self.position = position
         self.arg_name = arg_name
-        self.struct_name = struct_name
-        self.softdev_signature = soft_sign
 
-class UnionParams(NRFBase):
-    """Structure UnionParams of union members contained in structures"""
-    __tablename__ = "UnionParams"
-    union_id = Column("id", Integer, primary_key=True)
-    union_param = Column(String(96))
-    union_name = Column(String(96), ForeignKey('StructArgs.arg_name'))
-    struct_name = Column(String(96), ForeignKey('Structures.name'))
-    softdev_signature = Column(String(64), ForeignKey('SoftDevice.sign'))
-    def __init__(self, soft_sign, param, union, struct):
-        self.union_param = param
-        self.union_name = union
-        self.struct_name = struct
+class SoftDeviceStruct(NRFBase):
+    """Link table between SoftDevice signatures and their structures"""
+    __tablename__ = "SoftDeviceStruct"
+    # the link is its own primary key, stored without rowid nor extra index
+    __table_args__ = {"sqlite_with_rowid": False}
+    softdev_signature = Column(String(64), ForeignKey('SoftDevice.sign'), primary_key=True)
+    struct_hash = Column(String(64), ForeignKey('StructDef.hash'), primary_key=True)
+    def __init__(self, soft_sign, struct_hash):
         self.softdev_signature = soft_sign
+        self.struct_hash = struct_hash
 
-class Structures(NRFBase):
-    """Structures table"""
-    __tablename__ = "Structures"
-    struct_id = Column("id", Integer, primary_key=True)
+class StructLayout(NRFBase):
+    """Structure and union layouts table, content-addressed and shared by SoftDevices of the same ABI"""
+    __tablename__ = "StructLayout"
+    layout_hash = Column("hash", String(64), primary_key=True)
+    name = Column(String(128))
+    kind = Column(String(8))
+    abi = Column(String(16))
+    size = Column(Integer)
+    align = Column(Integer)
+    members = relationship("LayoutMemberRow", order_by="LayoutMemberRow.position")
+    def __init__(self, layout):
+        self.layout_hash = layout_hash(layout)
+        self.name = layout.name
+        self.kind = layout.kind
+        self.abi = layout.abi
+        self.size = layout.size
+        self.align = layout.align
+        for position, member in enumerate(layout.members):
+            self.members.append(LayoutMemberRow(self.layout_hash, position, member))
+
+class LayoutMemberRow(NRFBase):
+    """Layout members table: type, offset and size, bit position of bit-fields, length of arrays"""
+    __tablename__ = "LayoutMember"
+    __table_args__ = {"sqlite_with_rowid": False}
+    layout_hash = Column(String(64), ForeignKey('StructLayout.hash'), primary_key=True)
+    position = Column(Integer, primary_key=True)
     name = Column(String(96))
-    contains_union = Column(String(10)) #bool
-    contains_struct = Column(String(10)) #bool
-    softdev_signature = Column(String(64), ForeignKey('SoftDevice.sign'))
-    def __init__(self, soft_sign, name, contains_union, contains_struct):
-        self.name = name
+    type_name = Column(String(128))
+    offset = Column(Integer)
+    size = Column(Integer)
+    count = Column(Integer)
+    bit_offset = Column(Integer)
+    bit_size = Column(Integer)
+    def __init__(self, layout_hash, position, member):
+        self.layout_hash = layout_hash
+        self.position = position
+        self.name = member.name
+        self.type_name = member.type_name
+        self.offset = member.offset
+        self.size = member.size
+        self.count = member.count
+        self.bit_offset = member.bit_offset
+        self.bit_size = member.bit_size
+
+class SoftDeviceLayout(NRFBase):
+    """Link table between SoftDevice signatures and their structure layouts"""
+    __tablename__ = "SoftDeviceLayout"
+    # the link is its own primary key, stored without rowid nor extra index
+    __table_args__ = {"sqlite_with_rowid": False}
+    softdev_signature = Column(String(64), ForeignKey('SoftDevice.sign'), primary_key=True)
+    layout_hash = Column(String(64), ForeignKey('StructLayout.hash'), primary_key=True)
+    def __init__(self, soft_sign, layout_hash):
         self.softdev_signature = soft_sign
+        self.layout_hash = layout_hash
 
 class SVCLast(NRFBase):
     """SVCLast class svc_last ranges for nRF5 version"""
@@ -459,18 +723,105 @@ class SVCLast(NRFBase):
         self.svc_last_num = svc_last_num
         self.softdev_signature = soft_sign
 
+class BuildInfo(NRFBase):
+    """BuildInfo table, identity of each nrfparse build of the database"""
+    __tablename__ = "BuildInfo"
+    id = Column("id", Integer, primary_key=True)
+    build_id = Column(String(32))
+    built_at = Column(String(32))
+    def __init__(self):
+        self.build_id = uuid.uuid4().hex
+        self.built_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+class SDKMarker(NRFBase):
+    """SDKMarker class, SDK version and nRF part strings of the firmwares and the SoftDevices they designate"""
+    __tablename__ = "SDKMarker"
+    marker_id = Column("id", Integer, primary_key=True)
+    marker = Column(String(64), index=True)
+    kind = Column(String(8))
+    softdev_signature = Column(String(64), ForeignKey('SoftDevice.sign'))
+    sdk_version = Column(String(32))
+    nrf = Column(String(32))
+    softdevice_v = Column(String(32))
+    def __init__(self, marker, kind, soft_sign, sdk_version, nrf, softdevice_v):
+        self.marker = marker
+        self.kind = kind
+        self.softdev_signature = soft_sign
+        self.sdk_version = sdk_version
+        self.nrf = nrf
+        self.softdevice_v = softdevice_v
+
+def sdk_markers(sdk_version):
+    """
+    Returns the lowercase strings designating an SDK version in the source paths left by the SDK asserts:
+    "nRF51 SDK_v6.1.0/...", "nRF5_SDK_14.0.0_3bcc1f7/...", "nRF5 SDK 12.3.0/..."
+    """
+    version = sdk_version.lstrip("v")
+    return ["sdk_" + version, "sdk_v" + version, "sdk " + version, "sdk v" + version]
+
+def build_marker_table(session):
+    """
+    (Re)builds the SDKMarker table from the SoftDevices of the database
+    Each SDK version marker designates the SoftDevices of its SDK, each nRF part marker
+    (nrf52832) the SoftDevices of that part or of its family (nrf51)
+    The SoftDevice images themselves hold no such string, they are not scanned
+    """
+    session.query(SDKMarker).delete()
+    rows = session.query(SoftDevice.sign, SoftDevice.sdk_version, SoftDevice.nrf, SoftDevice.softdevice_v).all()
+    parts = set(nrf for sign, sdk_version, nrf, softdevice_v in rows if re.match(r"nrf5\d+$", nrf))
+    markers = set()
+    for sign, sdk_version, nrf, softdevice_v in rows:
+        for marker in sdk_markers(sdk_version):
+            markers.add((marker, "sdk", sign, sdk_version, nrf, softdevice_v))
+        for part in parts:
+            if part.startswith(nrf):
+                markers.add((part, "nrf", sign, sdk_version, nrf, softdevice_v))
+    for marker in sorted(markers):
+        session.add(SDKMarker(*marker))
+    session.commit()
+    print("SDK marker table built: {0} markers".format(len(set(marker[0] for marker in markers))))
+
+def write_sidecar(session, sidecar, path, build_id):
+    """
+    Writes the signature sidecar of every SoftDevice of the database
+    """
+    softdevices = []
+    for sign, sdk_version, nrf, softdevice_v in session.query(SoftDevice.sign, SoftDevice.sdk_version,
+                                                              SoftDevice.nrf, SoftDevice.softdevice_v):
+        softdevices.append((sign, SoftDeviceRow(sdk_version, nrf, softdevice_v)))
+    sidecar.write(path, softdevices, build_id)
+
+def build_search_index(engine):
+    """
+    (Re)builds the SearchIndex FTS5 table over function prototypes and structures
+    One row per distinct prototype or structure, referenced by its content hash;
+    nrfquery joins the link tables to filter by SDK, SoftDevice and nRF
+    """
+    with engine.begin() as con:
+        con.execute(text("DROP TABLE IF EXISTS SearchIndex"))
+        con.execute(text("CREATE VIRTUAL TABLE SearchIndex USING fts5(kind, name, prototype, ref UNINDEXED, "
+                         "tokenize=\"unicode61 tokenchars '_'\")"))
+        con.execute(text("INSERT INTO SearchIndex SELECT 'function', function, "
+                         "trim(ret_type) || ' ' || function || '(' || arguments || ') [' || svc || ' ' || syscall || ']', "
+                         "hash FROM Prototype"))
+        con.execute(text("INSERT INTO SearchIndex SELECT 'struct', d.name, "
+                         "d.name || ' {' || coalesce(group_concat(m.arg_name, '; '), '') || '}', d.hash "
+                         "FROM StructDef d LEFT JOIN StructMember m ON m.struct_hash=d.hash GROUP BY d.hash"))
+        con.execute(text("INSERT INTO SearchIndex(SearchIndex) VALUES ('optimize')"))
+
 class SDK(object):
     """
     Based on the Nordic development kit archive in its zip format. 
     The version will identify the SDK.
     The softdevices contained in this version are identified and listed, and for each softdevice, 
-    headers and linkers files are extracted from the archive to the disk into the local
-    directory SDKs/sdk_version/. If found in the archive, the firmware in its .hex format 
+    headers and linkers files are extracted from the archive to the disk into the
+    directory root/sdk_version/. If found in the archive, the firmware in its .hex format 
     associated to the softdevice is also extracted.
     """
-    def __init__(self, sdk_version, sdk_path):
+    def __init__(self, sdk_version, sdk_path, root=SDKS_ROOT):
         self.version = sdk_version
         self.zip_path = sdk_path
+        self.directory = os.path.join(root, sdk_version)
         self.compiled = None
         self.hex_path = None
 
@@ -512,35 +863,74 @@ class SDK(object):
                         self.extract_fromzip(sdv_zip, f)
     def extract_hex(self, hex_path):
         """
-        Extracts header and linker files from the SDK archive to local SDKs directory
+        Extracts the firmware in its .hex format from the SDK archive to root/sdk_version/
         """
-        directory = "./SDKs/" + self.version + "/"
-        if not os.path.exists(directory):
-            if not os.path.exists("SDKs"):
-                os.mkdir("SDKs")
-            os.mkdir(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        # a SoftDevice without firmware must not keep the hex of the previous one
+        self.hex_path = None
         with zipfile.ZipFile(self.zip_path) as sdv_zip:
             for f in sdv_zip.namelist():
                 if (f.startswith(hex_path) and fnmatch.fnmatch(f, '*.hex')):
                     print("Extracting the Hex format of firmware from archive to disk")
                     self.hex_path = f
-                    sdv_zip.extract(f, directory)
+                    sdv_zip.extract(f, self.directory)
     def extract_fromzip(self, sdv_zip, path):
         """
-        Extracts header and ld files from the SDK archive to local SDKs directory
+        Extracts header and ld files from the SDK archive to root/sdk_version/
         """
-        directory = "./SDKs/" + self.version + "/"
-        if not os.path.exists(directory):
-            if not os.path.exists("SDKs"):
-                os.mkdir("SDKs")
-            os.mkdir(directory)
+        os.makedirs(self.directory, exist_ok=True)
         try:
             for f in sdv_zip.namelist():
                 if f.startswith(path):
-                    sdv_zip.extract(f, directory)
-        except IOError:
+                    sdv_zip.extract(f, self.directory)
+        except IOError as err:
             print("I/O error: {0}".format(err))
 
+class SDKTree(SDK):
+    """
+    SDK version already extracted in the root/sdk_version/ directory
+    Same interface as SDK: the SoftDevices are listed from the directory tree
+    and nothing is extracted
+    """
+    def __init__(self, sdk_version, root=SDKS_ROOT):
+        SDK.__init__(self, sdk_version, None, root)
+        self.root = os.path.join(root, sdk_version)
+
+    def list_softdevices(self):
+        """
+        Lists the Softdevices of the extracted SDK
+        """
+        soft_devices = set()
+        sdv_dir = os.path.join(self.root, "components", "softdevice")
+        if os.path.isdir(sdv_dir):
+            for name in os.listdir(sdv_dir):
+                if name.startswith("s") and os.path.isdir(os.path.join(sdv_dir, name)):
+                    soft_devices.add(name)
+        #only soft_device source code
+        for nrf in os.listdir(self.root):
+            inc_dir = os.path.join(self.root, nrf, "Include")
+            if nrf.startswith("nrf") and os.path.isdir(inc_dir):
+                for name in os.listdir(inc_dir):
+                    if len(name) == 4 and name.startswith("s") and os.path.isdir(os.path.join(inc_dir, name)):
+                        soft_devices.add(nrf + "," + name)
+        return soft_devices
+
+    def extract_softdevices(self):
+        """
+        Headers and linkers are already on disk
+        """
+
+    def extract_hex(self, hex_path):
+        """
+        Sets the path of the firmware in its .hex format, relative to the SDK directory
+        """
+        self.hex_path = None
+        hex_dir = os.path.join(self.root, hex_path)
+        if os.path.isdir(hex_dir):
+            for fname in sorted(os.listdir(hex_dir)):
+                if fnmatch.fnmatch(fname, "*.hex"):
+                    self.hex_path = hex_path + fname
+
 class SDKs(object):
     """Nordic development kits"""
     def __init__(self, directory):
@@ -596,20 +986,97 @@ def main():
     """
     main
     """
+    parser = argparse.ArgumentParser("nrfparse.py")
+    parser.add_argument("--db", help="path of nRF.db to build (default: $NRF_DB or nRF.db next to the tools)",
+                        metavar="DB", default=None)
+    parser.add_argument("--trace", help="write a Chrome trace-event JSON of the build stages to FILE",
+                        metavar="FILE", default=None)
+    parser.add_argument("--parse-cache", help="path of the header parse cache (default: nrfparse-cache.db next to the tools)",
+                        metavar="CACHE", default=DEFAULT_PARSE_CACHE)
+    parser.add_argument("--no-parse-cache", help="parse every header and linker file", action="store_true")
+    sources = parser.add_mutually_exclusive_group()
+    sources.add_argument("--archives", help="build from the SDK archives (.zip) of DIR, without downloading",
+                         metavar="DIR", default=None)
+    sources.add_argument("--offline", help="build from the SDKs already extracted in DIR (default: ./SDKs), "
+                         "without archives", metavar="DIR", nargs="?", const=SDKS_ROOT, default=None)
+    parser.add_argument("--extract-to", help="extract the SDK archives into DIR (default: a temporary directory "
+                        "removed after the build)", metavar="DIR", default=None)
+    parser.add_argument("--sidecar", help="path of the signature sidecar (default: nRF.sig next to nRF.db)",
+                        metavar="SIDECAR", default=None)
+    args = parser.parse_args()
+    if args.offline is not None and args.extract_to is not None:
+        parser.error("argument --extract-to: not allowed with argument --offline")
+    nrftrace.enable(args.trace)
+    parse_cache = None
+    if not args.no_parse_cache:
+        parse_cache = ParseCache(args.parse_cache)
+    sidecar = SidecarBuilder()
+    engine = create_engine("sqlite:///" + db_path(args.db))
     Session = sessionmaker(bind=engine)
     session = Session()
     NRFBase.metadata.create_all(engine)
-    sdk_dir = "developer.nordicsemi.com/nRF5_SDK/"
-    download_sdk(sdk_dir, "http://" + sdk_dir)
-    sdks = SDKs(sdk_dir)
-    for sdk_v, zip_path in sdks.dict.items():
-        sdk = SDK(sdk_v, zip_path)
-        print("\n       ====================")
-        print("       ", sdk_v, "=>", zip_path)
-        print("        ====================")
+    root = SDKS_ROOT
+    extracted = None
+    if args.offline is not None:
+        root = args.offline.rstrip("/")
+        if not os.path.isdir(root):
+            parser.error("SDKs directory not found: {0}".format(root))
+        print("Offline build from the SDKs extracted in {0}".format(root))
+        sdk_archives = dict((sdk_v, None) for sdk_v in os.listdir(root) if os.path.isdir(os.path.join(root, sdk_v)))
+    else:
+        sdk_dir = args.archives
+        if sdk_dir is None:
+            sdk_dir = "developer.nordicsemi.com/nRF5_SDK/"
+            with nrftrace.span("download_sdk"):
+                download_sdk(sdk_dir, "http://" + sdk_dir)
+        with nrftrace.span("sdks_walk"):
+            sdk_archives = SDKs(sdk_dir).dict
+        if args.extract_to is not None:
+            root = args.extract_to.rstrip("/")
+        else:
+            extracted = tempfile.TemporaryDirectory(prefix="nrfparse-")
+            root = extracted.name
+        print("SDK archives extracted in {0}".format(root))
+    for sdk_v, zip_path in sorted(sdk_archives.items()):
+        with nrftrace.span("sdk", version=sdk_v):
+            parse_sdk(sdk_v, zip_path, session, parse_cache, sidecar, root)
+    # results cached by nrfident against a previous build are invalidated by the new build_id
+    build = BuildInfo()
+    session.add(build)
+    with nrftrace.span("orm_flush"):
+        session.commit()
+    with nrftrace.span("search_index"):
+        build_search_index(engine)
+    with nrftrace.span("marker_table"):
+        build_marker_table(session)
+    with nrftrace.span("sidecar"):
+        write_sidecar(session, sidecar, args.sidecar or sidecar_path(db_path(args.db)), build.build_id)
+    print("SoftDevice successfully added to database")
+    if extracted is not None:
+        extracted.cleanup()
+    if parse_cache is not None:
+        parse_cache.close()
+    nrftrace.finish()
+
+def parse_sdk(sdk_v, zip_path, session, parse_cache=None, sidecar=None, root=SDKS_ROOT):
+    """
+    Extracts the SoftDevices of an SDK archive and parses each of them
+    The archive is extracted to root/sdk_v/; without archive (zip_path None), the SDK is read
+    from the already extracted root/sdk_v/ directory
+    The SoftDevice images are added to the sidecar builder if one is given
+    """
+    if zip_path is None:
+        sdk = SDKTree(sdk_v, root)
+    else:
+        sdk = SDK(sdk_v, zip_path, root)
+    print("\n       ====================")
+    print("       ", sdk_v, "=>", zip_path)
+    print("        ====================")
+    with nrftrace.span("extract_softdevices", version=sdk_v):
         sdk.extract_softdevices()
-        soft_devices = list(sdk.list_softdevices())
-        for soft_dvc in soft_devices:
+        soft_devices = sorted(sdk.list_softdevices())
+    for soft_dvc in soft_devices:
+        with nrftrace.span("softdevice", version=sdk_v, softdevice=soft_dvc):
             if "nrf" in soft_dvc:
                 nrf = soft_dvc.split(",")[0]
                 sdvc = soft_dvc.split(",")[1]
@@ -626,28 +1093,32 @@ def main():
                 sdvc = soft_dvc
                 header_dir = "components/softdevice/" + sdvc + "/headers/"
                 linker_dir = "components/softdevice/" + sdvc + "/toolchain/armgcc/"
-                linkers_path = "./SDKs/" + sdk_v + "/" + linker_dir
+                linkers_path = root + "/" + sdk_v + "/" + linker_dir
                 if os.path.exists(linkers_path) is False:
                     linker_dir = "components/toolchain/gcc/"
                 hex_dir = "components/softdevice/" + sdvc + "/hex/"
                 print("\n=== {0} {1} ===".format(sdvc, nrf))
                 sdk.extract_hex(hex_dir)
-            soft_device = SoftDevice(sdk_v, sdvc, nrf, header_dir, linker_dir, sdk.hex_path, session)
-            soft_device.signature()
+            soft_device = SoftDevice(sdk_v, sdvc, nrf, header_dir, linker_dir, sdk.hex_path, session, parse_cache, root)
+            with nrftrace.span("signature"):
+                soft_device.signature()
             print("SoftDevice Signature: {0}".format(soft_device.sign))
+            if sidecar is not None and soft_device.image is not None:
+                sidecar.add_image(soft_device.image)
+            soft_device.image = None
             soft_device.set_headers()
             # Setting a list of header files for parsing
             try:
                 soft_device.set_linkers()
                 if soft_device.linkers != []:
-                    soft_device.mem_parser()
+                    with nrftrace.span("mem_parser"):
+                        soft_device.mem_parser()
             except IOError as err:
                 print("I/O error: {0}".format(err))
-            soft_device.svc_parser()
+            with nrftrace.span("svc_parser"):
+                soft_device.svc_parser()
             print("SVCALLs, functions, structures' parsing completed")
             session.add(soft_device)
-    session.commit()
-    print("SoftDevice successfully added to database")
 
 if __name__ == '__main__':
     main()
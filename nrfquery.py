@@ -0,0 +1,48 @@
+#!/usr/bin/env python3.5
+
+"""
+NRF5 SoftDevice API search tool
+Ranked full-text search over the SVCALL prototypes and structures of nRF.db
+"""
+import argparse
+import sys
+from nrfdb import NRFDatabase
+import nrftrace
+
+def format_softdevices(softdevices):
+    """
+    Returns the "SDK SoftDevice nRF" list of a search hit
+    """
+    return ", ".join("{0} {1} {2}".format(sd.sdk_version, sd.softdevice_v, sd.nrf) for sd in softdevices)
+
+def main():
+    """
+    main
+    """
+    parser = argparse.ArgumentParser("nrfquery.py")
+    parser.add_argument("query", help="FTS5 query: sd_ble_gap_adv_set_configure, 'sd_ble_gap*', "
+                        "'ble_gap_adv_params_t AND kind:function'", metavar="QUERY")
+    parser.add_argument("--sdk", help="only SoftDevices of this SDK version (14.0.0)", default=None)
+    parser.add_argument("--softdevice", help="only this SoftDevice version (s132)", default=None)
+    parser.add_argument("--nrf", help="only this nRF (nrf52832)", default=None)
+    parser.add_argument("--limit", help="maximum number of results", type=int, default=50)
+    parser.add_argument("--db", help="path of nRF.db", default=None)
+    parser.add_argument("--trace", help="write a Chrome trace-event JSON of the search to FILE",
+                        metavar="FILE", default=None)
+    args = parser.parse_args()
+    nrftrace.enable(args.trace)
+    with NRFDatabase(args.db) as db:
+        try:
+            with nrftrace.span("search", query=args.query):
+                hits = db.search(args.query, args.sdk, args.softdevice, args.nrf, args.limit)
+        except ValueError as err:
+            print(err)
+            sys.exit(1)
+    for hit in hits:
+        print("[{0}] {1}".format(hit.kind, hit.prototype))
+        print("    " + format_softdevices(hit.softdevices))
+    print("{0} results".format(len(hits)))
+    nrftrace.finish()
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,16 @@
 """
 NRF5 reverse tool using IDA-python
 """
-import sqlite3
+import json
+import os
 import idaapi
 import idc
+from nrfdb import NRFDatabase, db_path
+from nrflayout import layout_order
+import nrftrace
+
+APPLIED_NODE = "$ nrf5x"
+MEMBER_FLAGS = {1: idc.FF_BYTE, 2: idc.FF_WORD, 4: idc.FF_DWRD, 8: idc.FF_QWRD}
 
 def launch_print():
     """print message"""
@@ -26,23 +33,111 @@ class NRF5xReverse(object):
         Database initialisation
         """
         self.nrf_db = nRF_db
-        self.con = sqlite3.connect(self.nrf_db)
-        self.cur = self.con.cursor()
+        self.db = NRFDatabase(self.nrf_db)
         self.svc_addr = dict()
         self.svc_count = dict()
         self.structs = []
+        self.layouts = dict()
+        self.mem_map = None
+        self.app_area = None
+        self.applied = {"sign": None, "structs": dict(), "svcs": dict()}
+        self.changed_structs = []
         self.types = {"int8_t":"__int8", "int16_t": "__int16", "int32_t": "__int32", "int64_t":"__int64", "int128_t":"__int128"}
         with open(nRFv_path, "r") as nrf_file:
             self.sign = nrf_file.read()
 
+    def load_applied(self):
+        """
+        Loads the record of what a previous run applied to this IDB
+        The record is stored as a json blob in the "$ nrf5x" netnode of the database
+        and is discarded if it was produced for another SoftDevice signature
+        """
+        node = idaapi.netnode(APPLIED_NODE, 0, True)
+        blob = node.getblob(0, "N")
+        if blob is None:
+            return
+        applied = json.loads(blob.decode("utf-8"))
+        if applied.get("sign") == self.sign:
+            self.applied = applied
+            print("Previous run found in IDB:", len(applied["structs"]), "structures,", len(applied["svcs"]), "SVC sites")
+
+    def save_applied(self):
+        """
+        Stores the record of applied signature, structures and SVC names in the IDB
+        """
+        self.applied["sign"] = self.sign
+        node = idaapi.netnode(APPLIED_NODE, 0, True)
+        node.delblob(0, "N")
+        node.setblob(json.dumps(self.applied).encode("utf-8"), 0, "N")
+
+    def get_memory_map(self):
+        """
+        Selects the RAM and FLASH mapping of the identified SoftDevice from nRF.db
+        Several card versions may share the signature: the smallest FLASH region
+        holding the loaded image is kept
+        """
+        layouts = set()
+        for res in self.db.memory_maps(self.sign):
+            layouts.add((res.ram_origin, res.ram_length, res.rom_origin, res.rom_length))
+        layouts = list(layouts)
+        if layouts == []:
+            print("No memory mapping found in nRF.db for", self.sign)
+            return
+        image_end = idc.MaxEA()
+        fitting = [lay for lay in layouts if lay[2] + lay[3] >= image_end]
+        if fitting != []:
+            self.mem_map = min(fitting, key=lambda lay: lay[3])
+        else:
+            self.mem_map = max(layouts, key=lambda lay: lay[2] + lay[3])
+        print("RAM  : ", hex(self.mem_map[0]), hex(self.mem_map[1]))
+        print("FLASH: ", hex(self.mem_map[2]), hex(self.mem_map[3]))
+
+    def setup_segments(self):
+        """
+        Creates FLASH and RAM segments bounded by the memory mapping
+        The SoftDevice region (MBR and SoftDevice below rom_origin) is marked as known
+        and removed from the auto-analysis queue, only the application is analysed
+        """
+        if self.mem_map is None:
+            return
+        ram_origin, ram_length, rom_origin, rom_length = self.mem_map
+        rom_end = min(rom_origin + rom_length, idc.MaxEA())
+        if rom_origin >= rom_end:
+            print("No application in the image: FLASH origin", hex(rom_origin), "is above its end", hex(idc.MaxEA()))
+            return
+        # add_segm truncates the segment created by the loader
+        idc.AddSeg(rom_origin, rom_end, 0, 1, idc.saRelPara, idc.scPub)
+        idc.RenameSeg(rom_origin, "FLASH")
+        idc.SetSegClass(rom_origin, "CODE")
+        # Cortex-M only executes Thumb code
+        idc.SetRegEx(rom_origin, "T", 1, idc.SR_user)
+        idc.AddSeg(ram_origin, ram_origin + ram_length, 0, 1, idc.saRelPara, idc.scPub)
+        idc.RenameSeg(ram_origin, "RAM")
+        idc.SetSegClass(ram_origin, "DATA")
+        if rom_origin > idc.MinEA():
+            softdev_start = idc.MinEA()
+            idc.RenameSeg(softdev_start, "SOFTDEVICE")
+            idc.SetSegClass(softdev_start, "CODE")
+            idc.SetRegEx(softdev_start, "T", 1, idc.SR_user)
+            idaapi.autoUnmark(softdev_start, rom_origin, idaapi.AU_CODE)
+            idaapi.autoUnmark(softdev_start, rom_origin, idaapi.AU_USED)
+            idc.MakeComm(softdev_start, "SoftDevice " + self.sign + ", not analysed")
+        self.app_area = (rom_origin, rom_end)
+        idc.AnalyzeArea(rom_origin, rom_end)
+
     def extract_syscalls(self):
         """
         Extracts SVC from ASM to self.svc_addr
         Condition met in ASM : SVC 0xnum
         Retrieves syscall number called (SVC 0xnum => 0xnum syscall) at svc_addr
+        Only the application area is walked once segments are set up
         """
-        for segea in Segments():
-            for head in Heads(segea, SegEnd(segea)):
+        if self.app_area is not None:
+            areas = [self.app_area]
+        else:
+            areas = [(segea, SegEnd(segea)) for segea in Segments()]
+        for start, end in areas:
+            for head in Heads(start, end):
                 if isCode(GetFlags(head)):
                     mnem = GetMnem(head)
                     if mnem == "SVC":
@@ -58,61 +153,71 @@ class NRF5xReverse(object):
     def resolve_svcs(self):
         """
         Resolves svcs in binary
+        SVC sites already renamed by a previous run with the same syscall and count are skipped
         """
         for addr, syscall in self.svc_addr.items():
-            req = "select distinct(svc) from SVCALL where LOWER(syscall)=LOWER(?) and softdev_signature LIKE ?"
-            self.cur.execute(req, (syscall, self.sign))
-            svc = self.cur.fetchall()
+            site = self.applied["svcs"].get(str(addr))
+            if site is not None and site[0] == syscall and site[1] == self.svc_count[syscall] and idc.Name(addr) == site[2]:
+                continue
+            svc = self.db.svc_names(syscall, self.sign)
             if len(svc) != 1:
                 print("No SVC identified or SoftDevice version must be specified\n", syscall, self.sign)
             else:
-                svcall = SVCALL(self.sign, self.cur, addr, syscall, self.svc_count[syscall])
+                svcall = SVCALL(self.sign, self.db, addr, syscall, self.svc_count[syscall])
                 svcall.rename(self.types)
+                self.applied["svcs"][str(addr)] = [syscall, self.svc_count[syscall], svcall.function]
 
     def get_structs(self):
         """
         Extracts structures from nRF.db
         """
-        self.structs = dict() 
-        req = "select distinct(name) from Structures where softdev_signature LIKE ?"
-        self.cur.execute(req, (self.sign, ))
-        structs = self.cur.fetchall()
-        print(structs)
-        for struct in structs:
-            req1 = "select distinct(arg_name) from StructArgs where struct_name=? and softdev_signature LIKE ?"
-            self.cur.execute(req1, (struct[0], self.sign))
-            struct_args = self.cur.fetchall()
-            self.structs[struct[0]] = struct_args
+        self.layouts = self.db.layouts(self.sign)
+        if self.layouts != {}:
+            # precomputed layouts are recorded in the IDB as lists to detect changes
+            self.structs = dict((name, [layout.kind, layout.size] + [list(member) for member in layout.members])
+                                for name, layout in self.layouts.items())
+        else:
+            self.structs = self.db.structs(self.sign)
+        print(list(self.structs))
 
     def add_struc(self):
         """
         Adds structures to IDA
+        Only structures missing from the IDB or whose members changed since the previous run are added
         """
         print("## Structures ##")
-        structs = dict()
         idx = idaapi.get_last_struc_idx()
-        print(idx, self.structs)
-        idaapi.add_struc(idx, str(next(iter(self.structs))))
         for structure, args in self.structs.items():
-            idx = idaapi.get_next_struc_idx(idx)
-            struct_id = idaapi.get_struc_by_idx(idx)
             struct_name = str(structure)
-            idaapi.add_struc(idx, struct_name)
             self.types[struct_name] = struct_name
+            sid = idc.GetStrucIdByName(struct_name)
+            if sid != idc.BADADDR and self.applied["structs"].get(struct_name) == args:
+                continue
+            if sid == idc.BADADDR:
+                idx = idaapi.get_next_struc_idx(idx)
+                is_union = struct_name in self.layouts and self.layouts[struct_name].kind == "union"
+                idaapi.add_struc(idx, struct_name, is_union)
+            self.changed_structs.append(struct_name)
+        print(len(self.changed_structs), "new or changed structures")
 
     def add_strucmem(self):
         """
         Adds structures'members
         """
+        if self.layouts != {}:
+            self.add_layout_members()
+            return
         idx = idaapi.get_last_struc_idx()
-        for structure, args in self.structs.items():
-            struct_name = str(structure)
+        for struct_name in self.changed_structs:
+            args = self.structs[struct_name]
             sid = idc.GetStrucIdByName(struct_name)
+            # members of a changed structure are all redefined
+            idaapi.del_struc_members(idaapi.get_struc(sid), 0, idc.BADADDR)
             mem_cmt = ""
             for struct_arg in args:
-                if "union" in struct_arg[0]:
-                    print(struct_arg[0])
-                    union = struct_arg[0].replace("union ", "")
+                if "union" in struct_arg:
+                    print(struct_arg)
+                    union = struct_arg.replace("union ", "")
                     union_name = union.split("(")[0]
                     union_members = union.split("(")[1].replace(")", "").rsplit(",")
                     uid = idaapi.get_next_struc_idx(idx)
@@ -126,27 +231,70 @@ class NRF5xReverse(object):
                             member_size = idc.GetStrucSize(member_id)
                             print(uid, union_name, member_type, member_name, member_size)
                             idc.AddStrucMember(uid, member_name, -1, idc.FF_DWRD, -1, member_size)
-                member = struct_arg[0].split(" ")[1].split("(")[0]
-                member_type = struct_arg[0].split(" ")[0]
-                mem_cmt += struct_arg[0] + "|"
+                member = struct_arg.split(" ")[1].split("(")[0]
+                member_type = struct_arg.split(" ")[0]
+                mem_cmt += struct_arg + "|"
                 idc.AddStrucMember(sid, str(member), -1, idc.FF_DWRD, -1, 8)
             struct_cmt = "STRUCTURE " + struct_name + " contains " + mem_cmt
             idaapi.set_struc_cmt(sid, str(struct_cmt), False)
+            self.applied["structs"][struct_name] = args
+
+    def add_layout_members(self):
+        """
+        Adds the members of the new or changed structures at the offsets of their precomputed layouts
+        Embedded structures are filled first so that their size is known where they are used;
+        the bit-fields sharing a container are added as one member
+        """
+        changed = set(self.changed_structs)
+        for layout in layout_order(self.layouts.values()):
+            if layout.name not in changed:
+                continue
+            sid = idc.GetStrucIdByName(layout.name)
+            idaapi.del_struc_members(idaapi.get_struc(sid), 0, idc.BADADDR)
+            members = []
+            for member in layout.members:
+                if member.bit_size is not None and members != [] and members[-1][1].bit_size is not None \
+                        and members[-1][1].offset == member.offset:
+                    members[-1][0].append(member)
+                else:
+                    members.append(([member], member))
+            decls = []
+            end = 0
+            for fields, member in members:
+                if member.bit_size is not None:
+                    name = "_".join(field.name for field in fields)
+                    decls += ["{0} {1}:{2}".format(field.type_name, field.name, field.bit_size) for field in fields]
+                else:
+                    name = member.name
+                    decls.append("{0} {1}{2}".format(member.type_name, member.name,
+                                                     "[{0}]".format(member.count) if member.count is not None else ""))
+                if member.size == 0:
+                    continue
+                element_size = member.size // member.count if member.count else member.size
+                flag, typeid = MEMBER_FLAGS.get(element_size, idc.FF_BYTE), -1
+                if member.type_name in self.layouts:
+                    flag, typeid = idc.FF_STRU, idc.GetStrucIdByName(str(member.type_name))
+                offset = -1 if layout.kind == "union" else member.offset
+                idc.AddStrucMember(sid, str(name), offset, flag, typeid, member.size)
+                end = max(end, member.offset + member.size)
+            if layout.kind == "struct" and end < layout.size:
+                idc.AddStrucMember(sid, "padding", end, idc.FF_BYTE, -1, layout.size - end)
+            struct_cmt = "STRUCTURE " + layout.name + " (" + layout.abi + ") contains " + "|".join(decls)
+            idaapi.set_struc_cmt(sid, str(struct_cmt), False)
+            self.applied["structs"][layout.name] = self.structs[layout.name]
 
 class SVCALL():
     """
     SVCALL class initiates svc object associated to an address in IDA
     sets function names and prototypes
     """
-    def __init__(self, softdev_sign, cur, addr, syscall, syscall_cnt):
-        self.cur = cur
+    def __init__(self, softdev_sign, db, addr, syscall, syscall_cnt):
+        self.db = db
         self.addr = addr
         self.syscall = syscall
         self.syscall_cnt = syscall_cnt
-        req = "select distinct(svc), function, ret_type, arguments from SVCALL where LOWER(syscall)=LOWER(?) and softdev_signature LIKE ?"
-        self.cur.execute(req, (syscall, softdev_sign))
         #checking if syscall has same number of arguments for different softdevices given the approximative signature
-        res1 = self.cur.fetchall()
+        res1 = self.db.svcalls(syscall, softdev_sign)
         if len(res1) != 1:
             self.args_len = len(res1[0][3].rsplit(",")) 
             for i in range(len(res1)):
@@ -155,9 +303,7 @@ class SVCALL():
                     print('number of arguments is different for softdevices, SYSCALL:', self.syscall)
                     print(args_1, len(args_1.rsplit(",")))
                     print(res1[0][3], self.args_len)
-        req = "select distinct(svc), function, ret_type, arguments from SVCALL where LOWER(syscall)=LOWER(?) and softdev_signature LIKE ?"
-        self.cur.execute(req, (syscall, softdev_sign))
-        res = self.cur.fetchone()
+        res = res1[0]
         self.svc = res[0]
         self.function = str(res[1])
         self.ret_type = res[2]
@@ -210,16 +356,26 @@ def main():
     main
     """
     launch_print()
+    nrftrace.enable(os.environ.get(nrftrace.TRACE_ENV))
     nrf_sign = "./nRF_ver"
-    nrf_db = "./nRF.db"
+    nrf_db = db_path()
     nrf = NRF5xReverse(nrf_sign, nrf_db)
-    nrf.get_structs()
-    nrf.add_struc()
-    nrf.add_strucmem()
-    nrf.extract_syscalls()
-    nrf.count_svcs()
-    nrf.resolve_svcs()
-    nrf.con.close()
+    nrf.load_applied()
+    with nrftrace.span("setup_segments"):
+        nrf.get_memory_map()
+        nrf.setup_segments()
+    with nrftrace.span("structures"):
+        nrf.get_structs()
+        nrf.add_struc()
+        nrf.add_strucmem()
+    with nrftrace.span("extract_syscalls"):
+        nrf.extract_syscalls()
+        nrf.count_svcs()
+    with nrftrace.span("resolve_svcs"):
+        nrf.resolve_svcs()
+    nrf.save_applied()
+    nrf.db.close()
+    nrftrace.finish()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3.5
+
+"""
+Compact signature sidecar of nRF.db
+A small versioned file answering "is this a known SoftDevice, which one" without sqlite:
+- a sorted array of truncated signature hashes, each mapped to an (sdk, nrf, softdevice) label
+- a Bloom filter over the hashes of the SoftDevice images' blocks, to recognise altered or
+  partial SoftDevices whose signature is unknown
+The file is memory mapped by nrfident and only read where a lookup lands.
+"""
+import argparse
+import glob
+import hashlib
+import math
+import mmap
+import os
+import struct
+from nrfdb import NRFDatabase, SoftDeviceRow
+
+MAGIC = b"NRFSIG\0\0"
+FORMAT_VERSION = 1
+# magic, format version, key size, entries, labels, Bloom filter bits and hashes, block size, nRF.db build_id
+HEADER = struct.Struct("<8sHHIIIII32s")
+ENTRY = struct.Struct(">QI")
+LABEL = struct.Struct("16s16s16s")
+KEY_SIZE = 8
+BLOCK_SIZE = 1024
+BLOOM_FP_RATE = 0.001
+
+def sidecar_path(db_file):
+    """
+    Returns the default sidecar path of a nRF.db path: nRF.sig next to it
+    """
+    return os.path.splitext(db_file)[0] + ".sig"
+
+def signature_key(sign):
+    """
+    Returns the truncated key of a hex signature, None for the approximate (strings) signatures
+    """
+    if len(sign) != 64:
+        return None
+    try:
+        return int(sign[:2 * KEY_SIZE], 16)
+    except ValueError:
+        return None
+
+def block_hashes(image):
+    """
+    Returns the hashes of the aligned BLOCK_SIZE blocks of an image, erased (0xff) blocks excepted
+    """
+    hashes = set()
+    image = memoryview(image)
+    erased = b"\xff" * BLOCK_SIZE
+    for pos in range(0, len(image) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        block = image[pos:pos + BLOCK_SIZE]
+        if block != erased:
+            hashes.add(hashlib.sha256(block).digest()[:16])
+    return hashes
+
+def bloom_positions(block_hash, bits, hashes):
+    """
+    Returns the Bloom filter bits of a block hash, by double hashing of its two halves
+    """
+    first, second = struct.unpack("<QQ", block_hash)
+    return [(first + i * second) % bits for i in range(hashes)]
+
+class SidecarBuilder(object):
+    """
+    Collects the SoftDevice images seen by nrfparse and writes the sidecar
+    """
+    def __init__(self):
+        self.blocks = set()
+
+    def add_image(self, image):
+        """
+        Adds the blocks of a SoftDevice image to the Bloom filter
+        """
+        self.blocks |= block_hashes(image)
+
+    def write(self, path, softdevices, build_id):
+        """
+        Writes the sidecar of the (signature, SoftDeviceRow) pairs of nRF.db
+        """
+        labels = []
+        entries = []
+        for sign, softdevice in softdevices:
+            key = signature_key(sign)
+            if key is None:
+                continue
+            if softdevice not in labels:
+                labels.append(softdevice)
+            entries.append((key, labels.index(softdevice)))
+        entries = sorted(set(entries))
+        count = max(len(self.blocks), 1)
+        bits = max(int(math.ceil(-count * math.log(BLOOM_FP_RATE) / math.log(2) ** 2)), 64)
+        hashes = max(int(round(bits / count * math.log(2))), 1)
+        bloom = bytearray((bits + 7) // 8)
+        for block_hash in self.blocks:
+            for bit in bloom_positions(block_hash, bits, hashes):
+                bloom[bit // 8] |= 1 << (bit % 8)
+        with open(path, "wb") as sidecar:
+            sidecar.write(HEADER.pack(MAGIC, FORMAT_VERSION, KEY_SIZE, len(entries), len(labels), bits, hashes,
+                                      BLOCK_SIZE, build_id.encode("ascii")[:32]))
+            for key, label in entries:
+                sidecar.write(ENTRY.pack(key, label))
+            for softdevice in labels:
+                sidecar.write(LABEL.pack(*(field.encode("utf-8") for field in softdevice)))
+            sidecar.write(bloom)
+        print("Signature sidecar written to {0}: {1} signatures, {2} blocks".format(path, len(entries), count))
+
+class Sidecar(object):
+    """
+    Memory mapped signature sidecar
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as sidecar:
+            self.map = mmap.mmap(sidecar.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, key_size, self.entries, self.labels, self.bloom_bits, self.bloom_hashes,
+         self.block_size, build_id) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION or key_size != KEY_SIZE:
+            self.map.close()
+            raise ValueError("{0} is not a version {1} signature sidecar".format(path, FORMAT_VERSION))
+        self.build_id = build_id.rstrip(b"\0").decode("ascii")
+        self.entries_offset = HEADER.size
+        self.labels_offset = self.entries_offset + self.entries * ENTRY.size
+        self.bloom_offset = self.labels_offset + self.labels * LABEL.size
+
+    def close(self):
+        """
+        Unmaps the sidecar
+        """
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def check(self, build_id):
+        """
+        Raises ValueError if the sidecar was not exported from the nRF.db build build_id
+        """
+        if self.build_id != build_id[:32]:
+            raise ValueError("{0} was exported from nRF.db build {1}, not from build {2}".format(
+                self.path, self.build_id, build_id))
+
+    def entry(self, i):
+        """
+        Returns the (key, label index) of the i-th entry
+        """
+        return ENTRY.unpack_from(self.map, self.entries_offset + i * ENTRY.size)
+
+    def label(self, i):
+        """
+        Returns the SoftDeviceRow of a label index
+        """
+        fields = LABEL.unpack_from(self.map, self.labels_offset + i * LABEL.size)
+        return SoftDeviceRow(*(field.rstrip(b"\0").decode("utf-8") for field in fields))
+
+    def lookup(self, sign):
+        """
+        Returns the SoftDevices of a signature, an empty list if it is unknown
+        A hit is a match of the first KEY_SIZE bytes of the signature
+        """
+        key = signature_key(sign)
+        if key is None:
+            return []
+        low, high = 0, self.entries
+        while low < high:
+            mid = (low + high) // 2
+            if self.entry(mid)[0] < key:
+                low = mid + 1
+            else:
+                high = mid
+        softdevices = []
+        while low < self.entries:
+            entry_key, label = self.entry(low)
+            if entry_key != key:
+                break
+            softdevices.append(self.label(label))
+            low += 1
+        return softdevices
+
+    def has_block(self, block_hash):
+        """
+        Returns whether a block hash may belong to a known SoftDevice (Bloom filter test)
+        """
+        for bit in bloom_positions(block_hash, self.bloom_bits, self.bloom_hashes):
+            if not self.map[self.bloom_offset + bit // 8] & (1 << (bit % 8)):
+                return False
+        return True
+
+    def known_blocks(self, image):
+        """
+        Returns the ratio of the non-erased blocks of an image found in the Bloom filter
+        """
+        hashes = block_hashes(image)
+        if not hashes:
+            return 0.0
+        return sum(1 for block_hash in hashes if self.has_block(block_hash)) / len(hashes)
+
+def main():
+    """
+    main
+    Writes the sidecar of an existing nRF.db, with the SoftDevice images of the SDKs directory
+    (nrfparse writes it at the end of each build)
+    """
+    parser = argparse.ArgumentParser("nrfsidecar.py")
+    parser.add_argument("--db", help="path of nRF.db", default=None)
+    parser.add_argument("--sdks", help="directory of the extracted SDKs", default="SDKs")
+    parser.add_argument("--output", help="path of the sidecar (default: nRF.sig next to nRF.db)", default=None)
+    args = parser.parse_args()
+    from nrfident import load_image
+    builder = SidecarBuilder()
+    for path in sorted(glob.glob(os.path.join(args.sdks, "*", "components", "softdevice", "*", "hex", "*.hex"))):
+        builder.add_image(load_image(path))
+    with NRFDatabase(args.db) as db:
+        softdevices = [(res[0], SoftDeviceRow(*res[1:]))
+                       for res in db.query("select sign, sdk_version, nrf, softdevice_v from SoftDevice", ())]
+        builder.write(args.output or sidecar_path(db.path), softdevices, db.build_id)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3.5
+
+"""
+NRF5 synthetic firmware corpus generator
+Combines the reference SoftDevices shipped in the SDKs directory with generated
+application regions, and writes .hex and .bin images with their ground-truth labels.
+The corpus only depends on the seed: the same seed always gives the same images.
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import struct
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from intelhex import IntelHex
+from nrfdb import NRFDatabase
+from nrfident import load_image, identify, identify_image, strings_signature, SIGN_OFFSET, SIGN_LENGTH, \
+    UICR_BOOTLOADERADDR
+from nrfindex import app_start, PAGE_SIZE
+import nrftrace
+
+REFERENCE_GLOB = os.path.join("*", "components", "softdevice", "*", "hex", "*.hex")
+LABELS_FILE = "labels.jsonl"
+RAM_TOP = 0x20008000
+UICR_MBR_PARAMS = 0x10001018
+UICR_CUSTOMER = 0x10001080
+# common Thumb halfwords: push/pop {r4, lr}, movs r0 #0/#1, bx lr, nop, adds, ldr, str, cmp, b
+THUMB_FILLERS = [0xb510, 0xbd10, 0x2000, 0x2001, 0x4770, 0xbf00, 0x1c40, 0x6800, 0x6008, 0x2800, 0xe7fe]
+
+Reference = namedtuple("Reference", ["path", "sign", "image", "app_start", "nrf", "svcs", "truth"])
+
+def load_references(sdks_dir, db):
+    """
+    Returns the distinct reference SoftDevices of the SDKs directory, identified by signature
+    """
+    references = []
+    signs = set()
+    for path in sorted(glob.glob(os.path.join(sdks_dir, REFERENCE_GLOB))):
+        image = load_image(path)
+        result = identify_image(image, db)
+        if result.method != "signature" or result.sign in signs:
+            continue
+        signs.add(result.sign)
+        start = app_start(result, image)
+        if start is None or start < len(image):
+            # the application starts on the FLASH page following the reference SoftDevice
+            start = (len(image) + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+        svcs = sorted(db.svc_table(result.sign))
+        truth = sorted(set(tuple(candidate) for candidate in result.candidates))
+        references.append(Reference(path, result.sign, bytes(image), start, result.candidates[0].nrf, svcs, truth))
+    return references
+
+def sdk_marker(candidate):
+    """
+    Returns an SDK source path string as left in the firmwares by the SDK asserts
+    """
+    sdk_version, nrf, softdevice_v = candidate
+    return "C:/Nordic Semiconductor/nRF5 SDK_{0}/examples/{1}/{2}/main.c".format(sdk_version.lstrip("v"), nrf,
+                                                                               softdevice_v)
+
+def generate_app(rng, reference, size):
+    """
+    Returns an application region and the SVC numbers it calls with their number of call sites
+    The region starts with a vector table and is filled with common Thumb instructions,
+    SVC instructions are drawn from the SVCALLs of the SoftDevice
+    """
+    app = bytearray()
+    for pos in range(0, size, 2):
+        app += struct.pack("<H", rng.choice(THUMB_FILLERS))
+    app[0:8] = struct.pack("<II", RAM_TOP, reference.app_start + 0x101)
+    svcs = reference.svcs if reference.svcs != [] else list(range(0x60, 0xa0))
+    calls = dict()
+    used = set()
+    for i in range(rng.randint(8, 64)):
+        pos = rng.randrange(8, size, 2)
+        if pos in used:
+            continue
+        used.add(pos)
+        svc = rng.choice(svcs)
+        app[pos:pos + 2] = bytes([svc, 0xdf])
+        calls[svc] = calls.get(svc, 0) + 1
+    return app, used, calls
+
+def mutate(rng, image, start, end, count, reserved=()):
+    """
+    Overwrites count random bytes of image[start:end] outside of the reserved offsets
+    (and of the byte following each of them)
+    Returns the mutated offsets
+    """
+    offsets = []
+    while len(offsets) < count:
+        pos = rng.randrange(start, end)
+        if pos in reserved or pos - 1 in reserved or pos in offsets:
+            continue
+        # 0xdf is avoided so that mutations never create SVC instructions
+        image[pos] = rng.choice([value for value in range(256) if value != 0xdf and value != image[pos]])
+        offsets.append(pos)
+    return sorted(offsets)
+
+def generate_image(seed, index, references, options):
+    """
+    Generates one image and its label
+    Returns (name, image, uicr records, label)
+    """
+    rng = random.Random("{0}:{1}".format(seed, index))
+    reference = references[rng.randrange(len(references))]
+    image = bytearray(reference.image)
+    image += b"\xff" * (reference.app_start - len(image))
+    app_size = rng.randrange(4 * 1024, options["max_app_size"], 2)
+    app, sites, calls = generate_app(rng, reference, app_size)
+    marker = None
+    reserved = set(reference.app_start + site for site in sites)
+    if rng.random() < options["marker_rate"]:
+        marker = sdk_marker(reference.truth[rng.randrange(len(reference.truth))])
+        data = marker.encode("ascii") + b"\0"
+        pos = rng.randrange(8, app_size - len(data), 2)
+        if not any(pos <= site < pos + len(data) + 1 for site in sites):
+            app[pos:pos + len(data)] = data
+            reserved.update(range(reference.app_start + pos - 1, reference.app_start + pos + len(data)))
+        else:
+            marker = None
+    image += app
+    label = {"reference": reference.path, "sign": reference.sign, "truth": reference.truth,
+             "app_start": reference.app_start, "app_size": app_size,
+             "svcs": dict((hex(svc), count) for svc, count in sorted(calls.items())),
+             "marker": marker, "marker_sign": strings_signature(marker.encode("ascii")) if marker else None}
+    label["app_mutations"] = mutate(rng, image, reference.app_start + 8, len(image),
+                                    rng.randint(0, options["max_mutations"]), reserved)
+    label["sd_mutations"] = []
+    if rng.random() < options["sd_mutation_rate"]:
+        label["sd_mutations"] = mutate(rng, image, SIGN_OFFSET, SIGN_OFFSET + SIGN_LENGTH, rng.randint(1, 4))
+    label["truncated_to"] = None
+    if rng.random() < options["truncate_rate"]:
+        label["truncated_to"] = rng.randrange(SIGN_OFFSET, len(image))
+        del image[label["truncated_to"]:]
+    label["sign_intact"] = label["sd_mutations"] == [] and len(image) >= SIGN_OFFSET + SIGN_LENGTH
+    label["format"] = options["formats"][rng.randrange(len(options["formats"]))]
+    uicr = dict()
+    if label["format"] == "hex":
+        if rng.random() < 0.5:
+            uicr[UICR_BOOTLOADERADDR] = rng.choice([0x3a000, 0x75000, 0x78000, 0xf8000])
+            if reference.nrf.startswith("nrf52"):
+                uicr[UICR_MBR_PARAMS] = uicr[UICR_BOOTLOADERADDR] + 0x5000
+        for i in range(rng.randint(0, 4)):
+            uicr[UICR_CUSTOMER + 4 * i] = rng.getrandbits(32)
+    label["uicr"] = dict((hex(addr), hex(value)) for addr, value in sorted(uicr.items()))
+    name = "synth-{0:06d}.{1}".format(index, label["format"])
+    label["file"] = name
+    return name, bytes(image), uicr, label
+
+def write_image(path, image, uicr):
+    """
+    Writes an image as .bin, or as .hex with its UICR records
+    """
+    if path.endswith(".bin"):
+        with open(path, "wb") as firmware:
+            firmware.write(image)
+        return
+    ihex = IntelHex()
+    ihex.frombytes(image)
+    for addr, value in uicr.items():
+        ihex.puts(addr, struct.pack("<I", value))
+    ihex.write_hex_file(path)
+
+def generate(outdir, count, seed, sdks_dir, db, options):
+    """
+    Generates count images and their labels in outdir
+    """
+    references = load_references(sdks_dir, db)
+    if references == []:
+        raise ValueError("no reference SoftDevice identified in {0}".format(sdks_dir))
+    print("{0} reference SoftDevices".format(len(references)))
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    with open(os.path.join(outdir, LABELS_FILE), "w") as labels:
+        for index in range(count):
+            name, image, uicr, label = generate_image(seed, index, references, options)
+            write_image(os.path.join(outdir, name), image, uicr)
+            labels.write(json.dumps(label, sort_keys=True) + "\n")
+    print("{0} images written to {1}".format(count, outdir))
+
+def read_labels(outdir):
+    """
+    Returns the labels of a generated corpus
+    """
+    with open(os.path.join(outdir, LABELS_FILE)) as labels:
+        return [json.loads(line) for line in labels]
+
+def evaluate(outdir, jobs=None, db=None):
+    """
+    Identifies every image of a corpus and compares the results with the labels
+    db is the path of the nRF.db to identify with, the default nRF.db if None
+    Prints the throughput and the accuracy for intact and altered signatures
+    """
+    labels = read_labels(outdir)
+    paths = [os.path.join(outdir, label["file"]) for label in labels]
+    begin = time.perf_counter()
+    with ProcessPoolExecutor(jobs) as executor:
+        results = list(executor.map(partial(identify, db=db), paths, chunksize=16))
+    elapsed = time.perf_counter() - begin
+    stats = dict()
+    for label, result in zip(labels, results):
+        group = stats.setdefault("intact" if label["sign_intact"] else "altered",
+                                 {"images": 0, "correct": 0, "wrong": 0, "unidentified": 0})
+        group["images"] += 1
+        truth = set(tuple(candidate) for candidate in label["truth"])
+        if not result.identified:
+            group["unidentified"] += 1
+        elif truth & set(tuple(candidate) for candidate in result.candidates):
+            group["correct"] += 1
+        else:
+            group["wrong"] += 1
+    print("{0} images identified in {1:.2f}s ({2:.1f} images/s)".format(len(labels), elapsed,
+                                                                       len(labels) / elapsed))
+    for name, group in sorted(stats.items()):
+        print("{0:8} signature: {1[images]} images, {1[correct]} correct, {1[wrong]} wrong, "
+              "{1[unidentified]} unidentified ({2:.1%} accuracy)".format(name, group,
+                                                                         group["correct"] / group["images"]))
+    return stats
+
+def main():
+    """
+    main
+    """
+    parser = argparse.ArgumentParser("nrfsynth.py")
+    parser.add_argument("--trace", help="write a Chrome trace-event JSON of the stages to FILE",
+                        metavar="FILE", default=None)
+    subparsers = parser.add_subparsers(dest="command")
+    gen_parser = subparsers.add_parser("generate", help="generate a synthetic corpus")
+    gen_parser.add_argument("outdir", help="output directory", metavar="DIR")
+    gen_parser.add_argument("--count", help="number of images", type=int, default=1000)
+    gen_parser.add_argument("--seed", help="generation seed", type=int, default=0)
+    gen_parser.add_argument("--sdks", help="directory of the extracted SDKs", default="SDKs")
+    gen_parser.add_argument("--db", help="path of nRF.db", default=None)
+    gen_parser.add_argument("--formats", help="output formats", choices=["hex", "bin"], nargs="+",
+                            default=["hex", "bin"])
+    gen_parser.add_argument("--max-app-size", help="maximum application size in bytes", type=int,
+                            default=64 * 1024)
+    gen_parser.add_argument("--max-mutations", help="maximum number of mutated application bytes", type=int,
+                            default=16)
+    gen_parser.add_argument("--marker-rate", help="ratio of images embedding an SDK path string", type=float,
+                            default=0.5)
+    gen_parser.add_argument("--sd-mutation-rate", help="ratio of images with a mutated SoftDevice signature area",
+                            type=float, default=0.1)
+    gen_parser.add_argument("--truncate-rate", help="ratio of truncated images", type=float, default=0.05)
+    eval_parser = subparsers.add_parser("evaluate", help="identify a corpus and compare with its labels")
+    eval_parser.add_argument("outdir", help="corpus directory", metavar="DIR")
+    eval_parser.add_argument("--jobs", help="number of worker processes", type=int, default=None)
+    eval_parser.add_argument("--db", help="path of nRF.db", default=None)
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error("a command is required")
+    nrftrace.enable(args.trace)
+    if args.command == "generate":
+        options = {"formats": args.formats, "max_app_size": args.max_app_size,
+                   "max_mutations": args.max_mutations, "marker_rate": args.marker_rate,
+                   "sd_mutation_rate": args.sd_mutation_rate, "truncate_rate": args.truncate_rate}
+        with NRFDatabase(args.db) as db, nrftrace.span("generate", count=args.count):
+            generate(args.outdir, args.count, args.seed, args.sdks, db, options)
+    else:
+        with nrftrace.span("evaluate"):
+            evaluate(args.outdir, args.jobs, args.db)
+    nrftrace.finish()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3.5
+
+"""
+Opt-in stage tracing of the nRF5x tools
+Nested timing spans and memory samples are written in Chrome trace-event JSON,
+viewable in chrome://tracing or ui.perfetto.dev.
+When tracing is not enabled, span() returns a shared no-op context manager.
+Memory samples are the peak resident size of the process, read at the end of each span;
+the Python allocations are only traced (tracemalloc, several times slower) if NRF_TRACE_MALLOC is set.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    resource = None
+
+TRACE_ENV = "NRF_TRACE"
+TRACE_MALLOC_ENV = "NRF_TRACE_MALLOC"
+# ru_maxrss is in bytes on macOS, in KiB elsewhere
+MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+class _NullSpan(object):
+    """
+    No-op span used while tracing is disabled
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+_tracer = None
+
+class _Span(object):
+    """
+    Timing span recorded as a complete ("X") trace event
+    """
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.begin = None
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.tracer.complete(self.name, self.begin, end, self.args)
+        return False
+
+class Tracer(object):
+    """
+    Collects trace events and writes them to a Chrome trace-event JSON file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+        self.malloc = bool(os.environ.get(TRACE_MALLOC_ENV))
+        if self.malloc:
+            tracemalloc.start()
+
+    def timestamp(self, counter):
+        """
+        Converts a perf_counter value to trace microseconds
+        """
+        return (counter - self.origin) * 1e6
+
+    def memory(self):
+        """
+        Returns the memory sample of the process: peak resident size and traced Python allocations
+        """
+        sample = dict()
+        if resource is not None:
+            sample["maxrss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT
+        if self.malloc:
+            sample["current"], sample["peak"] = tracemalloc.get_traced_memory()
+        return sample
+
+    def complete(self, name, begin, end, args):
+        """
+        Records a finished span and a memory sample at its end
+        """
+        sample = self.memory()
+        tid = threading.get_ident()
+        with self.lock:
+            self.events.append({"name": name, "ph": "X", "pid": self.pid, "tid": tid,
+                                "ts": self.timestamp(begin), "dur": (end - begin) * 1e6,
+                                "args": args})
+            if sample != {}:
+                self.events.append({"name": "memory", "ph": "C", "pid": self.pid, "tid": tid,
+                                    "ts": self.timestamp(end), "args": sample})
+
+    def write(self):
+        """
+        Writes the collected events to the trace file
+        """
+        if self.malloc:
+            tracemalloc.stop()
+        with open(self.path, "w") as trace_file:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, trace_file)
+        print("Trace written to {0}".format(self.path))
+
+def enable(path):
+    """
+    Enables tracing to the given file, tracing stays disabled if path is None
+    """
+    global _tracer
+    if path is not None:
+        _tracer = Tracer(path)
+
+def finish():
+    """
+    Writes the trace file if tracing is enabled
+    """
+    global _tracer
+    if _tracer is not None:
+        _tracer.write()
+        _tracer = None
+
+def span(name, **args):
+    """
+    Returns a context manager timing the enclosed stage
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return _Span(_tracer, name, args)
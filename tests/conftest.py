@@ -0,0 +1,28 @@
+"""
+Shared fixtures of the nRF5x tools tests
+The tests run against the nRF.db and the SoftDevices of the SDKs directory of the repository.
+"""
+import glob
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from nrfdb import NRFDatabase
+
+@pytest.fixture(scope="session")
+def db():
+    """
+    nRF.db of the repository
+    """
+    with NRFDatabase(os.path.join(ROOT, "nRF.db")) as nrf_db:
+        yield nrf_db
+
+@pytest.fixture(scope="session")
+def softdevice_hexes():
+    """
+    Reference SoftDevice .hex files of the SDKs directory
+    """
+    return sorted(glob.glob(os.path.join(ROOT, "SDKs", "*", "components", "softdevice", "*", "hex", "*.hex")))
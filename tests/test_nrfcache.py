@@ -0,0 +1,20 @@
+"""
+nrfcache tests
+"""
+from concurrent.futures import ThreadPoolExecutor
+from nrfcache import IdentCache
+from nrfident import identify
+
+def test_identify_from_threads_with_cache(db, softdevice_hexes, tmp_path):
+    """
+    A cache shared between threads gives the results of identify() without cache
+    """
+    firmwares = (softdevice_hexes[:4] * 25)
+    expected = dict((path, identify(path, db)) for path in set(firmwares))
+    cache = IdentCache(db.build_id, path=str(tmp_path / "ident.db"))
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda path: identify(path, db, cache=cache), firmwares))
+    finally:
+        cache.close()
+    assert results == [expected[path] for path in firmwares]
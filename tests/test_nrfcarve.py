@@ -0,0 +1,43 @@
+"""
+nrfcarve tests
+"""
+import glob
+import os
+from conftest import ROOT
+from nrfcarve import carve
+from nrfident import load_image
+
+def test_carve_softdevice_without_memory_map(db, tmp_path):
+    """
+    The application of a SoftDevice without memory map in nRF.db starts at the end of the
+    SoftDevice given by its information structure
+    """
+    softdevice_hex = glob.glob(os.path.join(ROOT, "SDKs", "13.0.0-1.alpha", "components", "softdevice", "s140",
+                                            "hex", "*.hex"))[0]
+    softdevice = bytes(load_image(softdevice_hex))
+    app = bytes(range(256)) * 16
+    image = softdevice + b"\xff" * (0x21000 - len(softdevice)) + app
+    firmware = tmp_path / "fw.bin"
+    firmware.write_bytes(image)
+    result, carved = carve(str(firmware), str(tmp_path), ["bin"], db)
+    assert result.method == "signature" and result.memory_maps == []
+    regions = dict((name, (start, end)) for name, start, end, files in carved)
+    assert regions == {"mbr": (0, 0x1000), "softdevice": (0x1000, 0x21000), "application": (0x21000, len(image))}
+    assert (tmp_path / "fw.application.bin").read_bytes() == app
+    assert (tmp_path / "fw.softdevice.bin").read_bytes() == image[0x1000:0x21000]
+
+def test_carve_erased_application(db, tmp_path):
+    """
+    A dump whose application region is erased is carved without its application and the
+    memory mapped .bin is closed
+    """
+    softdevice_hex = glob.glob(os.path.join(ROOT, "SDKs", "11.0.0", "components", "softdevice", "s130",
+                                            "hex", "*.hex"))[0]
+    softdevice = bytes(load_image(softdevice_hex))
+    image = softdevice + b"\xff" * (0x30000 - len(softdevice))
+    firmware = tmp_path / "fw.bin"
+    firmware.write_bytes(image)
+    result, carved = carve(str(firmware), str(tmp_path), ["bin", "hex"], db)
+    assert result.method == "signature"
+    assert [(name, start, end) for name, start, end, files in carved] == [("mbr", 0, 0x1000),
+                                                                          ("softdevice", 0x1000, 0x1b000)]
@@ -0,0 +1,94 @@
+"""
+nrfdb tests
+The read paths of the normalised nRF.db: search index, SDK markers, structure layouts
+and content-addressed prototypes and structures
+"""
+import sys
+import pytest
+import nrfquery
+from nrfdb import Layout, LayoutMember, SoftDeviceRow
+from nrfident import Candidate, identify_image
+
+def signature_of(db, sdk_version, softdevice_v):
+    """
+    Returns the signature of a SoftDevice of an SDK version
+    """
+    return db.query("select sign from SoftDevice where sdk_version=? and softdevice_v=?",
+                    (sdk_version, softdevice_v))[0][0]
+
+def test_database_schema(db):
+    """
+    The nRF.db of the repository is built with every table read by the tools
+    """
+    assert db.normalised and db.searchable and db.markable and db.laid_out
+    assert not db.build_id.startswith("file-")
+
+def test_search(db):
+    """
+    A function is found with the SoftDevices declaring it, filters narrow the SoftDevices
+    """
+    hits = db.search("sd_ble_gap_adv_start")
+    assert hits != []
+    assert set(hit.kind for hit in hits) == {"function"}
+    assert all(hit.name == "sd_ble_gap_adv_start" for hit in hits)
+    hits = db.search("sd_ble_gap_adv_start", sdk_version="14.0.0", softdevice_v="s132")
+    assert len(hits) == 1
+    assert hits[0].softdevices == [SoftDeviceRow("14.0.0", "nrf52832", "s132")]
+    assert "uint8_t conn_cfg_tag" in hits[0].prototype
+
+def test_search_invalid_query(db):
+    """
+    An FTS5 syntax error is reported as a ValueError
+    """
+    with pytest.raises(ValueError):
+        db.search("sd_ble_gap_adv_start AND")
+
+def test_nrfquery(monkeypatch, capsys):
+    """
+    nrfquery.py prints the hits and the SoftDevices defining them
+    """
+    monkeypatch.setattr(sys, "argv", ["nrfquery.py", "sd_ble_gap_adv_start", "--sdk", "14.0.0"])
+    nrfquery.main()
+    out = capsys.readouterr().out.splitlines()
+    assert out[0].startswith("[function] uint32_t sd_ble_gap_adv_start(")
+    assert out[1] == "    14.0.0 s132 nrf52832, 14.0.0 s140 hex"
+    assert out[-1] == "1 results"
+
+def test_identify_markers(db):
+    """
+    An image of unknown signature is identified by its SDK version and nRF part strings
+    """
+    image = b"\x00" * 0x4000 + b"Nordic Semiconductor nRF5 SDK 14.0.0 for nRF52832" + b"\x00" * 0x4000
+    result = identify_image(image, db)
+    assert result.identified
+    assert result.method == "markers"
+    assert result.candidates == [Candidate("14.0.0", "nrf52832", "s132"), Candidate("14.0.0", "nrf52832", "s212")]
+    assert sorted(memory_map.softdev_v for memory_map in result.memory_maps) == ["s132", "s212"]
+    assert result.confidence == 0.25
+
+def test_layouts(db):
+    """
+    Structure layouts hold the offsets and sizes of the members, bit-fields included
+    """
+    layouts = db.layouts(signature_of(db, "14.0.0", "s132"))
+    assert layouts["ble_gap_addr_t"] == Layout("ble_gap_addr_t", "struct", "cortex-m4", 7, 1, [
+        LayoutMember("addr_id_peer", "uint8_t", 0, 1, None, 0, 1),
+        LayoutMember("addr_type", "uint8_t", 0, 1, None, 1, 7),
+        LayoutMember("addr", "uint8_t", 1, 6, 6, None, None),
+    ])
+
+def test_content_addressed_structs(db):
+    """
+    Structures and prototypes are read through the hashes linked to each signature, a
+    definition shared by two SoftDevices is loaded once
+    """
+    s132 = db.structs(signature_of(db, "14.0.0", "s132"))
+    assert s132["ble_gap_addr_t"] == ["uint8_t addr_id_peer : 1", "uint8_t addr_type : 7",
+                                      "uint8_t addr[BLE_GAP_ADDR_LEN]"]
+    loaded = len(db.struct_defs)
+    s140 = db.structs(signature_of(db, "14.0.0", "s140"))
+    assert s140["ble_gap_addr_t"] == s132["ble_gap_addr_t"]
+    assert len(db.struct_defs) < 2 * loaded
+    svcs = db.svc_table(signature_of(db, "14.0.0", "s132"))
+    assert svcs[0x60] == "sd_ble_enable"
+    assert db.svc_names("0x60", signature_of(db, "14.0.0", "s132")) == ["SD_BLE_ENABLE"]
@@ -0,0 +1,83 @@
+"""
+nrfindex tests
+"""
+import glob
+import itertools
+import os
+import struct
+import pytest
+from conftest import ROOT
+from nrfident import load_image, identify_image
+from nrfindex import SD_INFO, SD_INFO_OFFSET, SVCIndex, app_start, extract_image, svc_sites
+
+APP_SVCS = {0x60: 2, 0x7c: 1, 0x85: 3}
+
+def application():
+    """
+    Returns an application region calling the SVCs of APP_SVCS, filled with Thumb nops
+    """
+    app = bytearray(struct.pack("<H", 0xbf00) * 2048)
+    pos = 64
+    for svc, count in sorted(APP_SVCS.items()):
+        for i in range(count):
+            app[pos:pos + 2] = bytes([svc, 0xdf])
+            pos += 64
+    return bytes(app)
+
+@pytest.mark.parametrize("sdk_version, softdevice_v, app_start", [
+    # SoftDevice with a memory map
+    ("11.0.0", "s130", 0x1b000),
+    # SoftDevice without memory map
+    ("13.0.0-1.alpha", "s140", 0x21000),
+])
+def test_no_softdevice_svc_indexed(tmp_path, sdk_version, softdevice_v, app_start):
+    """
+    Only the SVCs of the application are indexed, not those of the SoftDevice
+    """
+    softdevice_hex = glob.glob(os.path.join(ROOT, "SDKs", sdk_version, "components", "softdevice", softdevice_v,
+                                            "hex", "*.hex"))[0]
+    softdevice = bytes(load_image(softdevice_hex))
+    assert svc_sites(softdevice) != {}
+    firmware = tmp_path / "fw.bin"
+    firmware.write_bytes(softdevice + b"\xff" * (app_start - len(softdevice)) + application())
+    path, key, sign, terms = extract_image(str(firmware), os.path.join(ROOT, "nRF.db"))
+    assert sign is not None
+    assert dict((term, count) for term, count in terms.items() if term.startswith("svc:")) == \
+        dict(("svc:" + hex(svc), count) for svc, count in APP_SVCS.items())
+
+def test_app_start_of_shared_signature(db):
+    """
+    The application start of a signature shared by several SoftDevices does not depend on the
+    order of the candidates, the maps of the other SoftDevices start inside or past this one
+    """
+    softdevice_hex = glob.glob(os.path.join(ROOT, "SDKs", "11.0.0", "components", "softdevice", "s130",
+                                            "hex", "*.hex"))[0]
+    softdevice = bytes(load_image(softdevice_hex))
+    result = identify_image(softdevice + application(), db)
+    assert [candidate.softdevice_v for candidate in result.candidates] == ["s130"]
+    # the first nRF.db builds linked the s212 and s332 maps to this signature
+    s130_map = result.memory_maps[0]
+    shared = result._replace(
+        candidates=result.candidates + [candidate._replace(softdevice_v=softdevice_v)
+                                        for candidate in result.candidates for softdevice_v in ("s212", "s332")],
+        memory_maps=result.memory_maps + [s130_map._replace(softdev_v="s212", rom_origin=0x12000),
+                                          s130_map._replace(softdev_v="s332", rom_origin=0x27000)])
+    without_info = softdevice[:SD_INFO_OFFSET] + b"\xff" * SD_INFO.size + softdevice[SD_INFO_OFFSET + SD_INFO.size:]
+    for image in (softdevice + application(), without_info + application()):
+        for candidates in itertools.permutations(shared.candidates):
+            assert app_start(shared._replace(candidates=list(candidates)), image) == 0x1b000
+
+def test_corrupt_image_skipped(tmp_path):
+    """
+    A corrupt image is reported and skipped, the other images of the run are indexed
+    """
+    softdevice_hex = glob.glob(os.path.join(ROOT, "SDKs", "11.0.0", "components", "softdevice", "s130",
+                                            "hex", "*.hex"))[0]
+    (tmp_path / "fw.bin").write_bytes(bytes(load_image(softdevice_hex)) + application())
+    (tmp_path / "broken.hex").write_text(":zz not a record\n")
+    index = SVCIndex(str(tmp_path / "corpus.idx"))
+    try:
+        assert index.add_firmwares([str(tmp_path)], 1, os.path.join(ROOT, "nRF.db")) == 1
+        assert [os.path.basename(path) for path, hits in index.query(["0x60"])] == ["fw.bin"]
+    finally:
+        index.close()
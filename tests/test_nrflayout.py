@@ -0,0 +1,40 @@
+"""
+nrflayout tests
+"""
+import time
+import pytest
+from nrflayout import LayoutError, evaluate
+
+DEFINES = {"BLE_GAP_ADDR_LEN": "(6)", "BLE_GAP_WHITELIST_ADDR_MAX_COUNT": "(BLE_GAP_ADDR_LEN * 2U + 1)"}
+
+@pytest.mark.parametrize("expr, value", [
+    ("BLE_GAP_WHITELIST_ADDR_MAX_COUNT", 13),
+    ("(uint8_t)(0x1FUL & ~3)", 28),
+    ("(1 << 4) | BLE_GAP_ADDR_LEN >> 1", 19),
+    # C division and remainder truncate toward zero
+    ("-7 / 2", -3),
+    ("-7 % 2", -1),
+])
+def test_evaluate(expr, value):
+    """
+    Constant integer expressions of the headers are evaluated with their macros expanded
+    """
+    assert evaluate(expr, DEFINES) == value
+
+@pytest.mark.parametrize("expr", [
+    "9**9**9",
+    "1 << 100000000",
+    "__import__('os').getcwd()",
+    "(1).bit_length()",
+    "UNKNOWN_LEN + 1",
+    "1 / 0",
+    "1.5",
+])
+def test_evaluate_rejected(expr):
+    """
+    Anything but integer literals and the C integer operators is refused without being evaluated
+    """
+    start = time.time()
+    with pytest.raises(LayoutError):
+        evaluate(expr, DEFINES)
+    assert time.time() - start < 1